@@ -1,13 +1,14 @@
 import csv
 import os
 from collections import defaultdict
+import logging
 from datetime import datetime
-from functools import wraps
+from functools import partial, wraps
 
 import flask_restful as restful
 import requests
 import json, yaml
-from flask import Flask, redirect, Blueprint, g, request, jsonify, render_template
+from flask import Flask, redirect, Blueprint, g, request, jsonify, render_template, Response
 from flask_compress import Compress
 from redislite import Redis
 from app.common.auth import AuthKey
@@ -17,9 +18,19 @@ from app.common.proxy import ProxyHandler
 from app.common.scoring_conf import DataSourceScoring
 from config import config, Config
 from elasticsearch import Elasticsearch
+from app.common.cache import SharedCache
+from app.common.codecs import get_json_codec
 from app.common.elasticsearchclient import esQuery, InternalCache
+from app.common.enrichment import AssociationMatrix, association_matrix_directory
+from app.common.jobs import JobQueue
+from app.common.prefork import freeze_shared_data
+from app.common.results import Result
+from app.common.response_cache import ResponseCache
+from app.common.startup import Lazy, StartupProfile
+from app.common.tissues import TissueMap
+from app.common.warmup import TrafficRecorder
+from app.resources.jobs import register_jobs
 from api import create_api
-from werkzeug.contrib.cache import FileSystemCache
 from app.common.signals import LogException
 from ipaddr import IPNetwork
 from mixpanel import Mixpanel
@@ -59,8 +70,40 @@ def do_not_cache(request):
     return False
 
 
+def load_ip_resolver(ip_list_file):
+    '''
+    :return: dict of IPNetwork: organisation, PUBLIC for any other address
+    '''
+    ip_resolver = defaultdict(lambda: "PUBLIC")
+    if not os.path.exists(ip_list_file):
+        ip_list_file = '../' + ip_list_file
+    if os.path.exists(ip_list_file):
+        with open(ip_list_file) as csvfile:
+            reader = csv.DictReader(csvfile)
+            for row in reader:
+                net = IPNetwork(row['ip'])
+                ip_resolver[net] = row['org']
+    else:
+        logging.getLogger(__name__).warning('cannot find IP list for IP resolver. All traffic will be logged as PUBLIC')
+    return ip_resolver
+
+
+def load_openapi_def(api_version):
+    openapi_def = yaml.load(file('app/static/openapi.template.yaml', 'r'))
+    logging.getLogger(__name__).info('parsing swagger from app/static/openapi.template.yaml')
+
+    #inject the description into the docs
+    with open("api-description.md", "r") as f:
+        desc = f.read()
+    openapi_def['info']['description'] = desc
+    openapi_def['basePath'] = '/v%s' % str(api_version)
+    return openapi_def
+
+
 def create_app(config_name):
+    profile = StartupProfile()
     app = Flask(__name__, static_url_path='')
+    app.extensions['startup_profile'] = profile
     # This first loads the configuration from eg. config['development'] which corresponds to the DevelopmentConfig class in the config.py
     app.config.from_object(config[config_name])
     # Then you can override the values with the contents of the file the OPENTARGETS_API_LOCAL_SETTINGS environment variable points to.
@@ -80,7 +123,7 @@ def create_app(config_name):
 
 
     app.logger.info('looking for elasticsearch at: %s' % app.config['ELASTICSEARCH_URL'])
-
+    profile.mark('config')
 
     app.extensions['redis-core'] = Redis(app.config['REDIS_SERVER_PATH'], db=0) #served data
     app.extensions['redis-service'] = Redis(app.config['REDIS_SERVER_PATH'], db=1) #cache, rate limit and internal things
@@ -88,9 +131,36 @@ def create_app(config_name):
     '''setup cache'''
     app.extensions['redis-service'].config_set('save','')
     app.extensions['redis-service'].config_set('appendonly', 'no')
+    if app.config['CACHE_REDIS_MAX_BYTES']:
+        # evict the least recently used keys with a ttl, i.e. cache entries, rather than the ones without.
+        # the policy is server wide: data that must not be evicted goes to another server, like the jobs
+        app.extensions['redis-service'].config_set('maxmemory', app.config['CACHE_REDIS_MAX_BYTES'])
+        app.extensions['redis-service'].config_set('maxmemory-policy', 'volatile-lru')
+    profile.mark('redis')
+    # the responses and the cache encode json with the codec configured for this app
+    Result.json_codec = get_json_codec(app.config['JSON_ENCODER'], app.config['JSON_DOUBLE_PRECISION'])
     icache = InternalCache(app.extensions['redis-service'],
-                           str(api_version_minor))
+                           str(api_version_minor),
+                           local_max_bytes=app.config['CACHE_LOCAL_MAX_BYTES'],
+                           lock_ttl=app.config['CACHE_LOCK_TTL'],
+                           stale_ttl=app.config['CACHE_STALE_TTL'],
+                           compress_min_bytes=app.config['CACHE_COMPRESS_MIN_BYTES'],
+                           data_version=app.config['DATA_VERSION'],
+                           index_check_interval=app.config['CACHE_INDEX_CHECK_INTERVAL'],
+                           json_codec=Result.json_codec)
     ip2org = IP2Org(icache)
+    app.extensions['traffic'] = TrafficRecorder(app.extensions['redis-service'],
+                                                paths=app.config['CACHE_WARMUP_PATHS'],
+                                                max_keys=app.config['CACHE_WARMUP_MAX_KEYS'])
+    # jobs and their results carry a ttl, on the caches server they would be evicted under memory pressure
+    app.extensions['redis-jobs'] = Redis(app.config['JOBS_REDIS_SERVER_PATH'], db=0)
+    app.extensions['jobs'] = JobQueue(app.extensions['redis-jobs'],
+                                      result_ttl=app.config['JOBS_RESULT_TTL'],
+                                      max_queued=app.config['JOBS_MAX_QUEUED'],
+                                      heartbeat_timeout=app.config['JOBS_HEARTBEAT_TIMEOUT'],
+                                      max_attempts=app.config['JOBS_MAX_ATTEMPTS'])
+    register_jobs(app.extensions['jobs'])
+    profile.mark('cache')
     if app.config['ELASTICSEARCH_URL']:
         es = Elasticsearch(app.config['ELASTICSEARCH_URL'],
                            # # sniff before doing anything
@@ -104,10 +174,11 @@ def create_app(config_name):
                            )
     else:
         es = None
+    app.extensions['datatypes'] = DataTypes(app)
     '''elasticsearch handlers'''
     app.extensions['esquery'] = esQuery(
         es,
-        DataTypes(app),
+        app.extensions['datatypes'],
         DataSourceScoring(app),
         index_data=app.config['ELASTICSEARCH_DATA_INDEX_NAME'],
         index_drug=app.config['ELASTICSEARCH_DRUG_INDEX_NAME'],
@@ -132,8 +203,22 @@ def create_app(config_name):
         # docname_search_disease=app.config['ELASTICSEARCH_DATA_SEARCH_DISEASE_DOC_NAME'],
         docname_relation=app.config['ELASTICSEARCH_DATA_RELATION_DOC_NAME'],
         log_level=app.logger.getEffectiveLevel(),
-        cache=icache
+        cache=icache,
+        label_index_path=app.config['LABEL_INDEX_PATH'],
+        tissue_map=TissueMap(app.config['ES_TISSUE_MAP_URL'],
+                             app.config['DATA_VERSION'],
+                             app.config['ES_TISSUE_MAP_PATH']),
+        association_matrix=Lazy(partial(AssociationMatrix.load,
+                                        association_matrix_directory(app.config['ASSOCIATION_MATRIX_PATH'],
+                                                                     app.config['DATA_VERSION'])))
+        if app.config['ASSOCIATION_MATRIX_PATH'] else None,
         )
+    if es is not None:
+        # namespace the cache by the indices serving the data, so that moving an alias invalidates it
+        # within CACHE_INDEX_CHECK_INTERVAL seconds
+        icache.index_resolver = app.extensions['esquery'].get_concrete_indices
+
+    profile.mark('elasticsearch')
 
     app.extensions['es_access_store'] = esStore(es,
         eventlog_index=app.config['ELASTICSEARCH_LOG_EVENT_INDEX_NAME'],
@@ -159,35 +244,17 @@ def create_app(config_name):
     # cors = CORS(app, resources=r'/api/*', allow_headers='Content-Type,Auth-Token')
 
     ''' define cache'''
-    # cache = Cache(config={'CACHE_TYPE': 'simple'})
-    # cache.init_app(latest_blueprint)
-    # latest_blueprint.cache = cache
-    # latest_blueprint.extensions['cache'] = cache
-    # app.cache = SimpleCache()
-    app.cache = FileSystemCache('/tmp/cttv-rest-api-cache', threshold=100000, default_timeout=60*60, mode=777)
-
-    '''load ip name resolution'''
-    ip_resolver = defaultdict(lambda: "PUBLIC")
-    ip_list_file = app.config['IP_RESOLVER_LIST_PATH']
-    if not os.path.exists(ip_list_file):
-        ip_list_file = '../' + ip_list_file
-    if os.path.exists(ip_list_file):
-        with open(ip_list_file) as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                net = IPNetwork(row['ip'])
-                ip_resolver[net] = row['org']
-    else:
-        app.logger.warning('cannot find IP list for IP resolver. All traffic will be logged as PUBLIC')
-    app.config['IP_RESOLVER'] = ip_resolver
+    app.cache = SharedCache(icache.namespace('app'), default_timeout=60*60)
 
+    '''load ip name resolution the first time it is needed'''
+    app.extensions['ip_resolver'] = Lazy(partial(load_ip_resolver, app.config['IP_RESOLVER_LIST_PATH']))
+    profile.mark('access logging')
 
 
     '''compress http response'''
     compress = Compress()
     compress.init_app(app)
 
-    latest_blueprint = Blueprint('latest', __name__)
     current_version_blueprint = Blueprint(str(api_version), __name__)
     current_minor_version_blueprint = Blueprint(str(api_version_minor), __name__)
 
@@ -199,29 +266,23 @@ def create_app(config_name):
         app.wsgi_app = ProfilerMiddleware(app.wsgi_app, restrictions=[30])
 
 
+    profile.mark('compress')
+
     '''set the right prefixes'''
 
-    create_api(latest_blueprint, api_version, specpath)
     create_api(current_version_blueprint, api_version, specpath)
     create_api(current_minor_version_blueprint, api_version_minor, specpath)
 
-    # app.register_blueprint(latest_blueprint, url_prefix='/latest/platform')
     app.register_blueprint(current_version_blueprint, url_prefix='/v'+str(api_version) + '/platform')
     app.register_blueprint(current_minor_version_blueprint, url_prefix='/v'+str(api_version_minor) + '/platform')
+    profile.mark('blueprints')
 
 
-    '''serve the static docs'''
-    openapi_def = yaml.load(file('app/static/openapi.template.yaml', 'r'))
-    app.logger.info('parsing swagger from app/static/openapi.template.yaml')
-
-    #inject the description into the docs
-    with open("api-description.md", "r") as f:
-        desc = f.read()
-    openapi_def['info']['description'] = desc
-    openapi_def['basePath'] = '/v%s' % str(api_version)
+    '''serve the static docs, parsed at the first request or before forking the workers'''
+    app.extensions['openapi'] = Lazy(lambda: json.dumps(load_openapi_def(api_version)))
     @app.route('/v%s/platform/swagger' % str(api_version))
     def serve_swagger(apiversion=api_version):
-        return jsonify(openapi_def)
+        return Response(app.extensions['openapi'].get(), mimetype='application/json')
 
     @app.route('/v%s/platform/docs/swagger-ui' % str(api_version))
     def render_swaggerui(apiversion=api_version):
@@ -247,14 +308,34 @@ def create_app(config_name):
             else:
                 cache = 30 * 24 * 60 * 60 #cache for 30 days
                 resp.headers.add('Cache-Control', "public, no-transform, max-age=%i"%(cache))
+                traffic = app.extensions['traffic']
+                if request.method == 'GET' and resp.status_code == 200 and traffic.should_record(request.path):
+                    traffic.record(request.full_path)
             return resp
 
         except Exception as e:
             app.logger.exception('failed request teardown function', str(e))
             return resp
 
+    '''cache the rendered responses. registered last, so that its after_request
+    hook runs before the ones compressing the responses and adding the headers'''
+    response_cache = ResponseCache(app.cache,
+                                   paths=app.config['RESPONSE_CACHE_PATHS'],
+                                   timeout=app.config['RESPONSE_CACHE_TIMEOUT'],
+                                   encodings=app.config['RESPONSE_CACHE_ENCODINGS'],
+                                   compress_level=app.config['COMPRESS_LEVEL'],
+                                   br_level=app.config['RESPONSE_CACHE_BR_LEVEL'],
+                                   compress_min_size=app.config['COMPRESS_MIN_SIZE'],
+                                   compress_mimetypes=app.config['COMPRESS_MIMETYPES'])
+    response_cache.init_app(app)
+
     # Override the HTTP exception handler.
     app.handle_http_exception = get_http_exception_handler(app)
+    profile.mark('hooks')
+
+    if app.config['FREEZE_SHARED_DATA']:
+        freeze_shared_data(app)
+        profile.mark('freeze shared data')
     return app
 
 
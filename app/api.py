@@ -1,8 +1,6 @@
 from app.resources.enrichment import EnrichmentTargets
 from app.resources.relation import  Relations
 from app.resources.utils import LogEvent
-from config import Config
-from app.common import load_tissue_map
 
 __author__ = 'andreap'
 
@@ -12,7 +10,6 @@ from flask_restful import Api
 def create_api(app, api_version = '0.0', specpath = '' ):
     # app.config['CORS_HEADERS'] = 'Content-Type,Auth-Token'
 
-    Config.ES_TISSUE_MAP = load_tissue_map()
     'custom errors for flask-restful'
     # errors = {'SignatureExpired': {
     #     'message': "Authentication expired.",
@@ -33,12 +30,13 @@ def create_api(app, api_version = '0.0', specpath = '' ):
     from app.resources import association
     from app.resources.expression import Expression
     from app.resources.datasets import DatasetList, Datasets
-    from app.resources.cache import ClearCache
+    from app.resources.cache import ClearCache, CacheStatistics
     from app.resources.utils import Ping, Version
     from app.resources.relation import RelationTargetSingle, RelationDiseaseSingle
     from app.resources.stats import Stats
     from app.resources.metrics import Metrics
     from app.resources.therapeuticarea import TherapeuticAreas
+    from app.resources.jobs import Jobs, Job, JobResult
 
     # api.add_resource(AvailableGenes,
     #                  basepath+'/available-genes')
@@ -91,6 +89,8 @@ def create_api(app, api_version = '0.0', specpath = '' ):
                      '/private/autocomplete')
     api.add_resource(ClearCache,
                      '/private/cache/clear')
+    api.add_resource(CacheStatistics,
+                     '/private/cache/stats')
     api.add_resource(Ping,
                      '/public/utils/ping')
     api.add_resource(Version,
@@ -111,5 +111,12 @@ def create_api(app, api_version = '0.0', specpath = '' ):
                      '/private/enrichment/targets')
     api.add_resource(TherapeuticAreas,
                      '/public/utils/therapeuticareas')
+    api.add_resource(Jobs,
+                     '/private/jobs')
+    api.add_resource(Job,
+                     '/private/jobs/<string:job_id>',
+                     endpoint='job')
+    api.add_resource(JobResult,
+                     '/private/jobs/<string:job_id>/result')
 
     return api
@@ -0,0 +1,281 @@
+import copy
+import hashlib
+import json
+import marshal
+import time
+from collections import OrderedDict
+
+from gevent.event import AsyncResult
+from werkzeug.contrib.cache import BaseCache
+
+__author__ = 'andreap'
+
+'''search arguments that do not change the returned documents'''
+IGNORED_KEY_ARGUMENTS = ('timeout', 'request_timeout')
+
+
+def _normalise(obj, terms=False):
+    if isinstance(obj, dict):
+        normalised = dict((k, _normalise(v, terms=k == 'terms')) for k, v in obj.items())
+        if terms:
+            # the values of a `terms` filter are OR-ed, their order does not matter
+            for k, v in normalised.items():
+                if isinstance(v, list) and all(isinstance(i, (basestring, int, long, float)) for i in v):
+                    normalised[k] = sorted(v)
+        return normalised
+    elif isinstance(obj, (list, tuple)):
+        return [_normalise(i) for i in obj]
+    return obj
+
+
+def canonical_cache_key(*args, **kwargs):
+    '''
+    builds a key for the arguments of an elasticsearch call that does not
+    depend on the insertion order of the body dicts, on the order of the
+    values of `terms` filters, or on timeouts.
+
+    :return: a string usable as InternalCache key
+    '''
+    kwargs = dict((k, v) for k, v in kwargs.items() if k not in IGNORED_KEY_ARGUMENTS)
+    return json.dumps([_normalise(args), _normalise(kwargs)],
+                      sort_keys=True,
+                      separators=(',', ':'),
+                      default=str)
+
+
+class KeyFoldCounter(object):
+    '''
+    counts how many distinct raw keys end up in the same canonical key, to
+    measure the hit rate gained by the canonicalisation.
+    tracks at most `max_keys` canonical keys per worker
+    '''
+
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self._folds = {}
+
+    def record(self, raw_key, canonical_key):
+        canonical_hash = hashlib.md5(canonical_key).hexdigest()
+        raw_keys = self._folds.get(canonical_hash)
+        if raw_keys is None:
+            if len(self._folds) >= self.max_keys:
+                return
+            raw_keys = self._folds[canonical_hash] = set()
+        raw_keys.add(hashlib.md5(raw_key).hexdigest())
+
+    def to_dict(self, top=10):
+        raw_total = sum(len(v) for v in self._folds.values())
+        folded = sorted(((len(v), k) for k, v in self._folds.items() if len(v) > 1),
+                        reverse=True)
+        return dict(canonical_keys=len(self._folds),
+                    raw_keys=raw_total,
+                    folded_keys=len(folded),
+                    top=[dict(key=k, raw_keys=n) for n, k in folded[:top]])
+
+
+class CacheStats(object):
+    '''
+    hit/miss counters for each tier of a cache, kept per worker process
+    '''
+
+    def __init__(self, *tiers):
+        self.counters = OrderedDict()
+        for tier in tiers:
+            self.counters[tier] = dict(hits=0, misses=0)
+
+    def hit(self, tier):
+        self.counters[tier]['hits'] += 1
+
+    def miss(self, tier):
+        self.counters[tier]['misses'] += 1
+
+    def to_dict(self):
+        stats = OrderedDict()
+        for tier, counter in self.counters.items():
+            total = counter['hits'] + counter['misses']
+            stats[tier] = dict(hits=counter['hits'],
+                               misses=counter['misses'],
+                               hit_ratio=float(counter['hits']) / total if total else 0.)
+        return stats
+
+
+class LocalLRUCache(object):
+    '''
+    least recently used cache living in the worker process, bounded by the
+    total size in bytes of the stored values rather than by number of entries.
+
+    values are stored marshalled: every `get` returns a fresh copy (callers
+    such as `Association` modify the elasticsearch hits in place) and
+    `marshal.loads` is several times faster than `json.loads` on large
+    elasticsearch responses.
+    '''
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key):
+        try:
+            payload, expire_at = self._data.pop(key)
+        except KeyError:
+            return None
+        if expire_at <= time.time():
+            self.current_bytes -= len(payload)
+            return None
+        # reinsert to mark it as the most recently used
+        self._data[key] = (payload, expire_at)
+        return marshal.loads(payload)
+
+    def set(self, key, value, ttl):
+        self.delete(key)
+        if self.max_bytes <= 0 or ttl <= 0:
+            return False
+        try:
+            payload = marshal.dumps(value, 2)
+        except ValueError:
+            # not a plain json-like structure, keep it in the shared tier only
+            return False
+        if len(payload) > self.max_bytes:
+            return False
+        self._data[key] = (payload, time.time() + ttl)
+        self.current_bytes += len(payload)
+        while self.current_bytes > self.max_bytes:
+            _, (evicted, _) = self._data.popitem(last=False)
+            self.current_bytes -= len(evicted)
+            self.evictions += 1
+        return True
+
+    def delete(self, key):
+        try:
+            payload, _ = self._data.pop(key)
+            self.current_bytes -= len(payload)
+            return True
+        except KeyError:
+            return False
+
+    def clear(self):
+        self._data.clear()
+        self.current_bytes = 0
+
+    def info(self):
+        return dict(entries=len(self._data),
+                    bytes=self.current_bytes,
+                    max_bytes=self.max_bytes,
+                    evictions=self.evictions)
+
+
+def _snapshot(value):
+    try:
+        return True, marshal.dumps(value, 2)
+    except ValueError:
+        return False, copy.deepcopy(value)
+
+
+def _restore(snapshot):
+    is_marshalled, value = snapshot
+    if is_marshalled:
+        return marshal.loads(value)
+    return copy.deepcopy(value)
+
+
+class SingleFlightCancelled(Exception):
+    pass
+
+
+class _Flight(object):
+    def __init__(self):
+        self.result = AsyncResult()
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    '''
+    coalesces concurrent calls for the same key within a worker: the first
+    greenlet runs the function, the others wait for its result.
+
+    waiters get their own copy of the result, since the caller of the first
+    greenlet is free to modify it as soon as it is returned
+    '''
+
+    def __init__(self):
+        self._flights = {}
+        self.coalesced = 0
+
+    def __contains__(self, key):
+        return key in self._flights
+
+    def do(self, key, func, timeout=None):
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.coalesced += 1
+            flight.waiters += 1
+            return _restore(flight.result.get(timeout=timeout))
+
+        flight = self._flights[key] = _Flight()
+        try:
+            value = func()
+        except Exception as e:
+            flight.result.set_exception(e)
+            raise
+        except BaseException:
+            # killed or timed out, do not leave the waiters hanging
+            flight.result.set_exception(SingleFlightCancelled(key))
+            raise
+        else:
+            if flight.waiters:
+                flight.result.set(_snapshot(value))
+            return value
+        finally:
+            del self._flights[key]
+
+
+class SharedCache(BaseCache):
+    '''
+    werkzeug cache interface over an `InternalCache`, so that `app.cache` is
+    shared by the workers in redis, with the size bounded in-process tier in
+    front of it, instead of living in a directory of files per container
+    '''
+
+    def __init__(self, cache, default_timeout=300):
+        '''
+        :param cache: InternalCache, usually a namespace of the elasticsearch one
+        :param default_timeout: seconds, 0 is not supported by the redis tier
+            and means the default timeout too
+        '''
+        super(SharedCache, self).__init__(default_timeout)
+        self.cache = cache
+
+    def _normalize_timeout(self, timeout):
+        return timeout or self.default_timeout
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value, timeout=None):
+        return bool(self.cache.set(key, value, self._normalize_timeout(timeout)))
+
+    def add(self, key, value, timeout=None):
+        if self.has(key):
+            return False
+        return self.set(key, value, timeout)
+
+    def delete(self, key):
+        return bool(self.cache.delete(key))
+
+    def has(self, key):
+        return self.cache.get(key) is not None
+
+    def clear(self):
+        self.cache.bump_generation()
+        return True
+
+    def info(self):
+        return self.cache.info()
@@ -0,0 +1,184 @@
+import json
+import logging
+import marshal
+import time
+import zlib
+from collections import OrderedDict
+
+import ujson
+
+__author__ = 'andreap'
+
+
+class JSONCodec(object):
+    '''
+    plain json, the format used before the binary codecs. its payloads carry
+    no header so that entries written by older workers are still readable
+    '''
+    name = 'json'
+    header = ''
+
+    def dumps(self, obj):
+        return json.dumps(obj)
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class UJSONCodec(JSONCodec):
+    '''
+    json through ujson, several times faster than the stdlib module.
+    ujson writes floats with at most `MAX_DOUBLE_PRECISION` decimals, so
+    small values lose their significant digits and the ones below 1e-15 are
+    written as 0.0: only for data without such values, e.g. not enrichment
+    p-values. only plain json types should be given to it: it writes
+    objects it does not know as `{}` rather than failing. values it cannot
+    encode, like nan, go through the stdlib module
+    '''
+    name = 'ujson'
+    MAX_DOUBLE_PRECISION = 15
+
+    def __init__(self, double_precision=MAX_DOUBLE_PRECISION):
+        if not 0 <= double_precision <= self.MAX_DOUBLE_PRECISION:
+            raise ValueError('ujson keeps between 0 and %i decimals, %s requested' %
+                             (self.MAX_DOUBLE_PRECISION, double_precision))
+        self.double_precision = double_precision
+
+    def dumps(self, obj):
+        try:
+            return ujson.dumps(obj,
+                               ensure_ascii=True,
+                               double_precision=self.double_precision)
+        except (OverflowError, TypeError):
+            return super(UJSONCodec, self).dumps(obj)
+
+    def loads(self, data):
+        try:
+            return ujson.loads(data, precise_float=True)
+        except ValueError:
+            # ujson is stricter, e.g. on nan and infinity
+            return super(UJSONCodec, self).loads(data)
+
+
+def get_json_codec(name='json', double_precision=UJSONCodec.MAX_DOUBLE_PRECISION):
+    '''
+    :param name: `json` or `ujson`
+    :param double_precision: decimals kept by ujson
+    '''
+    if name == UJSONCodec.name:
+        return UJSONCodec(double_precision)
+    if name != JSONCodec.name:
+        logging.getLogger(__name__).warning('unknown json encoder %s, using json', name)
+    return JSONCodec()
+
+
+class MarshalCodec(object):
+    '''
+    compact binary serialisation for json-like structures. much faster than
+    json in both directions and smaller, but only meant for data written by
+    the api itself
+    '''
+    name = 'marshal'
+    header = '\x00M'
+
+    def dumps(self, obj):
+        return marshal.dumps(obj, 2)
+
+    def loads(self, data):
+        return marshal.loads(data)
+
+
+class CompressedMarshalCodec(MarshalCodec):
+    '''
+    marshal payload compressed with a fast zlib level, for big values
+    '''
+    name = 'marshal+zlib'
+    header = '\x00Z'
+
+    def __init__(self, level=1):
+        self.level = level
+
+    def dumps(self, obj):
+        return zlib.compress(super(CompressedMarshalCodec, self).dumps(obj), self.level)
+
+    def loads(self, data):
+        return super(CompressedMarshalCodec, self).loads(zlib.decompress(data))
+
+
+class CodecStats(object):
+    def __init__(self):
+        self.counters = OrderedDict()
+
+    def add(self, codec, operation, seconds, raw_bytes=0, stored_bytes=0):
+        counter = self.counters.setdefault(codec, dict(encoded=0,
+                                                        decoded=0,
+                                                        encode_seconds=0.,
+                                                        decode_seconds=0.,
+                                                        raw_bytes=0,
+                                                        stored_bytes=0))
+        counter[operation] += 1
+        counter[operation[:6] + '_seconds'] += seconds
+        counter['raw_bytes'] += raw_bytes
+        counter['stored_bytes'] += stored_bytes
+
+    def to_dict(self):
+        stats = OrderedDict()
+        for codec, counter in self.counters.items():
+            stats[codec] = dict(
+                encoded=counter['encoded'],
+                decoded=counter['decoded'],
+                avg_encode_ms=1000 * counter['encode_seconds'] / counter['encoded'] if counter['encoded'] else 0.,
+                avg_decode_ms=1000 * counter['decode_seconds'] / counter['decoded'] if counter['decoded'] else 0.,
+                compression_ratio=float(counter['raw_bytes']) / counter['stored_bytes'] if counter['stored_bytes'] else 1.,
+            )
+        return stats
+
+
+class CacheCodec(object):
+    '''
+    encodes the values stored in redis choosing the codec by value size:
+    marshal for small values, compressed marshal above `compress_min_bytes`.
+    values that cannot be marshalled fall back to json.
+
+    decoding dispatches on the payload header, and payloads without one are
+    json, so the format can change without flushing the cache
+    '''
+
+    def __init__(self, compress_min_bytes=16 * 1024, compress_level=1, json_codec=None):
+        '''
+        :param json_codec: codec of the values marshal cannot store and of
+            the legacy entries, the stdlib json one if None
+        '''
+        self.compress_min_bytes = compress_min_bytes
+        self.json = json_codec or JSONCodec()
+        self.marshal = MarshalCodec()
+        self.compressed = CompressedMarshalCodec(compress_level)
+        self._by_header = dict((c.header, c) for c in (self.marshal, self.compressed))
+        self.stats = CodecStats()
+
+    def dumps(self, obj):
+        start_time = time.time()
+        try:
+            raw = self.marshal.dumps(obj)
+        except ValueError:
+            data = self.json.dumps(obj)
+            self.stats.add(self.json.name, 'encoded', time.time() - start_time, len(data), len(data))
+            return data
+
+        codec = self.marshal
+        data = raw
+        if len(raw) >= self.compress_min_bytes:
+            codec = self.compressed
+            data = zlib.compress(raw, self.compressed.level)
+        self.stats.add(codec.name, 'encoded', time.time() - start_time, len(raw), len(data))
+        return codec.header + data
+
+    def loads(self, data):
+        start_time = time.time()
+        codec = self._by_header.get(data[:2], self.json)
+        obj = codec.loads(data[len(codec.header):])
+        self.stats.add(codec.name, 'decoded', time.time() - start_time)
+        return obj
+
+    def info(self):
+        return self.stats.to_dict()
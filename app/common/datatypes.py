@@ -33,6 +33,16 @@ class DataTypes():
                     self.datasources[datasource_name].datatypes.append(datatype_name)
 
 
+    def freeze(self):
+        '''
+        turns the lists of datasources and datatypes into tuples, the data
+        is read only once the workers are forked
+        '''
+        for datatype in self.datatypes.values():
+            datatype.datasources = tuple(datatype.datasources)
+        for datasource in self.datasources.values():
+            datasource.datatypes = tuple(datasource.datatypes)
+
     def get_datasources(self, datatype):
         try:
             return self.datatypes[datatype].datasources
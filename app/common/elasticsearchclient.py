@@ -1,33 +1,42 @@
 import ast
 import datetime
 import hashlib
-import json as json
 import logging
 import sys
 import time
+import uuid
 from collections import defaultdict
+from functools import partial
 
 import addict
+import gevent
 import jmespath
 import numpy as np
 from elasticsearch import TransportError
 from elasticsearch import helpers
-from flask import current_app, request
+from flask import current_app, has_app_context, has_request_context, request
 from flask_restful import abort
-from scipy.stats import hypergeom
 
+from app.common.cache import CacheStats, LocalLRUCache, KeyFoldCounter, SingleFlight, canonical_cache_key
+from app.common.codecs import CacheCodec
+from app.common.enrichment import AssociationMatrix, DiseaseGroups, enrichment_results
+from app.common.fanout import fan_out
+from app.common.hypergeometric import PValueCorrections
+from app.common.labels import LabelIndex
 from app.common.request_templates import FilterTypes
 from app.common.request_templates import SourceDataStructureOptions, AssociationSortOptions
 from app.common.response_templates import Association, DataStats, Relation, SearchMetadataObject, DataMetrics, \
     TherapeuticArea
 from app.common.results import PaginatedResult, SimpleResult, RawResult, EmptySimpleResult, \
-    EmptyPaginatedResult
+    EmptyPaginatedResult, Result
 from app.common.scoring import Scorer
 from app.common.scoring_conf import ScoringMethods
 from config import Config
 
 __author__ = 'andreap'
 
+logger = logging.getLogger(__name__)
+
 KEYWORD_MAPPING_FIELDS = ["name",
                           "id",
                           "approved_symbol",
@@ -86,7 +95,13 @@ def _copy_and_mutate_dict(d, del_k, **add_ks):
     return d
 
 
-def _inject_tissue_data(response, t2m):
+def _inject_tissue_data(response, tissue_map):
+    '''
+    adds the details of the tissues to the expression facets, or to the
+    tissues of an expression response
+
+    :param tissue_map: mapping of efo code: tissue, e.g. a TissueMap
+    '''
     def __clean_id(id):
         if not id[0].isdigit():
             return id
@@ -97,51 +112,32 @@ def _inject_tissue_data(response, t2m):
         else:
             return id
 
+    if tissue_map is None:
+        return response
+
     # find the data information assoc with this id
     if 'facets' in response:
-        if 'protein_expression_tissue' in response['facets']:
-            bl = response['facets']['protein_expression_tissue']['data']['buckets'] \
-                    if 'data' in response['facets']['protein_expression_tissue'] else \
-                        response['facets']['protein_expression_tissue']['buckets']
-            for i in xrange(len(bl)):
-                try:
-                    k = __clean_id(bl[i]['key'])
-                    bl[i]['data'] = t2m['codes'][k]
-                    bl[i]['key'] = k
-                except:
-                    pass
-
-        if 'rna_expression_tissue' in response['facets']:
-            bl = response['facets']['rna_expression_tissue']['data']['buckets'] \
-                    if 'data' in response['facets']['rna_expression_tissue'] else \
-                    response['facets']['rna_expression_tissue']['buckets']
-            for i in xrange(len(bl)):
-                try:
-                    k = __clean_id(bl[i]['key'])
-                    bl[i]['data'] = t2m['codes'][k]
-                    bl[i]['key'] = k
-                except:
-                    pass
-
-        if 'zscore_expression_tissue' in response['facets']:
-            bl = response['facets']['zscore_expression_tissue']['data']['buckets'] \
-                    if 'data' in response['facets']['zscore_expression_tissue'] else \
-                    response['facets']['zscore_expression_tissue']['buckets']
-            for i in xrange(len(bl)):
-                try:
-                    k = __clean_id(bl[i]['key'])
-                    bl[i]['data'] = t2m['codes'][k]
-                    bl[i]['key'] = k
-                except:
-                    pass
+        for facet in ('protein_expression_tissue', 'rna_expression_tissue', 'zscore_expression_tissue'):
+            if facet in response['facets']:
+                bl = response['facets'][facet]['data']['buckets'] \
+                        if 'data' in response['facets'][facet] else \
+                        response['facets'][facet]['buckets']
+                for bucket in bl:
+                    try:
+                        k = __clean_id(bucket['key'])
+                    except (IndexError, KeyError, TypeError):
+                        continue
+                    tissue = tissue_map.get(k)
+                    if tissue is not None:
+                        bucket['data'] = tissue
+                        bucket['key'] = k
 
     else:
         if 'tissues' in response:
-            for k, _ in response['tissues'].iteritems():
-                try:
-                    response['tissues'][k]['data'] = t2m['codes'][k]
-                except:
-                    pass
+            for k, v in response['tissues'].iteritems():
+                tissue = tissue_map.get(k)
+                if tissue is not None:
+                    v['data'] = tissue
 
     return response
 
@@ -167,40 +163,450 @@ class ESResultStatus(object):
 
 class InternalCache(object):
     NAMESPACE = 'CTTV_REST_API_CACHE'
+    MEMORY_TIER = 'memory'
+    REDIS_TIER = 'redis'
+    _ENTRY_MARKER = '__cache_entry__'
+    _UNLOCK_SCRIPT = '''
+        if redis.call('get', KEYS[1]) == ARGV[1] then
+            return redis.call('del', KEYS[1])
+        end
+        return 0'''
 
     def __init__(self, r_server,
                  app_version='',
-                 default_ttl=60):
+                 default_ttl=60,
+                 local_max_bytes=0,
+                 local=None,
+                 lock_ttl=60,
+                 lock_poll_interval=0.05,
+                 stale_ttl=0,
+                 compress_min_bytes=16 * 1024,
+                 data_version='',
+                 index_resolver=None,
+                 namespace_check_interval=1,
+                 index_check_interval=60,
+                 name='',
+                 json_codec=None):
+        '''
+        two tier cache: a size bounded in-process LRU in front of the redis
+        instance shared by all the uwsgi workers
+
+        :param r_server: redis connection
+        :param app_version: used to namespace the keys
+        :param default_ttl: ttl in seconds when none is given to `set`
+        :param local_max_bytes: size in bytes of the in-process tier, 0 to disable it
+        :param local: in-process tier shared with another cache, overrides `local_max_bytes`
+        :param lock_ttl: seconds other workers wait for the one computing a missing key
+        :param lock_poll_interval: seconds between checks while waiting for another worker
+        :param stale_ttl: default seconds `get_or_set` serves an expired value while refreshing it
+        :param compress_min_bytes: values bigger than this are stored compressed in redis
+        :param data_version: used to namespace the keys
+        :param index_resolver: callable returning the concrete elasticsearch
+            indices the data is served from, used to namespace the keys
+        :param namespace_check_interval: seconds between checks of the cache
+            generation shared by the workers
+        :param index_check_interval: seconds between resolutions of the
+            elasticsearch indices, after an alias is moved each worker
+            switches to the namespace of the new indices within this time
+        :param name: keeps the keys, stats and generation of caches sharing
+            the same redis apart
+        :param json_codec: codec of the values marshal cannot store, see `CacheCodec`
+        '''
         self.r_server = r_server
         self.app_version = app_version
         self.default_ttl = default_ttl
+        self.local = local if local is not None else LocalLRUCache(local_max_bytes)
+        self.stats = CacheStats(self.MEMORY_TIER, self.REDIS_TIER)
+        self.key_folds = KeyFoldCounter()
+        self.single_flight = SingleFlight()
+        self.lock_ttl = lock_ttl
+        self.lock_poll_interval = lock_poll_interval
+        self.lock_waits = 0
+        self.stale_ttl = stale_ttl
+        self.stale_served = 0
+        self.stale_refreshed = 0
+        self.codec = CacheCodec(compress_min_bytes, json_codec=json_codec)
+        self.data_version = data_version
+        self.index_resolver = index_resolver
+        self.index_fingerprint = None
+        self.generation = None
+        self.namespace_check_interval = namespace_check_interval
+        self.index_check_interval = index_check_interval
+        self._namespace = None
+        self._namespace_checked_at = 0
+        self._indices_checked_at = 0
+        self.name = name
+
+    def namespace(self, name):
+        '''
+        a cache sharing redis and the in-process tier, with its size budget,
+        with this one, but with its own keys, stats and generation
+        '''
+        return InternalCache(self.r_server,
+                             self.app_version,
+                             default_ttl=self.default_ttl,
+                             local=self.local,
+                             lock_ttl=self.lock_ttl,
+                             lock_poll_interval=self.lock_poll_interval,
+                             stale_ttl=self.stale_ttl,
+                             compress_min_bytes=self.codec.compress_min_bytes,
+                             data_version=self.data_version,
+                             index_resolver=self.index_resolver,
+                             namespace_check_interval=self.namespace_check_interval,
+                             name=name,
+                             json_codec=self.codec.json)
 
     def get(self, key):
-        value = self.r_server.get(self._get_namespaced_key(key))
-        if value:
-            return self._decode(value)
+        '''
+        returns the cached value, including one past its soft ttl
+        '''
+        value, _ = self._get_entry(key)
+        return value
 
-    def set(self, key, value, ttl=None):
+    def set(self, key, value, ttl=None, stale_ttl=0):
+        '''
+        :param ttl: soft ttl, the value is fresh until then
+        :param stale_ttl: seconds the value is kept after the soft ttl to be
+            served while it gets refreshed
+        '''
         _ttl = ttl if ttl else self.default_ttl
-        return self.r_server.setex(self._get_namespaced_key(key),
-                                   _ttl, self._encode(value))
+        if isinstance(_ttl, datetime.timedelta):
+            _ttl = int(_ttl.total_seconds())
+        hard_ttl = _ttl + (stale_ttl or 0)
+        entry = {self._ENTRY_MARKER: 1,
+                 'soft_expiry': time.time() + _ttl,
+                 'value': value}
+        namespaced_key = self._get_namespaced_key(key)
+        self.local.set(namespaced_key, entry, hard_ttl)
+        return self.r_server.setex(namespaced_key,
+                                   hard_ttl, self._encode(entry))
+
+    def delete(self, key):
+        namespaced_key = self._get_namespaced_key(key)
+        self.local.delete(namespaced_key)
+        return self.r_server.delete(namespaced_key)
+
+    def get_or_set(self, key, func, stale_ttl=None):
+        '''
+        returns the cached value for `key`, or computes it with `func` and
+        caches it. only one greenlet in the worker, and one worker across
+        uwsgi, computes a missing key at a time; the others wait for it.
+        a value past its soft ttl is returned straight away and refreshed by
+        a background greenlet.
+
+        :param func: callable returning a (value, ttl) tuple
+        :param stale_ttl: seconds a value is served after its ttl, defaults to
+            the one of the cache
+        '''
+        if stale_ttl is None:
+            stale_ttl = self.stale_ttl
+        value, soft_expiry = self._get_entry(key)
+        if value is None:
+            return self.single_flight.do(key, lambda: self._compute_locked(key, func, stale_ttl))
+        if soft_expiry is not None and soft_expiry < time.time():
+            self.stale_served += 1
+            self._revalidate(key, func, stale_ttl)
+        return value
+
+    def get_many_or_set(self, keys, func, stale_ttl=None):
+        '''
+        like `get_or_set` for several keys, computing all the missing ones
+        with a single call to `func`, and refreshing all the stale ones with
+        another in background. missing keys are not coalesced across
+        greenlets or workers.
+
+        :param func: callable taking the list of missing keys and returning
+            a list of (value, ttl) tuples in the same order
+        :return: list of values in the order of `keys`
+        '''
+        if stale_ttl is None:
+            stale_ttl = self.stale_ttl
+        values = []
+        missing = []
+        stale = []
+        for key in keys:
+            value, soft_expiry = self._get_entry(key)
+            if value is None:
+                if key not in missing:
+                    missing.append(key)
+            elif soft_expiry is not None and soft_expiry < time.time():
+                self.stale_served += 1
+                if key not in stale:
+                    stale.append(key)
+            values.append(value)
+        if stale:
+            self._revalidate_many(stale, func, stale_ttl)
+        if missing:
+            computed = {}
+            for key, (value, ttl) in zip(missing, func(missing)):
+                self.set(key, value, ttl, stale_ttl)
+                computed[key] = value
+            values = [computed[key] if value is None else value for key, value in zip(keys, values)]
+        return values
+
+    def _get_entry(self, key):
+        namespaced_key = self._get_namespaced_key(key)
+        entry = self.local.get(namespaced_key)
+        if entry is not None:
+            self.stats.hit(self.MEMORY_TIER)
+            return self._unwrap(entry)
+        self.stats.miss(self.MEMORY_TIER)
+
+        pipe = self.r_server.pipeline(transaction=False)
+        pipe.get(namespaced_key)
+        pipe.ttl(namespaced_key)
+        entry, ttl = pipe.execute()
+        if entry:
+            self.stats.hit(self.REDIS_TIER)
+            entry = self._decode(entry)
+            if ttl > 0:
+                self.local.set(namespaced_key, entry, ttl)
+            return self._unwrap(entry)
+        self.stats.miss(self.REDIS_TIER)
+        return None, None
+
+    def _unwrap(self, entry):
+        if isinstance(entry, dict) and self._ENTRY_MARKER in entry:
+            return entry['value'], entry['soft_expiry']
+        # stored before entries had a soft ttl
+        return entry, None
+
+    def _compute_locked(self, key, func, stale_ttl):
+        token = self.lock(key)
+        if token is None:
+            # another worker is computing it, wait for it to show up in redis
+            self.lock_waits += 1
+            deadline = time.time() + self.lock_ttl
+            while time.time() < deadline:
+                gevent.sleep(self.lock_poll_interval)
+                value = self.get(key)
+                if value is not None:
+                    return value
+                if not self.r_server.exists(self._get_lock_key(key)):
+                    break
+            # the other worker failed or is too slow, compute it here
+        try:
+            value, ttl = func()
+            self.set(key, value, ttl, stale_ttl)
+            return value
+        finally:
+            if token is not None:
+                self.unlock(key, token)
+
+    def _revalidate(self, key, func, stale_ttl):
+        if key in self.single_flight:
+            return
+        token = self.lock(key)
+        if token is None:
+            # already being refreshed by another worker
+            return
+
+        def refresh():
+            try:
+                value, ttl = func()
+                self.set(key, value, ttl, stale_ttl)
+                self.stale_refreshed += 1
+                return value
+            finally:
+                self.unlock(key, token)
+
+        self._spawn_refresh(lambda: self.single_flight.do(key, refresh))
+
+    def _revalidate_many(self, keys, func, stale_ttl):
+        '''
+        refreshes the stale `keys` no other greenlet or worker is refreshing
+        with a single call to `func`, in background
+        '''
+        tokens = {}
+        for key in keys:
+            if key in self.single_flight:
+                continue
+            token = self.lock(key)
+            if token is not None:
+                tokens[key] = token
+        if not tokens:
+            return
+        locked = [key for key in keys if key in tokens]
+
+        def refresh():
+            try:
+                for key, (value, ttl) in zip(locked, func(locked)):
+                    self.set(key, value, ttl, stale_ttl)
+                    self.stale_refreshed += 1
+            finally:
+                for key in locked:
+                    self.unlock(key, tokens[key])
+
+        self._spawn_refresh(refresh)
+
+    @staticmethod
+    def _spawn_refresh(refresh):
+        '''
+        runs `refresh` in a background greenlet, in the app context of the
+        request that found the stale value, so that the functions computing
+        the values can read `current_app` and `g`
+        '''
+        app = current_app._get_current_object() if has_app_context() else None
+
+        def run():
+            try:
+                if app is None:
+                    refresh()
+                else:
+                    with app.app_context():
+                        refresh()
+            except Exception:
+                logger.exception('cannot refresh stale cache entry')
+
+        gevent.spawn(run)
+
+    def lock(self, key, ttl=None):
+        '''
+        takes a short lock on `key` shared by all the workers
+
+        :return: the token to release the lock, None if it is held by someone else
+        '''
+        token = uuid.uuid4().hex
+        if self.r_server.set(self._get_lock_key(key), token, nx=True, ex=ttl or self.lock_ttl):
+            return token
+
+    def unlock(self, key, token):
+        return self.r_server.eval(self._UNLOCK_SCRIPT, 1, self._get_lock_key(key), token)
+
+    def bump_generation(self):
+        '''
+        invalidates the cache for all the workers without flushing redis, the
+        entries of the previous generation are left to expire.
+        every worker picks the new generation up within
+        `namespace_check_interval` seconds, and resolves the elasticsearch
+        indices again
+
+        :return: the new generation
+        '''
+        generation = self.r_server.incr(self._get_generation_key())
+        self._namespace_checked_at = 0
+        return generation
+
+    def info(self):
+        self._get_namespace()
+        return dict(namespace=dict(name=self.name,
+                                   data_version=self.data_version,
+                                   indices=self.index_fingerprint,
+                                   generation=self.generation),
+                    tiers=self.stats.to_dict(),
+                    memory=self.local.info(),
+                    keys=self.key_folds.to_dict(),
+                    coalesced=dict(greenlets=self.single_flight.coalesced,
+                                   workers=self.lock_waits),
+                    stale=dict(served=self.stale_served,
+                               refreshed=self.stale_refreshed),
+                    codecs=self.codec.info())
+
+    def _get_lock_key(self, key):
+        return self._get_namespaced_key(key) + ':lock'
+
+    def _get_generation_key(self):
+        return ':'.join(filter(None, [self.NAMESPACE, 'generation', self.name]))
+
+    def _get_namespace(self):
+        now = time.time()
+        if now - self._namespace_checked_at < self.namespace_check_interval:
+            return self._namespace
+        self._namespace_checked_at = now
+        generation = int(self.r_server.get(self._get_generation_key()) or 0)
+        index_fingerprint = self.index_fingerprint
+        if generation != self.generation or index_fingerprint is None or \
+                now - self._indices_checked_at >= self.index_check_interval:
+            self._indices_checked_at = now
+            index_fingerprint = self._resolve_index_fingerprint()
+            if index_fingerprint is None and generation == self.generation:
+                # keep the indices last resolved, retried at the next check
+                index_fingerprint = self.index_fingerprint
+        if self._namespace is None or generation != self.generation or \
+                index_fingerprint != self.index_fingerprint:
+            if self._namespace is not None:
+                # entries of the previous namespace can not be reached anymore
+                self.local.clear()
+            self.generation = generation
+            self.index_fingerprint = index_fingerprint
+            self._namespace = ':'.join(filter(None, [self.NAMESPACE, self.name]) +
+                                       [self.app_version,
+                                        self.data_version,
+                                        self.index_fingerprint or '',
+                                        str(self.generation)])
+        return self._namespace
+
+    def get_data_version(self):
+        '''
+        identifies the data served: changes with the data release and with
+        the indices behind the elasticsearch aliases, not with the generation
+        '''
+        self._get_namespace()
+        return ':'.join([self.data_version, self.index_fingerprint or ''])
+
+    def _resolve_index_fingerprint(self):
+        if self.index_resolver is None:
+            return ''
+        try:
+            indices = self.index_resolver()
+        except Exception:
+            # retried at the next check
+            logger.exception('cannot resolve the elasticsearch indices for the cache namespace')
+            return None
+        return hashlib.md5(','.join(sorted(indices))).hexdigest()[:12]
 
     def _get_namespaced_key(self, key):
         # try cityhash for better performance (fast and non cryptographic hash library) from cityhash import CityHash64
         # hashed_key = hashlib.md5(key).digest().encode('base64')[:8]
         hashed_key = hashlib.md5(key).hexdigest()
-        return ':'.join([self.NAMESPACE, self.app_version, hashed_key])
+        return ':'.join([self._get_namespace(), hashed_key])
 
     def _encode(self, obj):
-        # return base64.encodestring(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
-        return json.dumps(obj)
+        return self.codec.dumps(obj)
 
     def _decode(self, obj):
-        # return pickle.loads(base64.decodestring(obj))
-        return json.loads(obj)
+        return self.codec.loads(obj)
+
+
+class PlannedSearch(object):
+    def __init__(self, index, body):
+        self.index = index
+        self.body = body
+        self.result = None
+
+
+class QueryPlan(object):
+    '''
+    collects searches that do not depend on each other and runs them with a
+    single msearch round trip. every search keeps the cache entry it would
+    have with `esQuery._cached_search(index=..., body=...)`, and only the ones
+    missing from the cache are sent to elasticsearch
+    '''
+
+    def __init__(self, es_query):
+        self.es_query = es_query
+        self.searches = []
+
+    def search(self, index, body):
+        '''
+        :return: PlannedSearch, its `result` is available after `execute`
+        '''
+        search = PlannedSearch(index, body)
+        self.searches.append(search)
+        return search
+
+    def execute(self):
+        if self.searches:
+            results = self.es_query._cached_msearch([dict(index=s.index, body=s.body) for s in self.searches])
+            for search, result in zip(self.searches, results):
+                search.result = result
+        self.searches = []
 
 
 class esQuery():
+    REACTOME_LABELS = 'reactome'
+    THERAPEUTIC_AREA_LABELS = 'therapeutic_area'
+
     def __init__(self,
                  handler,
                  datatypes,
@@ -226,6 +632,9 @@ class esQuery():
                  docname_search=None,
                  docname_relation=None,
                  cache=None,
+                 label_index_path='',
+                 tissue_map=None,
+                 association_matrix=None,
                  log_level=logging.DEBUG):
         '''
 
@@ -235,6 +644,11 @@ class esQuery():
         :param index_efo:
         :param index_eco:
         :param index_genename:
+        :param label_index_path: directory of the memory mapped label files
+            shared by the workers, see LabelIndex
+        :param tissue_map: TissueMap adding the tissue details to the expression data
+        :param association_matrix: Lazy AssociationMatrix of the data version, the enrichments
+            scroll the association index without it
         :param log_level:
         :return:
         '''
@@ -255,6 +669,31 @@ class esQuery():
         self.datatource_scoring = datatource_scoring
         self.scorer = Scorer(datatource_scoring)
         self.cache = cache
+        self.labels = LabelIndex(cache.get_data_version if cache is not None else lambda: '',
+                                 path=label_index_path)
+        self.labels.add(self.REACTOME_LABELS, self._load_reactome_labels)
+        self.labels.add(self.THERAPEUTIC_AREA_LABELS, self._load_therapeutic_area_labels)
+        self.tissue_map = tissue_map
+        self.association_matrix = association_matrix
+
+    def get_concrete_indices(self):
+        '''
+        names of the indices currently behind the configured index names,
+        wildcards and aliases
+        '''
+        indices = [self._index_data,
+                   self._index_drug,
+                   self._index_efo,
+                   self._index_eco,
+                   self._index_genename,
+                   self._index_expression,
+                   self._index_reactome,
+                   self._index_association,
+                   self._index_search,
+                   self._index_relation]
+        res = self.handler.indices.get_alias(index=','.join(i for i in indices if i),
+                                             ignore_unavailable=True)
+        return sorted(res.keys())
 
     def free_text_search(self, searchphrase, doc_filter, **kwargs):
         '''
@@ -305,15 +744,22 @@ class esQuery():
                                    pvalue_threshold=1e-3,
                                    from_=0,
                                    size=10,
-                                   sort='enrichment.score'):
+                                   sort='enrichment.score',
+                                   correction=PValueCorrections.NONE,
+                                   progress=None):
 
         '''
         N is the population size - all_targets
         K is the number of success states in the population,
         n is the number of draws, - targets_in_set
         k is the number of observed successes, - all_targets_in_disease
+
+        the score of a disease is the probability of the targets in set in
+        disease or more, corrected with `correction` for all the diseases
         Args:
             query: list of targets
+            progress: optional callable taking the fraction of the work done
+                and a message, called by background jobs
 
         Returns:
 
@@ -323,10 +769,13 @@ class esQuery():
                               pvalue=pvalue_threshold,
                               from_=from_,
                               size=size,
-                              sort=sort)
+                              sort=sort,
+                              correction=correction)
 
         entry_time = time.time()
-        query_cache_key = hashlib.md5(''.join(sorted(list(set(targets))))).hexdigest()
+        query_cache_key = canonical_cache_key('enrichment',
+                                              hashlib.md5(''.join(sorted(list(set(targets))))).hexdigest(),
+                                              correction)
         data = None
         M = len(targets)
         if M < 2  :
@@ -334,61 +783,115 @@ class esQuery():
         if data is None:
             data = self.cache.get(query_cache_key)
         if data is None:
-            # We get the 3 numbers
-            # The total number of targets with associations
-            start_time = time.time()
-            q = addict.Dict()
-            q.query.bool.filter.range['association_counts.total'].gte = 1
-            # By default ES7 returns by default just the first 10000 entries.
-            q.track_total_hits= True
-            all_targets = self._cached_search(index=self._index_search,
-                                              body=q.to_dict(),
-
-                                              size=0)
-            N = all_targets["hits"]["total"]['value']
-            # print 'all targets query', time.time() - start_time
-
-
-            '''get all data'''
-            start_time = time.time()
-            # cache_file='/tmp/'+query_cache_key
-            # if os.path.exists('/tmp/'+query_cache_key):
-            #     disease_data = pickle.load(open(cache_file))
-            # else:
-            disease_data = {}
-            all_data = helpers.scan(client=self.handler,
-                                      query={
-                                          "query": self.get_complex_target_filter(targets),
-                                          'size': 1000,
-                                          "_source": ["target.*",
-                                                      "harmonic-sum.datatypes",
-                                                      "harmonic-sum.overall",
-                                                      "disease.id",
-                                                      "disease.efo_info.label",
-                                                      "disease.efo_info.therapeutic_area",
-                                                      ]
-                                      },
-                                      scroll='1h',
-                                      index=self._index_association,
-                                      # doc_type="search-object-disease",
-                                      timeout='10m'
-                                      )
-            for a in all_data:
-                disease_id = jmespath.search('_source.disease.id', a)
-                if disease_id not in disease_data:
-                    disease_data[disease_id] = []
-                disease_data[disease_id].append(a)
-            # pickle.dump(disease_data, open(cache_file, 'w'), protocol=pickle.HIGHEST_PROTOCOL)
-            # print 'get all data', time.time() - start_time
-
-            start_time = time.time()
-            background = self.handler.mget(body=dict(ids=disease_data.keys()),
+            matrix = self.association_matrix.get() if self.association_matrix is not None else None
+            if matrix is not None:
+                N = matrix.all_targets
+                groups, background_counts = matrix.enrichment_input(targets)
+            else:
+                # the total number of targets with associations
+                N = self._count_targets_with_associations()
+                # all the associations of the targets, grouped by integer coded disease
+                groups = DiseaseGroups()
+                for sources in self._get_target_associations(targets):
+                    for source in sources:
+                        groups.add(source['disease']['id'], source)
+                background_counts = self._get_cached_disease_background(groups.ids)
+            if progress is not None:
+                progress(.5, 'associations of %i diseases fetched' % len(groups))
+            data = enrichment_results(groups, background_counts, N, M, correction)
+            self.cache.set(query_cache_key, data, ttl=current_app.config['APP_CACHE_EXPIRY_TIMEOUT'])
+            if progress is not None:
+                progress(.9, '%i diseases tested' % len(data))
+        if pvalue_threshold < 1:
+            data = [d for d in data if d['enrichment']['score'] <= pvalue_threshold]
+        data = sorted(data, key=jmespath.compile(params.sort).search)
+        total_time = time.time() - entry_time
+        # print 'total time: %f | Targets = %i | Time per target %f'%(total_time, len(targets), total_time/len(targets))
+        return PaginatedResult(None,
+                               data=data[from_:from_ + size],
+                               total=len(data),
+                               took=int(total_time * 1000),
+                               params=params,
+
+                               )
+
+    def _count_targets_with_associations(self):
+        q = addict.Dict()
+        q.query.bool.filter.range['association_counts.total'].gte = 1
+        # By default ES7 returns by default just the first 10000 entries.
+        q.track_total_hits = True
+        all_targets = self._cached_search(index=self._index_search,
+                                          body=q.to_dict(),
+                                          size=0)
+        return all_targets["hits"]["total"]['value']
+
+    def _scan_enrichment_associations(self, query):
+        return helpers.scan(client=self.handler,
+                            query={
+                                "query": query,
+                                'size': 1000,
+                                "_source": ["target.*",
+                                            "harmonic-sum.datatypes",
+                                            "harmonic-sum.overall",
+                                            "disease.id",
+                                            "disease.efo_info.label",
+                                            "disease.efo_info.therapeutic_area",
+                                            ]
+                            },
+                            scroll='1h',
+                            index=self._index_association,
+                            timeout='10m'
+                            )
+
+    def _get_target_associations(self, targets):
+        '''
+        associations of each of `targets`, cached per target: a set of
+        targets overlapping one already seen only scrolls the associations
+        of the targets that were not in it
+
+        :return: list of the association sources of each target
+        '''
+        targets = sorted(set(targets))
+        key_targets = dict((canonical_cache_key('enrichment-target', target), target) for target in targets)
+        # read here: stale fragments are scanned again by a background greenlet
+        ttl = current_app.config['APP_CACHE_EXPIRY_TIMEOUT']
+
+        def scan(missing_keys):
+            missing = [key_targets[key] for key in missing_keys]
+            sources = dict((target, []) for target in missing)
+            for hit in self._scan_enrichment_associations(self.get_complex_target_filter(missing)):
+                sources.setdefault(hit['_source']['target']['id'], []).append(hit['_source'])
+            return [(sources[target], ttl) for target in missing]
+
+        return self.cache.get_many_or_set([canonical_cache_key('enrichment-target', target) for target in targets],
+                                          scan)
+
+    def _get_cached_disease_background(self, disease_ids):
+        '''
+        `_get_disease_background`, cached per disease
+        '''
+        key_diseases = dict((canonical_cache_key('enrichment-disease', disease_id), disease_id)
+                            for disease_id in disease_ids)
+        ttl = current_app.config['APP_CACHE_EXPIRY_TIMEOUT']
+
+        def mget(missing_keys):
+            background = self._get_disease_background([key_diseases[key] for key in missing_keys])
+            return [(background[key_diseases[key]], ttl) for key in missing_keys]
+
+        keys = [canonical_cache_key('enrichment-disease', disease_id) for disease_id in disease_ids]
+        return dict(zip(disease_ids, self.cache.get_many_or_set(keys, mget)))
+
+    def _get_disease_background(self, disease_ids, chunk_size=1000):
+        '''
+        :return: dict of disease id: dict with the label and the association counts of the disease
+        '''
+        background_counts = dict()
+        for i in range(0, len(disease_ids), chunk_size):
+            background = self.handler.mget(body=dict(ids=disease_ids[i:i + chunk_size]),
                                            index=self._index_search,
                                            _source=['association_counts', 'name'],
                                            realtime=False,
-                                          )
-
-            background_counts = dict()
+                                           )
             for doc in background['docs']:
                 if doc['found']:
                     background_counts[doc['_id']] = {
@@ -398,71 +901,20 @@ class esQuery():
                     }
                 else:
                     raise KeyError('document with id %s not found' % (doc['_id']))
+        return background_counts
 
-            # print 'background query', time.time() - start_time
-
-
-
-            start_time = time.time()
-            score_cache = {}
-            data = []
-            for disease_id, disease_targets in disease_data.items():
-                bg = background_counts[disease_id]
-                k = bg["association_counts"]["total"]
-                x = len(disease_targets)
-
-                key = '_'.join(map(str, [N, M, k, x]))
-                pvalue = score_cache.get(key)
-                if pvalue is None:
-                    # pvalue = HypergeometricTest.run(N, M, k, x)
-                    pvalue = hypergeom.pmf(x, N, k, M)
-                    # print key, hypergeom.pmf(x,N, k, M), HypergeometricTest.run(N, M, k, x)
-                    score_cache[key] = pvalue
-
-                disease_properties = disease_targets[0]['_source']['disease']['efo_info']
-                target_data = []
-                for d in disease_targets:
-                    source = d['_source']
-                    source['association_score'] = source.pop('harmonic-sum')
-                    del source['disease']
-                    target_data.append(source)
-                target_data = sorted(target_data, key=lambda k: k['association_score']['overall'], reverse=True)
-                for t in target_data:
-                    t['association_score']['overall'] = Association.cap_score(t['association_score']['overall'])
-
-                data.append({
-                    "enriched_entity": {
-                        "type": "disease",
-                        "id": disease_id,
-                        "label": bg["label"],
-                        "properties": disease_properties
-                    },
-                    "enrichment":{
-                        "method": "hypergeometric",
-                        "params": {
-                            "all_targets": N,
-                            "all_targets_in_disease": k,
-                            "targets_in_set": M,
-                            "targets_in_set_in_disease": x
-                        },
-                        "score": pvalue
-                    },
-                    "targets": target_data
-                })
-            self.cache.set(query_cache_key, data, ttl=current_app.config['APP_CACHE_EXPIRY_TIMEOUT'])
-            # print 'enrichment calculation', time.time() - start_time
-        if pvalue_threshold < 1:
-            data = [d for d in data if d['enrichment']['score'] <= pvalue_threshold]
-        data = sorted(data, key=lambda k: jmespath.search(params.sort, k))
-        total_time = time.time() - entry_time
-        # print 'total time: %f | Targets = %i | Time per target %f'%(total_time, len(targets), total_time/len(targets))
-        return PaginatedResult(None,
-                               data=data[from_:from_ + size],
-                               total=len(data),
-                               took=int(total_time * 1000),
-                               params=params,
+    def export_association_matrix(self, directory):
+        '''
+        builds the AssociationMatrix of all the associations in `directory`
 
-                               )
+        :return: the matrix built
+        '''
+        AssociationMatrix.write(directory,
+                                self._scan_enrichment_associations({"match_all": {}}),
+                                self._get_disease_background,
+                                self._count_targets_with_associations(),
+                                sorted(self.datatypes.datatypes.keys()))
+        return AssociationMatrix(directory)
 
     def best_hit_search(self, searchphrases, doc_filter, **kwargs):
         '''
@@ -662,6 +1114,13 @@ class esQuery():
 
             return PaginatedResult(res, params)
 
+    def get_gene_info_json(self, gene_id):
+        '''
+        json encoding of the document of a target, None if it does not exist
+        '''
+        return self._cached_json(['gene_info', gene_id],
+                                 lambda: self._get_first_document(self.get_gene_info([gene_id])))
+
     def _process_go_info(self, bucket_list):
         go_term_buckets = list()
         for bucket in bucket_list:
@@ -683,6 +1142,28 @@ class esQuery():
         if not isinstance(efo_codes, list):
             efo_codes = [efo_codes]
 
+        if efo_codes:
+            res = self._cached_search(index=self._index_efo,
+                                      body=self._get_efo_info_query(efo_codes, params)
+                                      )
+            return PaginatedResult(res, params)
+
+    def get_efo_info_json(self, efo_code):
+        '''
+        json encoding of the document of a disease, None if it does not exist
+        '''
+        return self._cached_json(['efo_info', efo_code],
+                                 lambda: self._get_first_document(self.get_efo_info_from_code(efo_code)))
+
+    @staticmethod
+    def _get_first_document(res):
+        if res:
+            data = res.toDict()['data']
+            if data:
+                return data[0]
+
+    @staticmethod
+    def _get_efo_info_query(efo_codes, params):
         query_body = addict.Dict()
         query_body.query.ids["values"] = efo_codes
         query_body.size = params.size
@@ -693,12 +1174,7 @@ class esQuery():
 
         if params.fields:
             query_body._source = params.fields
-
-        if efo_codes:
-            res = self._cached_search(index=self._index_efo,
-                                      body=query_body.to_dict()
-                                      )
-            return PaginatedResult(res, params)
+        return query_body.to_dict()
 
 
 
@@ -766,6 +1242,54 @@ class esQuery():
                      evidence_type_operator='OR',
                      **kwargs):
         params = SearchParams(**kwargs)
+        q = self._get_evidence_query(params, targets, diseases, evidence_types, datasources, datatypes,
+                                     gene_operator, object_operator, evidence_type_operator)
+
+        res = self._cached_search(index=self._index_data,
+                                  body=q,
+                                  timeout="10m",
+                                  )
+
+        evidence = [SearchMetadataObject(h).data
+                        for h in res['hits']['hits']]
+        if res['hits']['hits'] and len(res['hits']['hits']) == params.size:
+            params.next_ = res['hits']['hits'][-1]['sort']
+
+        return PaginatedResult(res, params, data=evidence)
+
+    def iter_evidence(self,
+                      targets=[],
+                      diseases=[],
+                      evidence_types=[],
+                      datasources=[],
+                      datatypes=[],
+                      page_size=1000,
+                      **kwargs):
+        '''
+        walks all the evidence matching the filters of `get_evidence` with
+        search_after, keeping one page in memory at a time. `size` and
+        `from` are ignored.
+
+        :param page_size: number of evidence fetched from elasticsearch at a time
+        :return: generator of evidence dicts
+        '''
+        kwargs.pop('size', None)
+        kwargs.pop('from', None)
+        params = SearchParams(**kwargs)
+        q = self._get_evidence_query(params, targets, diseases, evidence_types, datasources, datatypes)
+        return (SearchMetadataObject(h).data
+                for h in self._iter_hits(self._index_data, q, page_size))
+
+    def _get_evidence_query(self,
+                            params,
+                            targets,
+                            diseases,
+                            evidence_types,
+                            datasources,
+                            datatypes,
+                            gene_operator='OR',
+                            object_operator='OR',
+                            evidence_type_operator='OR'):
         if params.datastructure == SourceDataStructureOptions.DEFAULT:
             params.datastructure = SourceDataStructureOptions.FULL
         '''convert boolean to elasticsearch syntax'''
@@ -851,18 +1375,7 @@ class esQuery():
         if params.pagination_index:
             q.search_after = params.pagination_index
         q.sort.append({"id.keyword": "desc"})
-
-        res = self._cached_search(index=self._index_data,
-                                  body=q.to_dict(),
-                                  timeout="10m",
-                                  )
-
-        evidence = [SearchMetadataObject(h).data
-                        for h in res['hits']['hits']]
-        if res['hits']['hits'] and len(res['hits']['hits']) == params.size:
-            params.next_ = res['hits']['hits'][-1]['sort']
-
-        return PaginatedResult(res, params, data=evidence)
+        return q.to_dict()
 
     def get_evidence_known_drug(self, 
                      targets=None,
@@ -1139,21 +1652,19 @@ class esQuery():
                                params,
                                data)
 
-    def get_associations(self,
-                         **kwargs):
-        """
-        Get the associationscores for the provided target and diseases.
-        steps in the process:
-
-
-        """
-        params = SearchParams(**kwargs)
+    def _get_association_query(self, params, aggregations=True):
+        '''
+        builds the search for the associations matching `params`
 
+        :param aggregations: False to skip the facets, the filters are then
+            part of the query rather than a post filter
+        :return: the body of the search and its `_source`
+        '''
         '''create multiple condition boolean query'''
 
         agg_builder = AggregationBuilder(self)
         agg_builder.load_params(params)
-        aggs = agg_builder.aggs
+        aggs = agg_builder.aggs if aggregations else None
         filter_data_conditions = agg_builder.filters
 
         '''boolean query joining multiple conditions with an AND'''
@@ -1190,12 +1701,19 @@ class esQuery():
         if aggs:
             ass_query_body['aggs'] = aggs
         # filter out the results as requested, this will not be applied to the aggregation
-        if filter_data_conditions:
+        if filter_data_conditions and aggregations:
             ass_query_body['post_filter'] = {
                 "bool": {
                     "must": [i for i in filter_data_conditions.values() if i]
                 }
             }
+        elif filter_data_conditions:
+            ass_query_body['query'] = {
+                "bool": {
+                    "must": query_body,
+                    "filter": [i for i in filter_data_conditions.values() if i]
+                }
+            }
 
         # print "------------"
         # print ""	
@@ -1204,6 +1722,19 @@ class esQuery():
         # print ""	
         # print "------------"
 
+        return ass_query_body, source
+
+    def get_associations(self,
+                         **kwargs):
+        """
+        Get the associationscores for the provided target and diseases.
+        steps in the process:
+
+
+        """
+        params = SearchParams(**kwargs)
+        ass_query_body, source = self._get_association_query(params)
+
         ass_data = self._cached_search(index=self._index_association,
                                        body=ass_query_body,
                                        timeout="20m",
@@ -1231,12 +1762,14 @@ class esQuery():
         if ass_data['hits']['hits'] and len(ass_data['hits']['hits']) == params.size:
             params.next_ = ass_data['hits']['hits'][-1]['sort']
 
-        '''build data structure to return'''
-        data = self._return_association_flat_data_structures(scores, aggregation_results)
-
-        # inject tissue information: anatomical part and organs
-        data = _inject_tissue_data(data, Config.ES_TISSUE_MAP)
+        '''the facet labels and the therapeutic area associations only depend
+        on the main query, fetch them all with a single msearch'''
+        plan = QueryPlan(self)
+        facets = self._get_association_facets(aggregation_results)
+        if facets:
+            label_searches = self._plan_facet_labels(facets, plan)
 
+        ta_search = None
         if params.target:
             try:
                 therapeutic_areas = set()
@@ -1244,35 +1777,45 @@ class esQuery():
                     for ta_code in s['disease']['efo_info']['therapeutic_area']['codes']:
                         therapeutic_areas.add(s['target']['id'] + '-' + ta_code)
                 therapeutic_areas = list(therapeutic_areas)
-                ta_data = self._cached_search(index=self._index_association,
-                                              body={"query": {
-                                                        "ids": {"values": therapeutic_areas},
-                                                    },
-                                                    "size": 1000,
-                                                    '_source': source,
-                                                    },
-                                                )
-                ta_associations = (Association(h,
-                                               params.association_score_method,
-                                               self.datatypes,
-                                               cap_scores=params.cap_scores
-                                               )
-                                   for h in ta_data['hits']['hits'] if h['_source']['disease']['id'] != 'cttv_root')
-                ta_scores = [a.data for a in ta_associations]
-                # ta_scores.extend(scores)
-
-
-                return PaginatedResult(ass_data,
-                                       params,
-                                       data['data'],
-                                       facets=data['facets'],
-                                       available_datatypes=self.datatypes.available_datatypes,
-                                       therapeutic_areas=ta_scores,
-                                       )
-
+                ta_search = plan.search(self._index_association,
+                                        {"query": {
+                                            "ids": {"values": therapeutic_areas},
+                                         },
+                                         "size": 1000,
+                                         '_source': source,
+                                         })
             except KeyError:
                 current_app.logger.debug('fields containing therapeutic area information not available')
 
+        plan.execute()
+
+        '''build data structure to return'''
+        if facets:
+            facets = self._label_facets(facets, *label_searches)
+        data = dict(data=scores,
+                    facets=facets)
+
+        # inject tissue information: anatomical part and organs
+        data = _inject_tissue_data(data, self.tissue_map)
+
+        if ta_search is not None:
+            ta_associations = (Association(h,
+                                           params.association_score_method,
+                                           self.datatypes,
+                                           cap_scores=params.cap_scores
+                                           )
+                               for h in ta_search.result['hits']['hits'] if h['_source']['disease']['id'] != 'cttv_root')
+            ta_scores = [a.data for a in ta_associations]
+            # ta_scores.extend(scores)
+
+            return PaginatedResult(ass_data,
+                                   params,
+                                   data['data'],
+                                   facets=data['facets'],
+                                   available_datatypes=self.datatypes.available_datatypes,
+                                   therapeutic_areas=ta_scores,
+                                   )
+
         return PaginatedResult(ass_data,
                                params,
                                data['data'],
@@ -1280,6 +1823,49 @@ class esQuery():
                                available_datatypes=self.datatypes.available_datatypes,
                                )
 
+    def iter_associations(self, page_size=1000, **kwargs):
+        """
+        walks all the associations matching the filters of `get_associations`
+        with search_after, keeping one page in memory at a time. no facets or
+        therapeutic areas are computed, and `size` and `from` are ignored.
+
+        the query is built straight away, so invalid parameters abort the
+        request before the response starts
+
+        :param page_size: number of associations fetched from elasticsearch at a time
+        :return: generator of association dicts
+        """
+        kwargs.pop('size', None)
+        kwargs.pop('from', None)
+        params = SearchParams(**kwargs)
+        ass_query_body, _ = self._get_association_query(params, aggregations=False)
+        associations = (Association(h,
+                                    params.association_score_method,
+                                    self.datatypes,
+                                    cap_scores=params.cap_scores)
+                        for h in self._iter_hits(self._index_association, ass_query_body, page_size))
+        return (a.data for a in associations if a.data)
+
+    def _iter_hits(self, index, body, page_size):
+        '''
+        walks all the hits of a search with search_after, bypassing the cache.
+        the sort of `body` must end with a unique field
+
+        :return: generator of hits, elasticsearch is queried as it is consumed
+        '''
+        body = dict(body, size=page_size, track_total_hits=False)
+        body.pop('from', None)
+        while True:
+            res = self.handler.search(index=index,
+                                      body=body,
+                                      request_timeout=60 * 20)
+            hits = res['hits']['hits']
+            for hit in hits:
+                yield hit
+            if len(hits) < page_size:
+                break
+            body['search_after'] = hits[-1]['sort']
+
     def get_complex_target_filter(self,
                                   targets,
                                   bol=BooleanFilterOperator.OR,
@@ -1727,17 +2313,12 @@ class esQuery():
 
         return highlight
 
-    def _return_association_flat_data_structures(self,
-                                                 scores,
-                                                 facets):
-
+    @staticmethod
+    def _get_association_facets(aggregations):
         for facet_type in FilterTypes.__dict__.values():
-            if facet_type in facets:
-                facets[facet_type] = facets[facet_type]['data']
-        if facets:
-            facets = self._process_facets(facets)
-        return dict(data=scores,
-                    facets=facets)
+            if facet_type in aggregations:
+                aggregations[facet_type] = aggregations[facet_type]['data']
+        return aggregations
 
     def get_expression(self,
                        genes,
@@ -1815,14 +2396,20 @@ class esQuery():
                                       )
             if aggregate:
                 data = {'tissues': _compat_aggregated_expression(res['aggregations'])}
-                data = _inject_tissue_data(data, Config.ES_TISSUE_MAP)
+                data = _inject_tissue_data(data, self.tissue_map)
             else:
                 data = dict([(hit['_id'], hit['_source']) for hit in res['hits']['hits']])
 
             return SimpleResult(res, params, data)
 
-    def _process_facets(self, facets):
+    def _plan_facet_labels(self, facets, plan):
+        '''
+        adds to `plan` the searches for the labels of the reactome and
+        therapeutic area facets
 
+        :return: the reactome and the therapeutic area PlannedSearch, None if
+            not needed or if the label index has the labels
+        '''
         reactome_ids = []
         therapeutic_areas = []
 
@@ -1852,19 +2439,33 @@ class esQuery():
                                     if 'label' in sub_bucket:
                                         sub_bucket['label'] = sub_bucket['label']['buckets'][0]['key']
 
+        # labels missing from the label index are searched for
         reactome_ids = list(set(reactome_ids))
-        reactome_labels = self._get_labels_for_reactome_ids(reactome_ids)
-
-        efo_data = {}
-        therapeutic_area_labels = {}
-
-        t_areas = self.get_efo_info_from_code(therapeutic_areas, size=len(therapeutic_areas))
-
-        if t_areas:
-            efo_data = t_areas.toDict()['data']
+        reactome_search = None
+        if reactome_ids and self.labels.get(self.REACTOME_LABELS) is None:
+            reactome_search = plan.search(self._index_reactome, self._get_reactome_labels_query(reactome_ids))
+
+        t_areas_search = None
+        if therapeutic_areas and self.labels.get(self.THERAPEUTIC_AREA_LABELS) is None:
+            t_areas_search = plan.search(self._index_efo,
+                                         self._get_efo_info_query(therapeutic_areas,
+                                                                  SearchParams(size=len(therapeutic_areas))))
+        return reactome_search, t_areas_search
+
+    def _label_facets(self, facets, reactome_search, t_areas_search):
+        '''
+        :param reactome_search: executed PlannedSearch from `_plan_facet_labels`
+        :param t_areas_search: executed PlannedSearch from `_plan_facet_labels`
+        '''
+        if reactome_search is not None:
+            reactome_labels = self._parse_reactome_labels(reactome_search.result)
+        else:
+            reactome_labels = self.labels.get(self.REACTOME_LABELS) or {}
 
-        if efo_data:
-            therapeutic_area_labels = dict([(efo['path_codes'][0][-1], efo['label']) for efo in efo_data])
+        if t_areas_search is not None:
+            therapeutic_area_labels = self._parse_therapeutic_area_labels(t_areas_search.result)
+        else:
+            therapeutic_area_labels = self.labels.get(self.THERAPEUTIC_AREA_LABELS) or {}
 
         '''alter data'''
         for facet in facets:
@@ -1872,13 +2473,13 @@ class esQuery():
                 facet_buckets = facets[facet]['buckets']
                 for bucket in facet_buckets:
                     if facet == FilterTypes.PATHWAY:  # reactome data
-                        bucket['label'] = reactome_labels[bucket['key'].upper()] or bucket['key']
+                        bucket['label'] = reactome_labels.get(bucket['key'].upper()) or bucket['key']
                         if 'pathway' in bucket:
                             if 'buckets' in bucket['pathway']:
                                 sub_facet_buckets = bucket['pathway']['buckets']
                                 for sub_bucket in sub_facet_buckets:
-                                    sub_bucket['label'] = reactome_labels[sub_bucket['key'].upper()] or sub_bucket[
-                                        'key']
+                                    sub_bucket['label'] = reactome_labels.get(sub_bucket['key'].upper()) or \
+                                                          sub_bucket['key']
                     elif facet == FilterTypes.DATATYPE:  # need to filter out wrong datasource. an alternative is to map these object as nested in elasticsearch
                         dt = bucket["key"]
                         if 'datasource' in bucket:
@@ -1900,25 +2501,55 @@ class esQuery():
 
         return facets
 
-    def _get_labels_for_reactome_ids(self, reactome_ids):
+    @staticmethod
+    def _get_reactome_labels_query(reactome_ids):
+        return {"query": {
+                    "ids": {
+                        "values": reactome_ids
+                        }
+                    },
+                '_source': {"includes": ['label']},
+                'size': 10000,
+                'from': 0,
+                }
+
+    @staticmethod
+    def _parse_reactome_labels(res):
         labels = defaultdict(str)
-        if reactome_ids:
-            res = self._cached_search(index=self._index_reactome,
-                                      body={"query": {
-                                              "ids": {
-                                                  "values": reactome_ids
-                                                  }
-                                              },
-                                          '_source': {"includes": ['label']},
-                                          'size': 10000,
-                                          'from': 0,
-                                          }
-                                      )
-            if res['hits']['total']['value'] > 0:
-                for hit in res['hits']['hits']:
-                    labels[hit['_id']] = hit['_source']['label']
+        if res and res['hits']['total']['value'] > 0:
+            for hit in res['hits']['hits']:
+                labels[hit['_id']] = hit['_source']['label']
         return labels
 
+    @staticmethod
+    def _parse_therapeutic_area_labels(res):
+        return dict([(hit['_source']['path_codes'][0][-1], hit['_source']['label']) for hit in res['hits']['hits']])
+
+    def _load_reactome_labels(self):
+        '''
+        labels of all the reactome pathways, for the label index
+        '''
+        hits = helpers.scan(client=self.handler,
+                            query={'_source': ['label'], 'size': 1000},
+                            index=self._index_reactome,
+                            scroll='10m')
+        return dict((hit['_id'], hit['_source']['label']) for hit in hits)
+
+    def _load_therapeutic_area_labels(self):
+        '''
+        labels of all the therapeutic areas, for the label index
+        '''
+        res = self.handler.search(index=self._index_efo,
+                                  body={'size': 0,
+                                        'aggs': {'therapeutic_codes': {'terms': {'field': 'therapeutic_codes.keyword',
+                                                                                 'size': 1000}}}})
+        codes = [b['key'].upper() for b in res['aggregations']['therapeutic_codes']['buckets']]
+        if not codes:
+            return {}
+        res = self.handler.search(index=self._index_efo,
+                                  body=self._get_efo_info_query(codes, SearchParams(size=len(codes))))
+        return self._parse_therapeutic_area_labels(res)
+
     def _get_association_data_distribution(self, scores):
         histogram, bin_edges = np.histogram(scores, 5, (0., 1.))
         distribution = dict(buckets={})
@@ -2034,6 +2665,7 @@ class esQuery():
                 }
             },
             timeout="30m",
+            stale_ttl=Config.CACHE_STALE_TTL_EXPENSIVE,
         )
         )
 
@@ -2042,8 +2674,7 @@ class esQuery():
 
     def get_stats(self):
 
-        stats = DataStats()
-        stats.add_evidencestring(self._cached_search(
+        evidence_aggs = partial(self._cached_search,
                 index=self._index_data,
                 body={"query": {"match_all": {}},
                     "aggs": {
@@ -2066,18 +2697,18 @@ class esQuery():
                     '_source': False,
                     },
                 timeout="10m",
+                stale_ttl=Config.CACHE_STALE_TTL_EXPENSIVE,
                 )
-            )
 
         # To get the right number of docs use stats. (search aggregates the nested docs, count is giving different info)
-        index_data_stats=self._cached_stats(self._index_data)
-        stats.evidencestrings["total"] = [ v["total"]["docs"]["count"] for k, v in index_data_stats["indices"].iteritems()][0]
+        index_data_stats = partial(self._cached_stats, self._index_data,
+                                   stale_ttl=Config.CACHE_STALE_TTL_EXPENSIVE)
 
         # To get the right number of docs use stats.
-        index_association_stats = self._cached_stats(self._index_association)
-        total_associations = [ v["total"]["docs"]["count"] for k, v in index_association_stats["indices"].iteritems()][0]
+        index_association_stats = partial(self._cached_stats, self._index_association,
+                                          stale_ttl=Config.CACHE_STALE_TTL_EXPENSIVE)
 
-        stats.add_associations(self._cached_search(
+        association_aggs = partial(self._cached_search,
                     index=self._index_association,
                     body={"query": {"match_all": {}},
                             "aggs": {
@@ -2100,13 +2731,12 @@ class esQuery():
                             '_source': False,
                             },
                     timeout="10m",
-                    ),
-                    total_associations, self.datatypes
-                )
+                    stale_ttl=Config.CACHE_STALE_TTL_EXPENSIVE,
+                    )
 
         # To get the right number of docs use stats. (search aggregates the nested docs, count is giving different info)
         # By default ES7 returns by default just the first 10000 entries.
-        target_count = self._cached_search(
+        target_count = partial(self._cached_search,
             index=self._index_search,
             body={
                 "track_total_hits": True,
@@ -2120,11 +2750,11 @@ class esQuery():
                 },
                 "size": 1,
                 "_source": False
-            })
-        stats.add_key_value('targets', target_count['hits']['total']['value'])
+            },
+            stale_ttl=Config.CACHE_STALE_TTL_EXPENSIVE)
 
         # By default ES7 returns by default just the first 10000 entries.
-        disease_count = self._cached_search(
+        disease_count = partial(self._cached_search,
             index=self._index_search,
             body={
                 "track_total_hits": True,
@@ -2138,9 +2768,23 @@ class esQuery():
                 },
                 "size": 1,
                 "_source": False
-            })
-        stats.add_key_value('diseases', disease_count['hits']['total']['value'])
+            },
+            stale_ttl=Config.CACHE_STALE_TTL_EXPENSIVE)
+
+        res = self._fan_out(evidence_aggs=evidence_aggs,
+                            index_data_stats=index_data_stats,
+                            index_association_stats=index_association_stats,
+                            association_aggs=association_aggs,
+                            target_count=target_count,
+                            disease_count=disease_count)
 
+        stats = DataStats()
+        stats.add_evidencestring(res['evidence_aggs'])
+        stats.evidencestrings["total"] = [ v["total"]["docs"]["count"] for k, v in res['index_data_stats']["indices"].iteritems()][0]
+        total_associations = [ v["total"]["docs"]["count"] for k, v in res['index_association_stats']["indices"].iteritems()][0]
+        stats.add_associations(res['association_aggs'], total_associations, self.datatypes)
+        stats.add_key_value('targets', res['target_count']['hits']['total']['value'])
+        stats.add_key_value('diseases', res['disease_count']['hits']['total']['value'])
 
         return RawResult(str(stats))
 
@@ -2228,13 +2872,18 @@ class esQuery():
             }
         }
 
-        stats.add_genes(self._cached_search(index=self._index_genename,
-                                                     body=genes_metrics,
-                                                     timeout="10m"))
-
-        stats.add_evidences(self._cached_search(index=self._index_data,
-                                            body=evidences_metrics,
-                                            timeout="10m"))
+        res = self._fan_out(genes=partial(self._cached_search,
+                                          index=self._index_genename,
+                                          body=genes_metrics,
+                                          timeout="10m",
+                                          stale_ttl=Config.CACHE_STALE_TTL_EXPENSIVE),
+                            evidences=partial(self._cached_search,
+                                              index=self._index_data,
+                                              body=evidences_metrics,
+                                              timeout="10m",
+                                              stale_ttl=Config.CACHE_STALE_TTL_EXPENSIVE))
+        stats.add_genes(res['genes'])
+        stats.add_evidences(res['evidences'])
 
         return RawResult(str(stats))
 
@@ -2264,27 +2913,59 @@ class esQuery():
                 }
 
 
+    def _fan_out(self, **calls):
+        '''
+        runs independent elasticsearch calls concurrently
+
+        :param calls: name=callable taking no arguments
+        :return: dict of name: result
+        '''
+        return fan_out(calls,
+                       size=Config.ES_FAN_OUT_POOL_SIZE,
+                       timeout=Config.ES_FAN_OUT_TIMEOUT)
+
+    @staticmethod
+    def _no_cache():
+        '''
+        whether the request asked not to use the cache. the stale values
+        refreshed in background are computed outside of the request, and
+        always cached
+        '''
+        return has_request_context() and Config.NO_CACHE_PARAMS in request.values
+
+    def _cache_key(self, *args, **kwargs):
+        key = canonical_cache_key(*args, **kwargs)
+        self.cache.key_folds.record(str(args) + str(kwargs), key)
+        return key
+
     def _cached_stats(self, *args, **kwargs):
-        key = str(args) + str(kwargs)
-        no_cache = Config.NO_CACHE_PARAMS in request.values
+        stale_ttl = kwargs.pop('stale_ttl', None)
+        key = self._cache_key(*args, **kwargs)
+        no_cache = self._no_cache()
 
         if no_cache:
             res = self.handler.indices.stats(*args, **kwargs)
             return res
 
-        res = self.cache.get(key)
-        if res is None:
+        def stats():
             start_time = datetime.datetime.now()
             res = self.handler.indices.stats(*args, **kwargs)
             took = (datetime.datetime.now() - start_time) + datetime.timedelta(minutes=1)
-            self.cache.set(key, res, took)
+            return res, took
 
-        return res
+        return self.cache.get_or_set(key, stats, stale_ttl)
 
 
     def _cached_search(self, *args, **kwargs):
-        key = str(args) + str(kwargs)
-        no_cache = Config.NO_CACHE_PARAMS in request.values
+        '''
+        search elasticsearch through the InternalCache
+
+        :param stale_ttl: seconds an expired response is still served while
+            it is refreshed in background. defaults to the cache one
+        '''
+        stale_ttl = kwargs.pop('stale_ttl', None)
+        key = self._cache_key(*args, **kwargs)
+        no_cache = self._no_cache()
         is_multi = False
 
         # Debug the ES body
@@ -2301,8 +2982,7 @@ class esQuery():
                 res = self.handler.search(*args, **kwargs)
             return res
 
-        res = self.cache.get(key)
-        if res is None:
+        def search():
             start_time = datetime.datetime.now()
 
             if is_multi:
@@ -2311,8 +2991,63 @@ class esQuery():
                 res = self.handler.search(*args, **kwargs)
 
             took = (datetime.datetime.now() - start_time) + datetime.timedelta(minutes=1)
-            self.cache.set(key, res, took)
-        return res
+            return res, took
+
+        return self.cache.get_or_set(key, search, stale_ttl)
+
+    def _cached_msearch(self, searches, stale_ttl=None):
+        '''
+        runs several searches with one msearch, caching each of them on its own
+
+        :param searches: list of dicts with the `index` and `body` of each search
+        :return: list of responses, as returned by `_cached_search`
+        '''
+        keys = [self._cache_key(**s) for s in searches]
+        searches_by_key = dict(zip(keys, searches))
+
+        def msearch(missing):
+            start_time = datetime.datetime.now()
+            body = []
+            for key in missing:
+                body.append({'index': searches_by_key[key]['index']})
+                body.append(searches_by_key[key]['body'])
+            res = self.handler.msearch(body=body)
+            took = (datetime.datetime.now() - start_time) + datetime.timedelta(minutes=1)
+            responses = []
+            for response in res['responses']:
+                if 'error' in response:
+                    raise TransportError(response.get('status', 500),
+                                         response['error'].get('type'),
+                                         response['error'])
+                # make it the same as the response of a single search
+                response.pop('status', None)
+                responses.append((response, took))
+            return responses
+
+        if self._no_cache():
+            return [res for res, _ in msearch(keys)]
+        return self.cache.get_many_or_set(keys, msearch, stale_ttl)
+
+    def _cached_json(self, key, func):
+        '''
+        caches the json encoding of what `func` returns: a cache hit is
+        returned as it was encoded, to be sent with a RawResult without
+        being decoded and encoded again
+
+        :param key: json serialisable identifier of the document
+        :param func: callable returning the document to encode, None if there is none
+        :return: json string, None if `func` returned None
+        '''
+        def encode():
+            document = func()
+            ttl = current_app.config['APP_CACHE_EXPIRY_TIMEOUT']
+            if document is None:
+                return '', ttl
+            return Result.json_codec.dumps(document), ttl
+
+        if self._no_cache():
+            return encode()[0] or None
+        return self.cache.get_or_set(self._cache_key('json', key), encode) or None
 
     @staticmethod
     def _resolve_negable_parameter_set(params, include_negative=False):
@@ -0,0 +1,308 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+from array import array
+
+import numpy as np
+
+from app.common.hypergeometric import PValueCorrections, correct, upper_tail_pvalues
+from app.common.prefork import FrozenMap
+from app.common.response_templates import Association
+
+__author__ = 'andreap'
+
+logger = logging.getLogger(__name__)
+
+
+class DiseaseGroups(object):
+    '''
+    associations of a target set grouped by disease. each disease gets an
+    integer code in order of appearance, the associations are grouped by
+    sorting the codes once rather than appending to a list per disease id
+    '''
+
+    def __init__(self):
+        self.ids = []
+        self.sources = []
+        self._codes = {}
+        self._source_codes = array('l')
+
+    def add(self, disease_id, source):
+        '''
+        :param source: `_source` of the association hit
+        '''
+        code = self._codes.get(disease_id)
+        if code is None:
+            code = self._codes[disease_id] = len(self.ids)
+            self.ids.append(disease_id)
+        self._source_codes.append(code)
+        self.sources.append(source)
+
+    @classmethod
+    def from_codes(cls, ids, codes, sources):
+        '''
+        :param ids: disease id of each code
+        :param codes: array of the disease code of each association
+        :param sources: `_source` of each association
+        '''
+        groups = cls()
+        groups.ids = list(ids)
+        groups._codes = dict((disease_id, code) for code, disease_id in enumerate(groups.ids))
+        groups._source_codes = array('l', codes.tolist())
+        groups.sources = sources
+        return groups
+
+    def add_hits(self, hits):
+        for hit in hits:
+            source = hit['_source']
+            self.add(source['disease']['id'], source)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def codes(self):
+        '''
+        :return: array of the disease code of each association
+        '''
+        return np.frombuffer(self._source_codes, dtype=np.dtype(self._source_codes.typecode)) \
+            if self._source_codes else np.zeros(0, dtype=np.int64)
+
+    def counts(self):
+        '''
+        :return: array of the number of associations of each disease, by code
+        '''
+        if not self.ids:
+            return np.zeros(0, dtype=np.int64)
+        return np.bincount(self.codes, minlength=len(self.ids))
+
+    def groups(self):
+        '''
+        :return: list of the association sources of each disease, by code
+        '''
+        if not self.ids:
+            return []
+        order = np.argsort(self.codes, kind='mergesort')
+        bounds = np.cumsum(self.counts())[:-1]
+        sources = self.sources
+        return [[sources[i] for i in group.tolist()] for group in np.split(order, bounds)]
+
+
+def enrichment_results(groups, background, N, M, correction=PValueCorrections.NONE):
+    '''
+    one enrichment result per disease of `groups`, scored with the upper
+    tail hypergeometric p-value corrected for all the diseases tested
+
+    :param groups: DiseaseGroups of the associations of the target set
+    :param background: dict of disease id: dict with the `label` and the
+        `association_counts` of the disease
+    :param N: number of targets with associations
+    :param M: number of targets in the set
+    :param correction: one of PValueCorrections
+    '''
+    k = np.array([background[disease_id]['association_counts']['total'] for disease_id in groups.ids],
+                 dtype=np.int64)
+    x = groups.counts()
+    pvalues = upper_tail_pvalues(N, M, k, x)
+    scores = correct(pvalues, correction).tolist()
+    pvalues = pvalues.tolist()
+    k = k.tolist()
+    x = x.tolist()
+    data = []
+    for code, disease_targets in enumerate(groups.groups()):
+        disease_id = groups.ids[code]
+        disease_properties = disease_targets[0]['disease']['efo_info']
+        target_data = []
+        for source in disease_targets:
+            source['association_score'] = source.pop('harmonic-sum')
+            del source['disease']
+            target_data.append(source)
+        target_data.sort(key=lambda t: t['association_score']['overall'], reverse=True)
+        for t in target_data:
+            t['association_score']['overall'] = Association.cap_score(t['association_score']['overall'])
+        data.append({
+            "enriched_entity": {
+                "type": "disease",
+                "id": disease_id,
+                "label": background[disease_id]["label"],
+                "properties": disease_properties
+            },
+            "enrichment": {
+                "method": "hypergeometric",
+                "correction": correction,
+                "params": {
+                    "all_targets": N,
+                    "all_targets_in_disease": k[code],
+                    "targets_in_set": M,
+                    "targets_in_set_in_disease": x[code]
+                },
+                "pvalue": pvalues[code],
+                "score": scores[code]
+            },
+            "targets": target_data
+        })
+    return data
+
+
+def association_matrix_directory(path, data_version):
+    return os.path.join(path, 'association_matrix_%s' % data_version)
+
+
+class AssociationMatrix(object):
+    '''
+    targets x diseases matrix of the associations of a data release, built
+    offline by `manage.py build_association_matrix`, so that an enrichment
+    is answered from the rows of the targets in the set instead of
+    scrolling the association index.
+
+    the matrix is stored in compressed sparse row form in a directory of
+    .npy files, memory mapped by every worker: `indptr` has the first
+    association of each target, `indices` the disease of each association,
+    `overall` and `datatypes` its scores, `disease_counts` the number of
+    targets associated to each disease. `meta.json` holds the ids and the
+    target and disease details the enrichment results carry
+    '''
+    ARRAYS = ('indptr', 'indices', 'overall', 'datatypes', 'disease_counts')
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json')) as f:
+            meta = json.load(f)
+        self.all_targets = meta['all_targets']
+        self.datatype_names = meta['datatypes']
+        self.target_ids = [t[0] for t in meta['targets']]
+        self._target_codes = dict((t, i) for i, t in enumerate(self.target_ids))
+        self._target_info = FrozenMap(dict(meta['targets']))
+        self.disease_ids = [d[0] for d in meta['diseases']]
+        self.disease_labels = [d[1] for d in meta['diseases']]
+        self._disease_info = FrozenMap(dict((d[0], d[2]) for d in meta['diseases']))
+        for name in self.ARRAYS:
+            setattr(self, name, np.load(os.path.join(directory, name + '.npy'), mmap_mode='r'))
+
+    @classmethod
+    def load(cls, directory):
+        '''
+        :return: the matrix in `directory`, None if it was not built
+        '''
+        if not os.path.exists(os.path.join(directory, 'meta.json')):
+            logger.info('no association matrix in %s, enrichments are computed from elasticsearch', directory)
+            return None
+        return cls(directory)
+
+    @classmethod
+    def write(cls, directory, hits, get_background, all_targets, datatypes):
+        '''
+        builds the matrix in `directory` atomically, readers see either no
+        matrix or the complete one
+
+        :param hits: iterable of association hits, with the `_source` fields
+            get_enrichment_for_targets scrolls
+        :param get_background: callable taking the list of the disease ids
+            and returning a dict of disease id: dict with the `label` and the
+            `association_counts` of the disease, called once all the hits are read
+        :param all_targets: number of targets with associations
+        :param datatypes: names of the datatypes scores stored
+        '''
+        target_codes, targets = {}, []
+        disease_codes, diseases = {}, []
+        rows, cols = array('l'), array('l')
+        overall, datatype_scores = array('d'), array('d')
+        for hit in hits:
+            source = hit['_source']
+            target_id = source['target']['id']
+            row = target_codes.get(target_id)
+            if row is None:
+                row = target_codes[target_id] = len(targets)
+                targets.append((target_id, source['target']))
+            disease_id = source['disease']['id']
+            col = disease_codes.get(disease_id)
+            if col is None:
+                col = disease_codes[disease_id] = len(diseases)
+                diseases.append((disease_id, source['disease']['efo_info']))
+            rows.append(row)
+            cols.append(col)
+            scores = source['harmonic-sum']
+            overall.append(scores['overall'])
+            datatype_scores.extend(scores['datatypes'].get(dt, 0.) for dt in datatypes)
+
+        rows = np.frombuffer(rows, dtype=np.dtype(rows.typecode)) if rows else np.zeros(0, dtype=np.int64)
+        order = np.argsort(rows, kind='mergesort')
+        arrays = dict(
+            indptr=np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=len(targets))
+                                                  if targets else [])]).astype(np.int64),
+            indices=np.frombuffer(cols, dtype=np.dtype(cols.typecode))[order].astype(np.int32)
+                    if cols else np.zeros(0, dtype=np.int32),
+            overall=np.frombuffer(overall, dtype=np.float64)[order] if overall else np.zeros(0),
+            datatypes=np.frombuffer(datatype_scores, dtype=np.float64).reshape(-1, len(datatypes))[order]
+                      if datatype_scores else np.zeros((0, len(datatypes))),
+        )
+        background = get_background([d[0] for d in diseases])
+        arrays['disease_counts'] = np.array([background[d[0]]['association_counts']['total'] for d in diseases],
+                                            dtype=np.int64)
+        diseases = [(disease_id, background[disease_id]['label'], efo_info) for disease_id, efo_info in diseases]
+
+        parent = os.path.dirname(os.path.abspath(directory))
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        tmp_directory = tempfile.mkdtemp(dir=parent)
+        try:
+            for name in cls.ARRAYS:
+                np.save(os.path.join(tmp_directory, name + '.npy'), arrays[name])
+            with open(os.path.join(tmp_directory, 'meta.json'), 'w') as f:
+                json.dump(dict(all_targets=all_targets,
+                               datatypes=list(datatypes),
+                               targets=targets,
+                               diseases=diseases), f)
+            os.rename(tmp_directory, directory)
+        except Exception:
+            shutil.rmtree(tmp_directory, ignore_errors=True)
+            raise
+
+    def __contains__(self, target_id):
+        return target_id in self._target_codes
+
+    def enrichment_input(self, targets):
+        '''
+        the associations of `targets`, read from their rows, in the form
+        the association index scroll gives them
+
+        :return: DiseaseGroups of the associations, and the background dict
+            of the diseases for enrichment_results
+        '''
+        rows = np.array(sorted(set(self._target_codes[t] for t in targets if t in self._target_codes)),
+                        dtype=np.int64)
+        if not len(rows):
+            return DiseaseGroups(), {}
+        starts = self.indptr[rows]
+        lengths = self.indptr[rows + 1] - starts
+        # position in the matrix of each association of the rows, and the row it is in
+        row_index = np.repeat(np.arange(len(rows)), lengths)
+        positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        disease_cols, codes = np.unique(self.indices[positions], return_inverse=True)
+
+        disease_cols = disease_cols.tolist()
+        disease_ids = [self.disease_ids[col] for col in disease_cols]
+        background = dict((self.disease_ids[col], dict(id=self.disease_ids[col],
+                                                        label=self.disease_labels[col],
+                                                        association_counts=dict(total=int(self.disease_counts[col]))))
+                          for col in disease_cols)
+        # shared by the associations of a disease, it is left out of the results
+        diseases = [dict(id=disease_id, efo_info=self._disease_info[disease_id]) for disease_id in disease_ids]
+        targets = [self._target_info[self.target_ids[row]] for row in rows.tolist()]
+        datatype_names = self.datatype_names
+        sources = [{'target': targets[row],
+                    'harmonic-sum': {'overall': overall, 'datatypes': dict(zip(datatype_names, datatype_scores))},
+                    'disease': diseases[code]}
+                   for row, overall, datatype_scores, code in zip(row_index.tolist(),
+                                                                  self.overall[positions].tolist(),
+                                                                  self.datatypes[positions].tolist(),
+                                                                  codes.tolist())]
+        return DiseaseGroups.from_codes(disease_ids, codes, sources), background
+
+    def info(self):
+        return dict(directory=self.directory,
+                    targets=len(self.target_ids),
+                    diseases=len(self.disease_ids),
+                    associations=len(self.indices))
@@ -0,0 +1,39 @@
+import gevent
+from flask import copy_current_request_context, has_request_context
+from gevent.pool import Pool
+
+__author__ = 'andreap'
+
+
+class FanOutTimeout(Exception):
+    pass
+
+
+def _with_timeout(name, func, timeout):
+    with gevent.Timeout(timeout, FanOutTimeout('%s did not complete in %ss' % (name, timeout))):
+        return func()
+
+
+def fan_out(calls, size=8, timeout=None):
+    '''
+    runs independent calls concurrently in a bounded pool of greenlets, so
+    that they take as long as the slowest of them rather than their sum.
+    the calls run in a copy of the current request context, if any.
+
+    :param calls: dict of name: callable taking no arguments
+    :param size: maximum number of calls running at the same time
+    :param timeout: seconds allowed to each call before it raises FanOutTimeout
+    :return: dict of name: result of the call
+    :raise: the first exception raised by a call, once the others are cancelled
+    '''
+    pool = Pool(size)
+    greenlets = {}
+    try:
+        for name, func in calls.items():
+            if has_request_context():
+                func = copy_current_request_context(func)
+            greenlets[name] = pool.spawn(_with_timeout, name, func, timeout)
+        gevent.joinall(greenlets.values(), raise_error=True)
+    finally:
+        pool.kill()
+    return dict((name, g.value) for name, g in greenlets.items())
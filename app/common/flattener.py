@@ -0,0 +1,132 @@
+import collections
+import json
+
+__author__ = 'andreap'
+
+
+SIMPLIFIED_VALUE_PREFIX = "http://identifiers.org/"
+SIMPLIFIED_KEY_PREFIX = "biological_object.properties."
+_MISSING = object()
+
+
+def to_unicode(v):
+    '''
+    converts a leaf value to the text written in a tab or csv export: lists
+    of strings are joined with `|`, anything but strings is json encoded
+    '''
+    if isinstance(v, list):
+        if all(isinstance(i, basestring) for i in v):
+            v = '|'.join(v).encode('utf-8')
+        elif len(v) == 1:
+            v = v[0]
+        else:
+            v = json.dumps(v, encoding='utf-8')
+    if isinstance(v, str):
+        try:
+            v = unicode(v)
+        except UnicodeDecodeError:
+            pass
+    if not isinstance(v, unicode):
+        v = json.dumps(v, encoding='utf-8')
+    return unicode(v)
+
+
+class Flattener(object):
+    '''
+    turns nested documents into flat rows of text.
+
+    with a list of fields the columns are known in advance: the path of every
+    field is split once and rows are emitted in a single pass, reading only
+    the requested values. without fields every leaf becomes a column, named
+    by its dotted path, and the columns are only known once every row is
+    flattened: the `_source` of a datastructure lists wildcards, not leaves.
+    only the joined key paths are cached then, not the columns.
+    '''
+    _MAX_PARENT_KEYS = 10000
+
+    def __init__(self, fields=None, simplify=False, exclude=(), sep='.'):
+        '''
+        :param fields: dotted paths of the columns, all the leaves if None
+        :param simplify: drop identifiers.org urls and biological object properties
+        :param exclude: columns never returned
+        '''
+        self.fields = map(unicode, fields) if fields else None
+        self.simplify = simplify
+        self.exclude = frozenset(exclude)
+        self.sep = sep
+        self._paths = [tuple(f.split(sep)) for f in self.fields] if self.fields else None
+        self._keys = {}
+
+    def flatten(self, d, parent_key=''):
+        '''
+        :return: OrderedDict of column: text
+        '''
+        flat = collections.OrderedDict()
+        self._flatten_into(d, parent_key, flat)
+        for k in self.exclude:
+            flat.pop(k, None)
+        return flat
+
+    def _flatten_into(self, d, parent_key, flat):
+        keys = self._keys.get(parent_key)
+        if keys is None:
+            if len(self._keys) >= self._MAX_PARENT_KEYS:
+                self._keys.clear()
+            keys = self._keys[parent_key] = {}
+        for k, v in d.items():
+            new_key = keys.get(k)
+            if new_key is None:
+                new_key = keys[k] = unicode(parent_key + self.sep + k if parent_key else k)
+            if isinstance(v, collections.MutableMapping):
+                self._flatten_into(v, new_key, flat)
+                continue
+            text = to_unicode(v)
+            if self.simplify and (new_key.startswith(SIMPLIFIED_KEY_PREFIX) or
+                                  # lists are only matched once converted when nested, as Result.flatten does
+                                  ((parent_key or not isinstance(v, list)) and
+                                   text.startswith(SIMPLIFIED_VALUE_PREFIX))):
+                continue
+            flat[new_key] = text
+
+    def row(self, d):
+        '''
+        :return: list of the values of `fields` in `d`, as text
+        '''
+        values = []
+        for field, path in zip(self.fields, self._paths):
+            v = d
+            for step in path:
+                if isinstance(v, collections.Mapping) and step in v:
+                    v = v[step]
+                else:
+                    v = _MISSING
+                    break
+            if v is _MISSING or field in self.exclude:
+                values.append(u'')
+            elif isinstance(v, collections.Mapping):
+                values.append(unicode(json.dumps(v, encoding='utf-8')))
+            else:
+                text = to_unicode(v)
+                if self.simplify and (field.startswith(SIMPLIFIED_KEY_PREFIX) or
+                                      ((len(path) > 1 or not isinstance(v, list)) and
+                                       text.startswith(SIMPLIFIED_VALUE_PREFIX))):
+                    text = u''
+                values.append(text)
+        return values
+
+
+_flatteners = {}
+_MAX_FLATTENERS = 256
+
+
+def get_flattener(fields=None, simplify=False, exclude=()):
+    '''
+    flattener compiled for the given fields, shared across requests
+    '''
+    key = (tuple(fields) if fields else None, simplify, tuple(exclude))
+    flattener = _flatteners.get(key)
+    if flattener is None:
+        if len(_flatteners) >= _MAX_FLATTENERS:
+            _flatteners.clear()
+        flattener = _flatteners[key] = Flattener(fields, simplify, exclude)
+    return flattener
@@ -1,45 +1,119 @@
-from math import log, exp
+import numpy as np
+from scipy.special import gammaln
 
+__author__ = 'andreap'
 
-class HypergeometricTest:
 
-    def __init__(self):
-        pass
+class PValueCorrections:
+    NONE = 'none'
+    BONFERRONI = 'bonferroni'
+    BENJAMINI_HOCHBERG = 'bh'
 
-    @staticmethod
-    def _gammaln( x):
-        cof = [76.18009173, -86.50532033, 24.01409822, -1.231739516, 0.120858003e-2, -0.536382e-5]
 
-        if x == 0 or x == 1:
-            return 0
+def _log_choose(n, r):
+    return gammaln(n + 1) - gammaln(r + 1) - gammaln(n - r + 1)
 
-        y = x-1
-        tmp = y + 5.5
-        tmp -= (y+0.5)*log(tmp)
-        ser = 1
-        for i, c in enumerate(cof):
-            y += 1
-            ser += c/y
 
-        return log(x) + (log(2.50662827465*ser)-tmp)
+def _sum_pmf(N, M, k, start, stop, rtol):
+    '''
+    sums of the hypergeometric pmf from `start` to `stop`, for arrays of k,
+    start and stop. the first term of each sum is computed in log space,
+    then every step moves all the sums still open to their next term with
+    the pmf recurrence, until the terms left are negligible
+    '''
+    up = start <= stop
+    sums = np.zeros(len(k))
+    idx = np.arange(len(k))
+    i = start
+    term = np.exp(_log_choose(k, i) + _log_choose(N - k, M - i) - _log_choose(N, M))
+    total = term.copy()
+    while len(idx):
+        # p(i + 1) / p(i) going up, p(i - 1) / p(i) going down
+        ratio = np.where(up,
+                         (k - i) * (M - i) / ((i + 1) * (N - k - M + i + 1)),
+                         i * (N - k - M + i) / ((k - i + 1) * (M - i + 1)))
+        term = term * ratio
+        i = np.where(up, i + 1, i - 1)
+        inside = np.where(up, i <= stop, i >= stop)
+        total += np.where(inside, term, 0.)
+        # away from the mode the terms shrink faster than halving: what is left is below the last one
+        done = ~inside | ((ratio < .5) & (term <= total * rtol))
+        if done.any():
+            sums[idx[done]] = total[done]
+            keep = ~done
+            idx, k, i, stop, up, term, total = idx[keep], k[keep], i[keep], stop[keep], up[keep], term[keep], \
+                total[keep]
+    return sums
 
-    @staticmethod
-    def _choose(A, B):
-        return HypergeometricTest._gammaln(A) - (HypergeometricTest._gammaln(B) + HypergeometricTest._gammaln(A-B))
 
-    @staticmethod
-    def _hypergeom( N, M, k, x):
-        pvalue = 0
+def upper_tail_pvalues(N, M, k, x, rtol=1e-17):
+    '''
+    probability of each disease to have `x` or more of the `M` targets in
+    the set when `k` of the `N` targets with associations are associated to
+    it, computed for all the diseases at once: hypergeom.sf loops in python
+    over them.
 
-        for i in range(x, (min(k, M)+1)):
-            lprob = HypergeometricTest._choose(M, x) + HypergeometricTest._choose((N-M), (k-i)) - HypergeometricTest._choose(N, k)
-            pvalue += exp(lprob)
+    tails starting past the mode are summed up from `x`, the others are one
+    minus the lower tail summed down from `x - 1`, so that the terms summed
+    always shrink and the ones too small to count are skipped
 
-        return pvalue
+    :param N: number of targets with associations
+    :param M: number of targets in the set
+    :param k: array of the number of targets associated to each disease
+    :param x: array of the number of targets of the set associated to each disease
+    :param rtol: a sum stops once its terms are lower than this times the sum
+    :return: array of p-values
+    '''
+    k, x = np.broadcast_arrays(np.asarray(k, dtype=np.float64), np.asarray(x, dtype=np.float64))
+    N, M = float(N), float(M)
+    upper = np.minimum(k, M)
+    lower = np.maximum(0., M - (N - k))
+    mode = np.floor((M + 1) * (k + 1) / (N + 2))
+    # nothing to sum at or below the lowest count, or above the highest
+    pvalues = np.where(x > upper, 0., 1.)
+    idx = np.flatnonzero((x > lower) & (x <= upper))
+    k, x, upper, lower, mode = k[idx], x[idx], upper[idx], lower[idx], mode[idx]
+    past_mode = x > mode
+    sums = _sum_pmf(N, M, k,
+                    np.where(past_mode, x, x - 1),
+                    np.where(past_mode, upper, lower),
+                    rtol)
+    pvalues[idx] = np.where(past_mode, sums, 1. - sums)
+    return np.clip(pvalues, 0., 1.)
 
-    @staticmethod
-    def run( N, M, k, x):
-        if not N or not M or not k or not x:
-            return 1
 
-        return HypergeometricTest._hypergeom(N, M, k, x)
+def bonferroni(pvalues):
+    '''
+    :return: family-wise error rate adjusted p-values
+    '''
+    pvalues = np.asarray(pvalues, dtype=np.float64)
+    return np.minimum(pvalues * len(pvalues), 1.)
+
+
+def benjamini_hochberg(pvalues):
+    '''
+    :return: false discovery rate adjusted p-values, the i-th smallest of
+        the n p-values is the lowest p * n / j of the j-th smallest for j >= i
+    '''
+    pvalues = np.asarray(pvalues, dtype=np.float64)
+    n = len(pvalues)
+    if not n:
+        return pvalues
+    descending = np.argsort(pvalues, kind='mergesort')[::-1]
+    adjusted = np.minimum.accumulate(pvalues[descending] * n / np.arange(n, 0, -1, dtype=np.float64))
+    corrected = np.empty(n)
+    corrected[descending] = np.minimum(adjusted, 1.)
+    return corrected
+
+
+CORRECTIONS = {PValueCorrections.NONE: lambda pvalues: np.asarray(pvalues, dtype=np.float64),
+               PValueCorrections.BONFERRONI: bonferroni,
+               PValueCorrections.BENJAMINI_HOCHBERG: benjamini_hochberg}
+
+
+def correct(pvalues, correction=PValueCorrections.NONE):
+    '''
+    :param pvalues: p-values of all the tested diseases
+    :param correction: one of PValueCorrections
+    '''
+    return CORRECTIONS[correction](pvalues)
@@ -0,0 +1,275 @@
+import json
+import logging
+import time
+import traceback
+import uuid
+from contextlib import contextmanager
+
+import gevent
+from gevent.pool import Pool
+
+__author__ = 'andreap'
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def _no_context():
+    yield
+
+
+class JobStatus:
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobQueue(object):
+    '''
+    requests too long to be answered while the client waits, e.g. the
+    enrichment of a thousand targets, submitted by the api workers to a
+    queue in the local redis and run by `manage.py run_jobs`, so that they
+    neither hold a uwsgi request slot nor run into its harakiri.
+
+    each job is a redis hash with its kind, parameters, status and progress.
+    its result, the json of the Result returned by the function registered
+    for its kind, is kept in redis until `result_ttl` expires.
+
+    a running job beats every `heartbeat_interval` seconds. the ones left
+    running by a runner that was killed stop beating, and are queued again
+    by `recover`
+    '''
+
+    def __init__(self, r_server, prefix='jobs', result_ttl=24 * 60 * 60, max_queued=100,
+                 heartbeat_interval=30, heartbeat_timeout=5 * 60, max_attempts=2):
+        '''
+        :param r_server: redis connection shared by the api workers and the job runner,
+            to a server that does not evict keys with a ttl
+        :param result_ttl: seconds a job and its result are kept once submitted or updated
+        :param max_queued: jobs waiting to run before new ones are refused
+        :param heartbeat_interval: seconds between the beats of a running job
+        :param heartbeat_timeout: seconds without a beat after which a running job is recovered
+        :param max_attempts: times a job is run before it is failed rather than recovered
+        '''
+        self.r_server = r_server
+        self.prefix = prefix
+        self.result_ttl = result_ttl
+        self.max_queued = max_queued
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_attempts = max_attempts
+        self._kinds = {}
+
+    def register(self, kind, func, validate=None):
+        '''
+        :param func: callable taking the parameters of a job and a `progress`
+            callable, see `run`, and returning a Result
+        :param validate: callable taking the parameters of a job when it is
+            submitted and returning them as they are to be run, e.g. with
+            their types coerced, or raising ValueError if they are not valid
+        '''
+        self._kinds[kind] = (func, validate)
+
+    @property
+    def kinds(self):
+        return sorted(self._kinds)
+
+    @property
+    def _queue_key(self):
+        return '%s:queue' % self.prefix
+
+    @property
+    def _running_key(self):
+        return '%s:running' % self.prefix
+
+    def _job_key(self, job_id):
+        return '%s:job:%s' % (self.prefix, job_id)
+
+    def _result_key(self, job_id):
+        return '%s:result:%s' % (self.prefix, job_id)
+
+    def submit(self, kind, params):
+        '''
+        :return: the job queued
+        :raise ValueError: if `kind` or `params` are not valid
+        :raise QueueFull: if too many jobs are waiting
+        '''
+        if kind not in self._kinds:
+            raise ValueError('job kind must be one of %s' % ', '.join(self.kinds))
+        validate = self._kinds[kind][1]
+        if validate is not None:
+            params = validate(params)
+        if self.r_server.llen(self._queue_key) >= self.max_queued:
+            raise QueueFull('%i jobs are already waiting' % self.max_queued)
+        job_id = uuid.uuid4().hex
+        pipe = self.r_server.pipeline()
+        pipe.hset(self._job_key(job_id), mapping=dict(kind=kind,
+                                                      params=json.dumps(params),
+                                                      status=JobStatus.QUEUED,
+                                                      progress=0.,
+                                                      message='',
+                                                      submitted=time.time()))
+        pipe.expire(self._job_key(job_id), self.result_ttl)
+        pipe.rpush(self._queue_key, job_id)
+        pipe.execute()
+        return self.get(job_id)
+
+    def get(self, job_id):
+        '''
+        :return: dict of the status of the job, None if there is no such job
+        '''
+        job = self.r_server.hgetall(self._job_key(job_id))
+        if not job:
+            return None
+        info = dict(id=job_id,
+                    kind=job['kind'],
+                    status=job['status'],
+                    progress=float(job['progress']),
+                    message=job.get('message', ''),
+                    params=json.loads(job['params']))
+        for timestamp in ('submitted', 'started', 'heartbeat', 'finished'):
+            if timestamp in job:
+                info[timestamp] = float(job[timestamp])
+        if 'attempts' in job:
+            info['attempts'] = int(job['attempts'])
+        if job['status'] == JobStatus.QUEUED:
+            info['queued_before'] = self._position(job_id)
+        if 'error' in job:
+            info['error'] = job['error']
+        return info
+
+    def _position(self, job_id):
+        queued = self.r_server.lrange(self._queue_key, 0, -1)
+        return queued.index(job_id) if job_id in queued else 0
+
+    def get_result(self, job_id):
+        '''
+        :return: the json of the result of a job that is done, None otherwise
+        '''
+        return self.r_server.get(self._result_key(job_id))
+
+    def _update(self, job_id, **fields):
+        pipe = self.r_server.pipeline()
+        pipe.hset(self._job_key(job_id), mapping=fields)
+        pipe.expire(self._job_key(job_id), self.result_ttl)
+        pipe.execute()
+
+    def run(self, job_id, context=None):
+        '''
+        runs a queued job, passing to its function a `progress(fraction,
+        message='')` callable to report how far it got
+
+        :param context: callable returning the context manager the job runs in
+        '''
+        job = self.r_server.hgetall(self._job_key(job_id))
+        if not job:
+            # expired while queued
+            return
+        now = time.time()
+        pipe = self.r_server.pipeline()
+        pipe.hset(self._job_key(job_id), mapping=dict(status=JobStatus.RUNNING,
+                                                      started=now,
+                                                      heartbeat=now,
+                                                      attempts=int(job.get('attempts', 0)) + 1))
+        pipe.expire(self._job_key(job_id), self.result_ttl)
+        pipe.sadd(self._running_key, job_id)
+        pipe.execute()
+        heartbeat = gevent.spawn(self._beat, job_id)
+
+        def progress(fraction, message=''):
+            self._update(job_id, progress=min(max(float(fraction), 0.), 1.), message=message, heartbeat=time.time())
+
+        try:
+            func = self._kinds[job['kind']][0]
+            params = json.loads(job['params'])
+            with context() if context is not None else _no_context():
+                data = func(params, progress).toJSON()
+        except Exception as e:
+            logger.error('job %s failed: %s', job_id, traceback.format_exc())
+            self._update(job_id, status=JobStatus.FAILED, finished=time.time(), error=str(e) or e.__class__.__name__)
+            self.r_server.srem(self._running_key, job_id)
+            return
+        finally:
+            heartbeat.kill()
+        pipe = self.r_server.pipeline()
+        pipe.setex(self._result_key(job_id), self.result_ttl, data)
+        pipe.hset(self._job_key(job_id), mapping=dict(status=JobStatus.DONE,
+                                                      progress=1.,
+                                                      message='',
+                                                      finished=time.time()))
+        pipe.expire(self._job_key(job_id), self.result_ttl)
+        pipe.srem(self._running_key, job_id)
+        pipe.execute()
+
+    def _beat(self, job_id):
+        while True:
+            gevent.sleep(self.heartbeat_interval)
+            self._update(job_id, heartbeat=time.time())
+
+    def recover(self):
+        '''
+        queues again, at the front, the running jobs that stopped beating,
+        e.g. because their runner was killed. the ones already run
+        `max_attempts` times are failed instead
+
+        :return: ids of the jobs recovered
+        '''
+        recovered = []
+        now = time.time()
+        for job_id in self.r_server.smembers(self._running_key):
+            job = self.r_server.hgetall(self._job_key(job_id))
+            if job and now - float(job.get('heartbeat', 0)) < self.heartbeat_timeout:
+                continue
+            # another runner may be recovering it
+            if not self.r_server.srem(self._running_key, job_id) or not job:
+                continue
+            if int(job.get('attempts', 0)) >= self.max_attempts:
+                logger.error('job %s stopped while running, %s attempts made', job_id, job.get('attempts'))
+                self._update(job_id, status=JobStatus.FAILED, finished=now,
+                             error='stopped while running %s times' % job.get('attempts'))
+            else:
+                logger.warning('job %s stopped while running, queued again', job_id)
+                pipe = self.r_server.pipeline()
+                pipe.hset(self._job_key(job_id), mapping=dict(status=JobStatus.QUEUED,
+                                                              progress=0.,
+                                                              message=''))
+                pipe.expire(self._job_key(job_id), self.result_ttl)
+                pipe.lpush(self._queue_key, job_id)
+                pipe.execute()
+            recovered.append(job_id)
+        return recovered
+
+    def work(self, concurrency=2, context=None, poll_timeout=5, stop=None):
+        '''
+        runs the queued jobs, at most `concurrency` at a time, until `stop`
+        returns True. the jobs left running by a runner that stopped are
+        recovered at start, and every `heartbeat_timeout` seconds
+
+        :param context: callable returning the context manager the jobs run in
+        :param poll_timeout: seconds to wait for a job before checking `stop` again
+        '''
+        pool = Pool(concurrency)
+        recovered_at = 0
+        while stop is None or not stop():
+            if time.time() - recovered_at >= self.heartbeat_timeout:
+                self.recover()
+                recovered_at = time.time()
+            pool.wait_available()
+            item = self.r_server.blpop(self._queue_key, timeout=poll_timeout)
+            if item is None:
+                continue
+            pool.spawn(self.run, item[1], context)
+            # let the job start before waiting for the next one
+            gevent.sleep(0)
+        pool.join()
+
+    def info(self):
+        return dict(queued=self.r_server.llen(self._queue_key),
+                    running=self.r_server.scard(self._running_key),
+                    max_queued=self.max_queued,
+                    kinds=self.kinds)
@@ -0,0 +1,170 @@
+import glob
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+from gevent.lock import Semaphore
+
+__author__ = 'andreap'
+
+logger = logging.getLogger(__name__)
+
+
+class MappedLabels(object):
+    '''
+    read only key: label mapping on a memory mapped file, so that the
+    workers of a host share the same pages instead of holding a copy each.
+
+    the file has a header with the number of entries and the offset of each
+    of them, followed by the `key\\0label\\0` entries sorted by key: a lookup
+    is a binary search on the offsets
+    '''
+    MAGIC = 'LBL1'
+    _HEADER = struct.Struct('<4sI')
+    _OFFSET = struct.Struct('<I')
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._size = self._HEADER.unpack_from(self._mm, 0)
+        if magic != self.MAGIC:
+            raise ValueError('%s is not a label file' % filename)
+        self._data_start = self._HEADER.size + self._OFFSET.size * self._size
+
+    @classmethod
+    def write(cls, filename, labels):
+        '''
+        writes `labels` to `filename` atomically, readers see either the old
+        file or the complete new one
+        '''
+        items = sorted((unicode(k).encode('utf-8'), unicode(v).encode('utf-8')) for k, v in labels.items())
+        offsets = []
+        data = []
+        position = 0
+        for key, label in items:
+            entry = key + '\0' + label + '\0'
+            offsets.append(position)
+            data.append(entry)
+            position += len(entry)
+        fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename) or '.')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(cls._HEADER.pack(cls.MAGIC, len(items)))
+            f.write(''.join(cls._OFFSET.pack(o) for o in offsets))
+            f.write(''.join(data))
+        os.rename(tmp_filename, filename)
+
+    def _entry(self, i):
+        start = self._data_start + self._OFFSET.unpack_from(self._mm, self._HEADER.size + self._OFFSET.size * i)[0]
+        key_end = self._mm.find('\0', start)
+        return start, key_end
+
+    def get(self, key, default=None):
+        key = unicode(key).encode('utf-8')
+        lo, hi = 0, self._size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start, key_end = self._entry(mid)
+            mid_key = self._mm[start:key_end]
+            if mid_key < key:
+                lo = mid + 1
+            elif mid_key > key:
+                hi = mid
+            else:
+                label_end = self._mm.find('\0', key_end + 1)
+                return self._mm[key_end + 1:label_end].decode('utf-8')
+        return default
+
+    def __getitem__(self, key):
+        label = self.get(key)
+        if label is None:
+            raise KeyError(key)
+        return label
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return self._size
+
+
+class LabelIndex(object):
+    '''
+    small label sets that change only with the data, e.g. reactome pathway
+    names, loaded once per data version and kept in the process.
+
+    with a `path` the labels are written to memory mapped files there,
+    named after the data version, and the workers of the host load the file
+    the first of them wrote instead of querying elasticsearch each
+    '''
+
+    def __init__(self, get_version, path='', retry_interval=60):
+        '''
+        :param get_version: callable returning the version of the data, the
+            labels are loaded again when it changes
+        :param path: directory of the memory mapped files, in process
+            dictionaries if empty
+        :param retry_interval: seconds before loading labels that failed to load again
+        '''
+        self.get_version = get_version
+        self.path = path
+        self.retry_interval = retry_interval
+        self._loaders = {}
+        self._labels = {}
+        self._failed_at = {}
+        self._lock = Semaphore()
+
+    def add(self, name, loader):
+        '''
+        :param loader: callable returning a dict of key: label
+        '''
+        self._loaders[name] = loader
+
+    def get(self, name):
+        '''
+        :return: mapping of key: label, None if it cannot be loaded
+        '''
+        try:
+            version = self.get_version()
+        except Exception:
+            logger.exception('cannot get the data version of the %s labels', name)
+            return None
+        loaded = self._labels.get(name)
+        if loaded is not None and loaded[0] == version:
+            return loaded[1]
+        if time.time() - self._failed_at.get(name, 0) < self.retry_interval:
+            return None
+        with self._lock:
+            loaded = self._labels.get(name)
+            if loaded is not None and loaded[0] == version:
+                return loaded[1]
+            try:
+                labels = self._load(name, version)
+            except Exception:
+                logger.exception('cannot load the %s labels', name)
+                self._failed_at[name] = time.time()
+                return None
+            self._labels[name] = (version, labels)
+            self._failed_at.pop(name, None)
+            return labels
+
+    def _load(self, name, version):
+        if not self.path:
+            return self._loaders[name]()
+        filename = os.path.join(self.path, '%s-%s.labels' % (name, hashlib.md5(version).hexdigest()[:12]))
+        if not os.path.exists(filename):
+            MappedLabels.write(filename, self._loaders[name]())
+            for old_filename in glob.glob(os.path.join(self.path, '%s-*.labels' % name)):
+                if old_filename != filename:
+                    try:
+                        os.remove(old_filename)
+                    except OSError:
+                        pass
+        return MappedLabels(filename)
+
+    def info(self):
+        return dict((name, dict(version=version, labels=len(labels)))
+                    for name, (version, labels) in self._labels.items())
@@ -0,0 +1,113 @@
+import gc
+import logging
+import marshal
+from array import array
+
+__author__ = 'andreap'
+
+logger = logging.getLogger(__name__)
+
+
+class FrozenMap(object):
+    '''
+    read only mapping with string keys, held in two strings and two arrays
+    of offsets whatever its size.
+
+    a forked worker writes to the memory of every object it touches, to
+    update its reference count, so a big nested structure loaded in the
+    master ends up copied in each worker. here the keys and the marshalled
+    values are sorted in one string each and a lookup is a binary search on
+    the offsets: it touches no object of the mapping, the pages stay shared,
+    and every lookup returns a fresh copy that callers are free to change
+    '''
+
+    def __init__(self, mapping):
+        items = sorted((self._encode(k), marshal.dumps(v, 2)) for k, v in mapping.items())
+        self._key_offsets = array('L', [0])
+        self._value_offsets = array('L', [0])
+        for key, value in items:
+            self._key_offsets.append(self._key_offsets[-1] + len(key))
+            self._value_offsets.append(self._value_offsets[-1] + len(value))
+        self._keys = ''.join(k for k, _ in items)
+        self._values = ''.join(v for _, v in items)
+
+    @staticmethod
+    def _encode(key):
+        if isinstance(key, unicode):
+            return key.encode('utf-8')
+        return str(key)
+
+    def _key(self, i):
+        return self._keys[self._key_offsets[i]:self._key_offsets[i + 1]]
+
+    def _index(self, key):
+        key = self._encode(key)
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_key = self._key(mid)
+            if mid_key < key:
+                lo = mid + 1
+            elif mid_key > key:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def get(self, key, default=None):
+        i = self._index(key)
+        if i is None:
+            return default
+        return marshal.loads(self._values[self._value_offsets[i]:self._value_offsets[i + 1]])
+
+    def __getitem__(self, key):
+        i = self._index(key)
+        if i is None:
+            raise KeyError(key)
+        return marshal.loads(self._values[self._value_offsets[i]:self._value_offsets[i + 1]])
+
+    def __contains__(self, key):
+        return self._index(key) is not None
+
+    def __len__(self):
+        return len(self._key_offsets) - 1
+
+    def keys(self):
+        return [self._key(i).decode('utf-8') for i in range(len(self))]
+
+
+def freeze_shared_data(app):
+    '''
+    loads in the uwsgi master, before the workers are forked, the read only
+    data the workers would otherwise load each, and freezes it in forms
+    whose pages stay shared between them
+    '''
+    frozen = []
+    for name in ('ip_resolver', 'openapi'):
+        lazy = app.extensions.get(name)
+        if lazy is not None:
+            try:
+                lazy.get()
+                frozen.append(name)
+            except Exception:
+                logger.exception('cannot load %s before forking', name)
+    esquery = app.extensions.get('esquery')
+    if esquery is not None and esquery.tissue_map is not None:
+        esquery.tissue_map.freeze()
+        frozen.append('tissue_map')
+    if esquery is not None and esquery.association_matrix is not None:
+        # memory mapped, the workers share the pages of the files
+        try:
+            if esquery.association_matrix.get() is not None:
+                frozen.append('association_matrix')
+        except Exception:
+            logger.exception('cannot load the association matrix before forking')
+    datatypes = app.extensions.get('datatypes')
+    if datatypes is not None:
+        datatypes.freeze()
+        frozen.append('datatypes')
+    # the garbage collector writes to every object it tracks: start the
+    # workers with nothing left to collect from the loading
+    gc.collect()
+    logger.info('frozen before forking: %s', ', '.join(frozen))
+    return frozen
@@ -0,0 +1,172 @@
+import gzip
+import hashlib
+import time
+from datetime import datetime
+from io import BytesIO
+
+from flask import Response, g, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from app.common.cache import canonical_cache_key
+from app.common.response_templates import ResponseType
+from config import Config
+
+__author__ = 'andreap'
+
+
+def negotiated_type(accept_header):
+    '''
+    the ResponseType CTTVResponse picks for an Accept header, None if it
+    picks none
+    '''
+    accept_header = accept_header or ''
+    if 'application/json' in accept_header:
+        return ResponseType.JSON
+    elif "text/xml" in accept_header:
+        return ResponseType.XML
+    elif "text/tab-separated-values" in accept_header:
+        return ResponseType.TSV
+    elif "text/csv" in accept_header:
+        return ResponseType.CSV
+
+
+def gzip_compress(data, level=6):
+    buf = BytesIO()
+    with gzip.GzipFile(mode='wb', compresslevel=level, fileobj=buf) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def brotli_compress(data, level=9):
+    return brotli.compress(data, quality=level)
+
+
+class ResponseCache(object):
+    '''
+    caches the rendered body of the GET responses of the given paths, keyed
+    on path, query arguments and the format picked by the Accept header.
+    a cached response is sent without running the resource at all, or as a
+    304 if the client already has it, with the ETag and Last-Modified of
+    the response first rendered.
+
+    next to the body, the ones Flask-Compress would compress are stored
+    already compressed in each of `encodings`, and the variant sent is
+    negotiated on Accept-Encoding: compressing costs once per cached
+    response rather than once per request. the hooks have to be registered
+    after the ones of Flask-Compress, so that the responses are stored
+    before it compresses them, and after the other before_request hooks of
+    the app, that a cache hit would skip.
+    '''
+
+    def __init__(self, cache, paths=(), timeout=60 * 60, encodings=('br', 'gzip'), compress_level=6,
+                 br_level=9, compress_min_size=500, compress_mimetypes=()):
+        '''
+        :param cache: werkzeug like cache storing the responses
+        :param paths: prefixes of the cached paths, after the /platform api prefix
+        :param timeout: seconds a response is cached
+        :param encodings: content encodings stored, in order of preference
+            when the client accepts several with the same quality
+        :param compress_level: gzip compression level
+        :param br_level: brotli quality
+        :param compress_mimetypes: mimetypes of the bodies stored compressed
+        '''
+        self.cache = cache
+        self.paths = tuple(paths)
+        self.timeout = timeout
+        self.compressors = dict(gzip=lambda data: gzip_compress(data, compress_level))
+        if brotli is not None:
+            self.compressors['br'] = lambda data: brotli_compress(data, br_level)
+        self.encodings = [e for e in encodings if e in self.compressors]
+        self.compress_min_size = compress_min_size
+        self.compress_mimetypes = frozenset(compress_mimetypes)
+        self.hits = 0
+        self.not_modified = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.extensions['response_cache'] = self
+
+    def is_cacheable(self):
+        if request.method != 'GET' or Config.NO_CACHE_PARAMS in request.values:
+            return False
+        path = request.path.split('/platform', 1)[-1]
+        return path.startswith(self.paths)
+
+    def get_key(self):
+        return canonical_cache_key('response',
+                                   request.path,
+                                   sorted(request.args.lists()),
+                                   negotiated_type(request.headers.get('Accept')))
+
+    def before_request(self):
+        g.response_cache_key = None
+        if not self.is_cacheable():
+            return
+        key = self.get_key()
+        entry = self.cache.get(key)
+        if entry is None:
+            g.response_cache_key = key
+            self.misses += 1
+            return
+        resp = self.make_response(entry)
+        if resp.status_code == 304:
+            self.not_modified += 1
+        else:
+            self.hits += 1
+        return resp
+
+    def after_request(self, resp):
+        key = getattr(g, 'response_cache_key', None)
+        if key is None or \
+                resp.status_code != 200 or \
+                resp.is_streamed or \
+                resp.direct_passthrough or \
+                'Content-Encoding' in resp.headers or \
+                'Set-Cookie' in resp.headers:
+            return resp
+        entry = self.make_entry(resp)
+        self.cache.set(key, entry, timeout=self.timeout)
+        return self.make_response(entry)
+
+    def make_entry(self, resp):
+        body = resp.get_data()
+        entry = dict(etag=hashlib.md5(body).hexdigest(),
+                     last_modified=int(time.time()),
+                     mimetype=resp.mimetype,
+                     body=body,
+                     encodings={})
+        if resp.mimetype in self.compress_mimetypes and len(body) >= self.compress_min_size:
+            for encoding in self.encodings:
+                entry['encodings'][encoding] = self.compressors[encoding](body)
+        return entry
+
+    def make_response(self, entry):
+        '''
+        response for the current request from a cached entry
+        '''
+        body = entry['body']
+        etag = entry['etag']
+        resp = Response(mimetype=entry['mimetype'])
+        if entry['encodings']:
+            encoding = request.accept_encodings.best_match([e for e in self.encodings if e in entry['encodings']])
+            if encoding:
+                body = entry['encodings'][encoding]
+                resp.headers['Content-Encoding'] = encoding
+                # same validator Flask-Compress gives to compressed bodies
+                etag += ':' + encoding
+            resp.vary.add('Accept-Encoding')
+        resp.set_data(body)
+        resp.set_etag(etag)
+        resp.last_modified = datetime.utcfromtimestamp(entry['last_modified'])
+        return resp.make_conditional(request)
+
+    def info(self):
+        return dict(hits=self.hits,
+                    not_modified=self.not_modified,
+                    misses=self.misses)
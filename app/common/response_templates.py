@@ -97,7 +97,7 @@ class Association(object):
         self.search_metadata = {}
         self._scoring_method = scoring_method
         if datatypes is None:
-            datatypes = DataTypes(current_app)
+            datatypes = current_app.extensions.get('datatypes') or DataTypes(current_app)
         self._datatypes = datatypes
         self.hit_source = {}
         if '_source' in hit:
@@ -1,11 +1,11 @@
-import collections
-import json
 import sys
 from io import BytesIO
 
 import unicodecsv as csv
 from dicttoxml import dicttoxml
 
+from app.common.codecs import get_json_codec
+from app.common.flattener import Flattener, get_flattener
 from app.common.request_templates import SourceDataStructureOptions
 from app.common.response_templates import ResponseType
 from config import Config
@@ -17,6 +17,9 @@ __author__ = 'andreap'
 
 class Result(object):
     format = ResponseType.JSON
+    NOT_ALLOWED_FIELDS = ['evidence.evidence_chain', 'search_metadata', 'search_metadata.sort']
+    # encoder of the json responses, see app.common.codecs. set from the app config by create_app
+    json_codec = get_json_codec(Config.JSON_ENCODER, Config.JSON_DOUBLE_PRECISION)
 
     def __init__(self,
                  res,
@@ -60,92 +63,51 @@ class Result(object):
             return self.toCSV(delimiter=',')
 
     def toJSON(self):
-        return json.dumps(self.toDict())
+        return self.json_codec.dumps(self.toDict())
 
     def toXML(self):
         return dicttoxml(self.toDict(), custom_root='cttv-api-result')
 
     def toCSV(self, delimiter = '\t'):
-        NOT_ALLOWED_FIELDS = ['evidence.evidence_chain', 'search_metadata', 'search_metadata.sort']
         output = BytesIO()
         if not self.data:
-            self.flatten(self.toDict())  # populate data if empty
+            self.toDict()  # populate data if empty
+        writer = csv.writer(output,
+                            delimiter=delimiter,
+                            quotechar='"',
+                            quoting=csv.QUOTE_MINIMAL,
+                            doublequote=False,
+                            escapechar='\\',
+                            )
         if self.data and isinstance(self.data[0], dict):
-            key_set = set()
-            flattened_data = []
-            for row in self.data:
-                flat = self.flatten(row,
-                                    simplify=self.params.datastructure == SourceDataStructureOptions.SIMPLE)
-                for field in NOT_ALLOWED_FIELDS:
-                    flat.pop(field, None)
-                flattened_data.append(flat)
-                key_set.update(flat.keys())
-            ordered_keys=self.params.fields or sorted(list(key_set))
-            ordered_keys = map(unicode,ordered_keys)
-
-            writer = csv.DictWriter(output,
-                                    ordered_keys,
-                                    restval='',
-                                    delimiter=delimiter,
-                                    quotechar='"',
-                                    quoting=csv.QUOTE_MINIMAL,
-                                    doublequote=False,
-                                    escapechar='\\',
-                                    # extrasaction='ignore',
-                                    )
-            writer.writeheader()
-            for row in flattened_data:
-                writer.writerow(row)
+            flattener = get_flattener(self.params.fields,
+                                      simplify=self.params.datastructure == SourceDataStructureOptions.SIMPLE,
+                                      exclude=self.NOT_ALLOWED_FIELDS)
+            if flattener.fields:
+                # columns known in advance, single pass
+                writer.writerow(flattener.fields)
+                for row in self.data:
+                    writer.writerow(flattener.row(row))
+            else:
+                # the columns are the leaves of all the rows, flatten them all before the header
+                flattened_data = []
+                key_set = set()
+                for row in self.data:
+                    flat = flattener.flatten(row)
+                    flattened_data.append(flat)
+                    key_set.update(flat)
+                ordered_keys = sorted(key_set)
+                writer.writerow(ordered_keys)
+                for flat in flattened_data:
+                    writer.writerow([flat.get(k, '') for k in ordered_keys])
 
         if self.data and isinstance(self.data[0], list):
-            writer = csv.writer(output,
-                                delimiter=delimiter,
-                                quotechar='"',
-                                quoting=csv.QUOTE_MINIMAL,
-                                doublequote=False,
-                                escapechar='\\',
-                                # extrasaction = 'ignore',
-                                )
             for row in self.data:
                 writer.writerow(row)
         return output.getvalue()
 
     def flatten(self, d, parent_key='', sep='.', simplify=False):
-        items = []
-        for k, v in d.items():
-            new_key = parent_key + sep + k if parent_key else k
-            if isinstance(v, collections.MutableMapping):
-                items.extend(self.flatten(v, new_key, sep=sep).items())
-            else:
-                items.append((new_key, v))
-        return_dict = collections.OrderedDict()
-        for k, v in items:
-            if isinstance(v, list):
-                try:
-                    v = '|'.join(v).encode('utf-8')
-                except:
-                    if len(v) == 1:
-                        v = v[0]
-                    else:
-                        v = json.dumps(v, encoding='utf-8')
-            if isinstance(v, str):
-                try:
-                    v= unicode(v)
-                except UnicodeDecodeError:
-                    pass
-            if not isinstance(v, unicode):
-                v= json.dumps(v, encoding='utf-8')
-            return_dict[unicode(k)] = unicode(v)
-        if simplify:
-            for k, v in items:
-                try:
-                    if v.startswith("http://identifiers.org/") or \
-                            k.startswith("biological_object.properties."):
-                        return_dict.pop(k)
-                except:
-                    pass
-
-        return return_dict
+        return Flattener(simplify=simplify, sep=sep).flatten(d, parent_key)
 
 
 class PaginatedResult(Result):
@@ -251,16 +213,18 @@ class SimpleResult(Result):
         return toReturn
 
 class RawResult(Result):
-    ''' just need res to be passed and it will be returned as it is
+    ''' just need res to be passed and it will be returned as it is.
+    a json string, e.g. one read from the cache, is sent without being
+    decoded and encoded again
     '''
 
     def toDict(self):
         if isinstance(self.res, dict):
             return self.res
-        return json.loads(self.res)
+        return self.json_codec.loads(self.res)
     def toJSON(self):
         if isinstance(self.res, dict):
-            return json.dumps(self.res)
+            return self.json_codec.dumps(self.res)
         return self.res
 
 class EmptySimpleResult(Result):
@@ -0,0 +1,64 @@
+import time
+from collections import OrderedDict
+
+from gevent.lock import Semaphore
+
+__author__ = 'andreap'
+
+
+class StartupProfile(object):
+    '''
+    time spent in each stage of the app initialisation. call `mark` at the
+    end of each stage
+    '''
+
+    def __init__(self):
+        self.started_at = self._last = time.time()
+        self.stages = OrderedDict()
+
+    def mark(self, stage):
+        '''
+        :param stage: name of the stage that just finished
+        '''
+        now = time.time()
+        self.stages[stage] = self.stages.get(stage, 0.) + now - self._last
+        self._last = now
+
+    @property
+    def total(self):
+        return sum(self.stages.values())
+
+    def report(self):
+        '''
+        :return: text table of the stages, slowest first
+        '''
+        lines = ['%-30s %10s %6s' % ('stage', 'ms', '%')]
+        total = self.total or 1.
+        for stage, seconds in sorted(self.stages.items(), key=lambda i: i[1], reverse=True):
+            lines.append('%-30s %10.1f %6.1f' % (stage, 1000 * seconds, 100 * seconds / total))
+        lines.append('%-30s %10.1f' % ('total', 1000 * self.total))
+        return '\n'.join(lines)
+
+
+class Lazy(object):
+    '''
+    value built the first time it is needed rather than at startup
+    '''
+
+    def __init__(self, func):
+        self.func = func
+        self._lock = Semaphore()
+        self._loaded = False
+        self._value = None
+
+    def get(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self._value = self.func()
+                    self._loaded = True
+        return self._value
+
+    @property
+    def loaded(self):
+        return self._loaded
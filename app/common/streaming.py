@@ -0,0 +1,102 @@
+import json
+from io import BytesIO
+
+import unicodecsv as csv
+from flask import Response, request, stream_with_context
+from flask_restful import abort
+
+from app.common.flattener import get_flattener
+from app.common.response_templates import ResponseType
+from app.common.results import Result
+
+__author__ = 'andreap'
+
+
+'''size in bytes of the chunks sent to the client'''
+CHUNK_SIZE = 64 * 1024
+
+
+def ndjson_rows(rows):
+    '''
+    one json document per line
+    '''
+    buffer = []
+    buffered = 0
+    for row in rows:
+        line = json.dumps(row) + '\n'
+        buffer.append(line)
+        buffered += len(line)
+        if buffered >= CHUNK_SIZE:
+            yield ''.join(buffer)
+            buffer = []
+            buffered = 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+def csv_rows(rows, delimiter='\t', fields=None, simplify=False):
+    '''
+    flattens and writes each row as it comes, holding at most a chunk in
+    memory. since the rows are not known in advance, the columns are
+    `fields` or the ones of the first row: keys missing from it are dropped
+    '''
+    flattener = get_flattener(fields, simplify=simplify, exclude=Result.NOT_ALLOWED_FIELDS)
+    output = BytesIO()
+    writer = None
+    columns = None
+    for row in rows:
+        if writer is None:
+            writer = csv.writer(output,
+                                delimiter=delimiter,
+                                quotechar='"',
+                                quoting=csv.QUOTE_MINIMAL,
+                                doublequote=False,
+                                escapechar='\\',
+                                )
+            if not flattener.fields:
+                columns = sorted(flattener.flatten(row).keys())
+            writer.writerow(flattener.fields or columns)
+        if flattener.fields:
+            writer.writerow(flattener.row(row))
+        else:
+            flat = flattener.flatten(row)
+            writer.writerow([flat.get(k, u'') for k in columns])
+        if output.tell() >= CHUNK_SIZE:
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate()
+    if output.tell():
+        yield output.getvalue()
+
+
+def streamed_response(rows, type=None, fields=None, simplify=False, filename='data'):
+    '''
+    sends the rows with chunked transfer encoding as they are produced,
+    rather than rendering a whole Result
+
+    :param rows: iterable of dicts, usually a generator walking elasticsearch
+    :param type: value of ResponseType, json is sent as newline delimited json.
+        negotiated on the Accept header if None
+    :param fields: columns of tab and csv exports
+    '''
+    accept_header = request.headers.get('Accept') or ''
+    if type is None:
+        if "text/tab-separated-values" in accept_header:
+            type = ResponseType.TSV
+        elif "text/csv" in accept_header:
+            type = ResponseType.CSV
+        else:
+            type = ResponseType.JSON
+
+    if type == ResponseType.JSON:
+        body, mimetype, extension = ndjson_rows(rows), 'application/x-ndjson', 'ndjson'
+    elif type == ResponseType.TSV:
+        body, mimetype, extension = csv_rows(rows, '\t', fields, simplify), 'text/tab-separated-values', 'tsv'
+    elif type == ResponseType.CSV:
+        body, mimetype, extension = csv_rows(rows, ',', fields, simplify), 'text/csv', 'csv'
+    else:
+        abort(400, message='format %s cannot be streamed, use json, tab or csv' % type)
+
+    resp = Response(stream_with_context(body), mimetype=mimetype)
+    resp.headers['Content-Disposition'] = 'attachment; filename=%s.%s' % (filename, extension)
+    return resp
@@ -0,0 +1,121 @@
+import json
+import logging
+import os
+import tempfile
+import time
+
+from gevent.lock import Semaphore
+
+from app.common import url_to_tmpfile
+from app.common.prefork import FrozenMap
+
+__author__ = 'andreap'
+
+logger = logging.getLogger(__name__)
+
+
+class TissueMap(object):
+    '''
+    efo code: tissue index of the expression hierarchy, used to add the
+    tissue details to the expression facets.
+
+    the map is downloaded once per data version to a local file shared by
+    the workers, and read from it the first time a worker needs it: startup
+    does not depend on github. `manage.py fetch_tissue_map` downloads it at
+    deploy time
+    '''
+
+    def __init__(self, url_template, data_version, path, retry_interval=60):
+        '''
+        :param url_template: url of the map, formatted with the data version
+            tag of the expression hierarchy repository
+        :param path: directory of the local copies
+        :param retry_interval: seconds before trying to load a map that failed to load again
+        '''
+        self.url_template = url_template
+        self.data_version = data_version
+        self.path = path
+        self.retry_interval = retry_interval
+        self._codes = None
+        self._failed_at = 0
+        self._lock = Semaphore()
+
+    MASTER = 'master'
+
+    @property
+    def filename(self):
+        return self._filename(self.data_version)
+
+    def _filename(self, version):
+        return os.path.join(self.path, 'api_tissue_map_%s.json' % version)
+
+    def fetch(self):
+        '''
+        downloads the map of the data version, or the one on master if there
+        is none, unless it is already there. the one on master is stored
+        apart, the map of the data version is tried again at the next fetch
+
+        :return: name of the local file
+        '''
+        if os.path.exists(self.filename):
+            return self.filename
+        try:
+            url = self.url_template.format(self.data_version)
+            filename = self._download(url, self.filename)
+        except Exception:
+            url = self.url_template.format(self.MASTER)
+            logger.warning('cannot get the tissue map for data version %s, getting it from %s',
+                           self.data_version, url)
+            filename = self._download(url, self._filename(self.MASTER))
+        logger.info('tissue map for data version %s downloaded from %s', self.data_version, url)
+        return filename
+
+    def _download(self, url, filename):
+        with url_to_tmpfile(url) as r_file:
+            tissues = json.load(r_file)['tissues']
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        fd, tmp_filename = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'tissues': tissues}, f)
+        # other workers see the whole file or none
+        os.rename(tmp_filename, filename)
+        return filename
+
+    def load(self):
+        with open(self.fetch()) as f:
+            tissues = json.load(f)['tissues']
+        return dict((v['efo_code'], v) for v in tissues.itervalues())
+
+    @property
+    def codes(self):
+        '''
+        :return: mapping of efo code: tissue, empty if the map cannot be loaded
+        '''
+        if self._codes is not None:
+            return self._codes
+        if time.time() - self._failed_at < self.retry_interval:
+            return {}
+        with self._lock:
+            if self._codes is None:
+                try:
+                    self._codes = self.load()
+                except Exception:
+                    logger.exception('cannot load the tissue map')
+                    self._failed_at = time.time()
+                    return {}
+        return self._codes
+
+    def get(self, code, default=None):
+        return self.codes.get(code, default)
+
+    def freeze(self):
+        '''
+        loads the map in a FrozenMap that forked workers share. only a map
+        already downloaded is loaded, this does not wait for github
+        '''
+        if self._codes is None and not os.path.exists(self.filename):
+            return
+        codes = self.codes
+        if codes and not isinstance(codes, FrozenMap):
+            self._codes = FrozenMap(codes)
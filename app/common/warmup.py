@@ -0,0 +1,111 @@
+import re
+import time
+from collections import Counter
+
+from gevent.pool import Pool
+
+__author__ = 'andreap'
+
+
+class TrafficRecorder(object):
+    '''
+    counts the requests served for the given paths in a redis sorted set, to
+    replay the most frequent ones once the cache is invalidated.
+
+    the service redis is not persisted, so the recorded traffic survives a
+    data release (cache generation bump) but not a redeploy: use an access
+    log for the latter
+    '''
+    KEY = 'CTTV_REST_API_TRAFFIC'
+
+    def __init__(self, r_server, paths=(), max_keys=10000, trim_every=1000):
+        '''
+        :param r_server: redis connection
+        :param paths: only requests to paths containing one of these are recorded
+        :param max_keys: number of most frequent requests kept
+        :param trim_every: number of recorded requests between trims of the set
+        '''
+        self.r_server = r_server
+        self.paths = tuple(paths)
+        self.max_keys = max_keys
+        self.trim_every = trim_every
+        self._recorded = 0
+
+    def should_record(self, path):
+        return any(p in path for p in self.paths)
+
+    def record(self, full_path):
+        self.r_server.zincrby(self.KEY, 1, full_path)
+        self._recorded += 1
+        if self._recorded % self.trim_every == 0:
+            self.r_server.zremrangebyrank(self.KEY, 0, -self.max_keys - 1)
+
+    def top(self, n):
+        '''
+        :return: list of (full path, count) tuples, most frequent first
+        '''
+        return [(k, int(v)) for k, v in self.r_server.zrevrange(self.KEY, 0, n - 1, withscores=True)]
+
+    def total(self):
+        return int(sum(v for _, v in self.r_server.zrange(self.KEY, 0, -1, withscores=True)))
+
+
+_ACCESS_LOG_REQUEST = re.compile(r'"GET (\S+) HTTP/[\d.]+"')
+
+
+def read_access_log(filename, paths=()):
+    '''
+    counts the GET requests in an access log in the common/combined format,
+    as written by nginx or by uwsgi with `--log-format`
+
+    :return: Counter of full paths
+    '''
+    counter = Counter()
+    with open(filename) as log:
+        for line in log:
+            match = _ACCESS_LOG_REQUEST.search(line)
+            if match and (not paths or any(p in match.group(1) for p in paths)):
+                counter[match.group(1)] += 1
+    return counter
+
+
+def warm_up(client, requests, total=None, concurrency=8, timeout=300):
+    '''
+    replays requests against the application to fill the cache
+
+    :param client: flask test client of the application
+    :param requests: list of (full path, count) tuples
+    :param total: number of recorded requests `requests` was taken from, to
+        compute the share of the traffic covered
+    :param concurrency: maximum number of requests run at the same time
+    :param timeout: seconds allowed for each request
+    :return: dict with the warm-up report
+    '''
+    pool = Pool(concurrency)
+    failed = []
+    replayed = set()
+
+    def replay(full_path):
+        try:
+            response = client.get(full_path)
+            if response.status_code != 200:
+                failed.append((full_path, response.status_code))
+        except Exception as e:
+            failed.append((full_path, str(e)))
+        replayed.add(full_path)
+
+    start_time = time.time()
+    for full_path, _ in requests:
+        pool.spawn(replay, full_path)
+    pool.join(timeout=timeout * len(requests) / float(concurrency) if requests else 0)
+    pool.kill()
+    failed.extend((full_path, 'timeout') for full_path, _ in requests if full_path not in replayed)
+
+    failed_paths = set(path for path, _ in failed)
+    warmed = sum(count for full_path, count in requests if full_path not in failed_paths)
+    recorded = total or sum(count for _, count in requests)
+    return dict(requests=len(requests),
+                failed=len(failed_paths),
+                errors=failed[:10],
+                seconds=time.time() - start_time,
+                coverage=float(warmed) / recorded if recorded else 0.)
@@ -7,6 +7,7 @@ from flask_restful import abort, fields
 from flask_restful import reqparse, Resource
 from app.common.request_templates import FilterTypes
 from app.common.response_templates import CTTVResponse
+from app.common.streaming import streamed_response
 from types import *
 import time
 
@@ -75,10 +76,15 @@ class FilterBy(Resource):
         parser.add_argument('sort', type=str,  required=False, action='append',)
         parser.add_argument('search', type=str,  required=False, )
         parser.add_argument('cap_scores', type=boolean, required=False, )
+        parser.add_argument('stream', type=boolean, required=False, default=False,
+                            help="stream all the matching associations as ndjson, tab or csv, ignoring size and from")
 
         args = parser.parse_args()
         self.remove_empty_params(args)
 
+        if args.pop('stream', False):
+            return self.stream_association(params=args)
+
         data = self.get_association(params=args)
 
         return CTTVResponse.OK(data)
@@ -95,6 +101,9 @@ class FilterBy(Resource):
         args = request.get_json(force=True)
         self.remove_empty_params(args)
 
+        if args.pop('stream', False):
+            return self.stream_association(params=args)
+
         data = self.get_association(params=args)
         format = None
         if('format' in args):
@@ -112,6 +121,18 @@ class FilterBy(Resource):
 
         return res
 
+    def stream_association(self, params):
+        es = current_app.extensions['esquery']
+        format = params.pop('format', None)
+        try:
+            rows = es.iter_associations(page_size=current_app.config['STREAM_PAGE_SIZE'], **params)
+        except AttributeError as e:
+            abort(404, message=e.message)
+
+        return streamed_response(rows, format,
+                                 fields=params.get('fields'),
+                                 filename='associations')
+
     def remove_empty_params(self,args):
         for k,v in args.items():
             if isinstance(v, list):
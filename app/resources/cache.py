@@ -4,11 +4,28 @@ __author__ = 'andreap'
 from flask import current_app
 from flask_restful import Resource
 
-
+from app.common.response_templates import CTTVResponse
+from app.common.results import SimpleResult
 
 
 class ClearCache(Resource):
-    ''' clear the aplication cache
+    ''' clear the aplication cache, and move all the workers to a new
+    generation of the elasticsearch response cache
     '''
     def get(self ):
-        return current_app.cache.clear()
+        current_app.cache.clear()
+        es = current_app.extensions['esquery']
+        generation = es.cache.bump_generation()
+        return CTTVResponse.OK(SimpleResult(None, data=dict(generation=generation)))
+
+
+class CacheStatistics(Resource):
+    ''' hit and miss counters of the elasticsearch response, application
+    and rendered response caches, and the labels loaded, for this worker
+    '''
+    def get(self):
+        es = current_app.extensions['esquery']
+        return CTTVResponse.OK(SimpleResult(None, data=dict(elasticsearch=es.cache.info(),
+                                                            application=current_app.cache.info(),
+                                                            responses=current_app.extensions['response_cache'].info(),
+                                                            labels=es.labels.info())))
@@ -1,4 +1,3 @@
-import json
 from app.common.response_templates import CTTVResponse
 from app.common.results import RawResult
 
@@ -18,11 +17,9 @@ class EfoLabelFromCode(Resource):
         '''
         start_time = time.time()
         es = current_app.extensions['esquery']
-        res = es.get_efo_info_from_code(disease_id)
-        if res:
-            data = res.toDict()['data']
-            if data:
-                return CTTVResponse.OK(RawResult(json.dumps(data[0])),
+        data = es.get_efo_info_json(disease_id)
+        if data:
+            return CTTVResponse.OK(RawResult(data),
                                    took=time.time() - start_time)
         else:
             abort(404, message="EFO code %s cannot be found"%disease_id)
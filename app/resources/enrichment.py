@@ -3,6 +3,7 @@ from app.common import boilerplate
 from flask import current_app, request
 
 from flask_restful import reqparse, Resource, abort
+from app.common.hypergeometric import CORRECTIONS, PValueCorrections
 from app.common.response_templates import CTTVResponse
 from types import *
 
@@ -18,6 +19,8 @@ class EnrichmentTargets(Resource):
     parser.add_argument('pvalue', type=float, required=False, default=0.001)
     parser.add_argument('from', type=int, required=False, default=0)
     parser.add_argument('size', type=int, required=False, default=10)
+    parser.add_argument('correction', type=str, required=False, default=PValueCorrections.NONE,
+                        choices=CORRECTIONS.keys())
 
     def get(self):
         """
@@ -30,7 +33,8 @@ class EnrichmentTargets(Resource):
         return self.get_enrichment_for_targets(args['target'],
                                                args['pvalue'],
                                                args['from'],
-                                               args['size'])
+                                               args['size'],
+                                               args['correction'])
 
 
     def post(self ):
@@ -43,24 +47,30 @@ class EnrichmentTargets(Resource):
         self.remove_empty_params(args)
         if len(args['target']) > MAX_ELEMENT_SIZE:
             abort(404, message='maximum number of targets allowed is %i' % MAX_ELEMENT_SIZE)
+        correction = args.get('correction', PValueCorrections.NONE)
+        if correction not in CORRECTIONS:
+            abort(400, message='correction must be one of %s' % ', '.join(sorted(CORRECTIONS)))
 
         return self.get_enrichment_for_targets(args['target'],
                                                args['pvalue'],
                                                args['from'],
-                                               args['size'])
+                                               args['size'],
+                                               correction)
 
 
     def get_enrichment_for_targets(self,
                                    targets,
                                    pvalue,
                                    from_,
-                                   size):
+                                   size,
+                                   correction):
         es = current_app.extensions['esquery']
 
         res = es.get_enrichment_for_targets(targets,
                                             pvalue_threshold=pvalue,
                                             from_=from_,
-                                            size=size)
+                                            size=size,
+                                            correction=correction)
         if not res:
             abort(404, message='Cannot find diseases for targets %s'%str(targets))
         return CTTVResponse.OK(res)
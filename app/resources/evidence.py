@@ -8,7 +8,9 @@ from flask import current_app, request
 
 from flask_restful import reqparse, Resource
 from app.common.boilerplate import Paginable
+from app.common.request_templates import SourceDataStructureOptions
 from app.common.response_templates import CTTVResponse
+from app.common.streaming import streamed_response
 from app.common.utils import fix_empty_strings
 
 # @swagger.model
@@ -109,6 +111,8 @@ class FilterBy(Resource, Paginable):
         parser.add_argument('begin', type=long, required=False, help="filter by range with this start")
         parser.add_argument('end', type=long, required=False, help="filter by range with this end")
         parser.add_argument('chromosome', type=str, required=False, help="filter by range required chromosome location")
+        parser.add_argument('stream', type=boolean, required=False, default=False,
+                            help="stream all the matching evidence as ndjson, tab or csv, ignoring size and from")
 
         args = parser.parse_args()
         targets = args.pop('target',[]) or []
@@ -128,6 +132,8 @@ class FilterBy(Resource, Paginable):
         #         or args['uniprotkw']
         #         or args['datatype']):
         #     abort(404, message='Please provide at least one gene, efo, eco or datasource')
+        if args.pop('stream', False):
+            return self.stream_evidence(targets, diseases, evidence_types, datasources, datatypes, params=args)
         data = self.get_evidence(targets, diseases, evidence_types, datasources,  datatypes, params=args)
         return CTTVResponse.OK(data,
                               )
@@ -150,6 +156,8 @@ class FilterBy(Resource, Paginable):
         if args.get('sort') is None:
             args['sort'] = [EvidenceSortOptions.SCORE]
 
+        if args.pop('stream', False):
+            return self.stream_evidence(targets, diseases, evidence_types, datasources, datatypes, params=args)
 
         data=self.get_evidence(targets, diseases, evidence_types, datasources, datatypes, params=args)
         return CTTVResponse.OK(data,
@@ -182,4 +190,25 @@ class FilterBy(Resource, Paginable):
 
         return res
 
+    def stream_evidence(self,
+                        targets,
+                        diseases,
+                        evidence_types,
+                        datasources,
+                        datatype,
+                        params={}):
 
+        es = current_app.extensions['esquery']
+        format = params.pop('format', None)
+        rows = es.iter_evidence(targets=targets,
+                                diseases=diseases,
+                                evidence_types=evidence_types,
+                                datasources=datasources,
+                                datatypes=datatype,
+                                page_size=current_app.config['STREAM_PAGE_SIZE'],
+                                **params)
+
+        return streamed_response(rows, format,
+                                 fields=params.get('fields'),
+                                 simplify=params.get('datastructure') == SourceDataStructureOptions.SIMPLE,
+                                 filename='evidence')
@@ -0,0 +1,140 @@
+__author__ = 'andreap'
+
+from flask import current_app, request, url_for
+from flask_restful import Resource, abort
+
+from app.common.hypergeometric import CORRECTIONS, PValueCorrections
+from app.common.jobs import JobStatus, QueueFull
+from app.common.response_templates import CTTVResponse
+from app.common.results import RawResult, SimpleResult
+from app.resources.enrichment import MAX_ELEMENT_SIZE
+
+
+def _list_param(params, name):
+    values = params.get(name) or []
+    if isinstance(values, basestring):
+        values = [values]
+    return [v for v in values if v != '']
+
+
+def _number_param(params, name, type, default):
+    '''
+    :raise ValueError: if the value is not a non negative number of `type`
+    '''
+    value = params.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        if isinstance(value, bool):
+            raise TypeError
+        number = type(value)
+    except (TypeError, ValueError):
+        raise ValueError('%s must be a number, not %r' % (name, value))
+    if number < 0:
+        raise ValueError('%s must not be negative' % name)
+    return number
+
+
+def validate_enrichment(params):
+    targets = _list_param(params, 'target')
+    if not targets:
+        raise ValueError('target is required')
+    if len(targets) > MAX_ELEMENT_SIZE:
+        raise ValueError('maximum number of targets allowed is %i' % MAX_ELEMENT_SIZE)
+    correction = params.get('correction') or PValueCorrections.NONE
+    if correction not in CORRECTIONS:
+        raise ValueError('correction must be one of %s' % ', '.join(sorted(CORRECTIONS)))
+    return {'target': targets,
+            'pvalue': _number_param(params, 'pvalue', float, 0.001),
+            'from': _number_param(params, 'from', int, 0),
+            'size': _number_param(params, 'size', int, 10),
+            'correction': correction}
+
+
+def run_enrichment(params, progress):
+    es = current_app.extensions['esquery']
+    return es.get_enrichment_for_targets(params['target'],
+                                         pvalue_threshold=params['pvalue'],
+                                         from_=params['from'],
+                                         size=params['size'],
+                                         correction=params['correction'],
+                                         progress=progress)
+
+
+def validate_known_drug(params):
+    targets, diseases = _list_param(params, 'target'), _list_param(params, 'disease')
+    if not targets and not diseases:
+        raise ValueError('target or disease is required')
+    return {'target': targets, 'disease': diseases}
+
+
+def run_known_drug(params, progress):
+    es = current_app.extensions['esquery']
+    return es.get_evidence_known_drug(params['target'] or None,
+                                      params['disease'] or None)
+
+
+def register_jobs(queue):
+    '''
+    the requests that can be run as background jobs, with the parameters of
+    their endpoint
+    '''
+    queue.register('enrichment', run_enrichment, validate_enrichment)
+    queue.register('known_drug', run_known_drug, validate_known_drug)
+
+
+class Jobs(Resource):
+    ''' submit a long running request, e.g. the enrichment of a large
+    target set, to be run in the background. the job id returned is polled
+    for its progress and result
+    '''
+
+    def post(self):
+        args = request.get_json(force=True)
+        if not isinstance(args, dict) or 'kind' not in args:
+            abort(400, message='kind is required')
+        params = args.get('params') or {}
+        if not isinstance(params, dict):
+            abort(400, message='params must be an object')
+        queue = current_app.extensions['jobs']
+        try:
+            job = queue.submit(args['kind'], params)
+        except ValueError as e:
+            abort(400, message=str(e))
+        except QueueFull as e:
+            abort(503, message=str(e))
+        resp = CTTVResponse.OK(SimpleResult(None, data=job))
+        resp.status_code = 202
+        resp.headers['Location'] = url_for('.job', job_id=job['id'])
+        return resp
+
+    def get(self):
+        return CTTVResponse.OK(SimpleResult(None, data=current_app.extensions['jobs'].info()))
+
+
+class Job(Resource):
+    ''' status and progress of a job
+    '''
+
+    def get(self, job_id):
+        job = current_app.extensions['jobs'].get(job_id)
+        if job is None:
+            abort(404, message='job %s not found, or expired' % job_id)
+        return CTTVResponse.OK(SimpleResult(None, data=job))
+
+
+class JobResult(Resource):
+    ''' result of a job that is done, as its endpoint would have returned it
+    '''
+
+    def get(self, job_id):
+        queue = current_app.extensions['jobs']
+        job = queue.get(job_id)
+        if job is None:
+            abort(404, message='job %s not found, or expired' % job_id)
+        if job['status'] == JobStatus.FAILED:
+            abort(500, message='job %s failed: %s' % (job_id, job.get('error', '')))
+        result = queue.get_result(job_id) if job['status'] == JobStatus.DONE else None
+        if result is None:
+            abort(409, message='job %s is %s, %i%% done' % (job_id, job['status'], int(100 * job['progress'])))
+        return CTTVResponse.OK(RawResult(result))
@@ -1,6 +1,5 @@
 from app.common import boilerplate
 
-import json
 from flask import request
 from flask import current_app
 
@@ -58,11 +57,9 @@ class TargetInfoSingle(Resource):
         Returns general information of a target
         """
         es = current_app.extensions['esquery']
-        res = es.get_gene_info([target_id])
-        if res:
-            data = res.toDict()['data']
-            if data:
-                return CTTVResponse.OK(RawResult(json.dumps(data[0])))
+        data = es.get_gene_info_json(target_id)
+        if data:
+            return CTTVResponse.OK(RawResult(data))
 
         abort(404, message="Gene id %s cannot be found" % target_id)
 
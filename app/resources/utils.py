@@ -30,7 +30,7 @@ class LogEvent(Resource):
         mpstore = current_app.extensions['mp_access_store']
         args = self.parser.parse_args()
         event = args['event'][:120]
-        ip_resolver = current_app.config['IP_RESOLVER']
+        ip_resolver = current_app.extensions['ip_resolver'].get()
         ip = request.remote_addr
         ip_net = IPNetwork(ip)
         resolved_org = ip_resolver['default']
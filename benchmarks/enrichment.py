@@ -0,0 +1,141 @@
+'''
+time to group the association hits of a target set by disease and compute
+the hypergeometric p-value of each disease, at 10, 100 and 1000 targets,
+with the per hit jmespath grouping and per disease scipy calls of the
+legacy code (scoring with the point probability rather than the upper
+tail), with the vectorised pipeline, and with the vectorised pipeline
+reading the rows of the targets from an AssociationMatrix. the
+elasticsearch scroll the first two need is left out: their hits are
+synthetic and built before timing, while the matrix timing includes
+building the association records from the rows.
+
+    python -m benchmarks.enrichment
+'''
+import gc
+import random
+import shutil
+import tempfile
+import time
+
+import jmespath
+from scipy.stats import hypergeom
+
+from app.common.enrichment import AssociationMatrix, DiseaseGroups, enrichment_results
+from app.common.response_templates import Association
+
+__author__ = 'andreap'
+
+
+ALL_TARGETS = 20000
+DISEASES = 10000
+ASSOCIATIONS_PER_TARGET = 200
+TARGET_SET_SIZES = (10, 100, 1000)
+
+
+def make_background(diseases=DISEASES):
+    rnd = random.Random(0)
+    return dict(('EFO_%07i' % i, dict(id='EFO_%07i' % i,
+                                      label='disease %i' % i,
+                                      association_counts=dict(total=rnd.randint(1000, 5000))))
+                for i in range(diseases))
+
+
+def make_hits(targets, diseases=DISEASES, associations=ASSOCIATIONS_PER_TARGET):
+    hits = []
+    for t in range(targets):
+        # the same associations for a target whatever the size of the set
+        rnd = random.Random(t)
+        # a few diseases get most of the associations
+        for d in set(int(rnd.paretovariate(0.5)) % diseases for _ in range(associations)):
+            hits.append({'_source': {
+                'target': dict(id='ENSG%011i' % t, gene_info=dict(symbol='GENE%i' % t)),
+                'harmonic-sum': dict(overall=rnd.random(), datatypes=dict(literature=rnd.random())),
+                'disease': dict(id='EFO_%07i' % d,
+                                efo_info=dict(label='disease %i' % d,
+                                              therapeutic_area=dict(codes=['EFO_0000001'], labels=['area'])))}})
+    return hits
+
+
+def legacy_enrichment(hits, background, N, M):
+    disease_data = {}
+    for a in hits:
+        disease_id = jmespath.search('_source.disease.id', a)
+        if disease_id not in disease_data:
+            disease_data[disease_id] = []
+        disease_data[disease_id].append(a)
+    score_cache = {}
+    data = []
+    for disease_id, disease_targets in disease_data.items():
+        k = background[disease_id]["association_counts"]["total"]
+        x = len(disease_targets)
+        key = '_'.join(map(str, [N, M, k, x]))
+        pvalue = score_cache.get(key)
+        if pvalue is None:
+            pvalue = hypergeom.pmf(x, N, k, M)
+            score_cache[key] = pvalue
+        disease_properties = disease_targets[0]['_source']['disease']['efo_info']
+        target_data = []
+        for d in disease_targets:
+            source = d['_source']
+            source['association_score'] = source.pop('harmonic-sum')
+            del source['disease']
+            target_data.append(source)
+        target_data = sorted(target_data, key=lambda k: k['association_score']['overall'], reverse=True)
+        for t in target_data:
+            t['association_score']['overall'] = Association.cap_score(t['association_score']['overall'])
+        data.append(dict(enriched_entity=dict(type='disease', id=disease_id, label=background[disease_id]['label'],
+                                              properties=disease_properties),
+                         enrichment=dict(method='hypergeometric',
+                                         params=dict(all_targets=N, all_targets_in_disease=k, targets_in_set=M,
+                                                     targets_in_set_in_disease=x),
+                                         score=pvalue),
+                         targets=target_data))
+    return data
+
+
+def vectorised_enrichment(hits, background, N, M):
+    groups = DiseaseGroups()
+    groups.add_hits(hits)
+    return enrichment_results(groups, background, N, M)
+
+
+def matrix_enrichment(matrix, targets):
+    groups, background = matrix.enrichment_input(targets)
+    return enrichment_results(groups, background, matrix.all_targets, len(targets))
+
+
+def main():
+    background = make_background()
+    directory = tempfile.mkdtemp()
+    try:
+        AssociationMatrix.write(directory + '/matrix', make_hits(max(TARGET_SET_SIZES)),
+                                lambda disease_ids: background, ALL_TARGETS, ['literature'])
+        matrix = AssociationMatrix(directory + '/matrix')
+        print '%-8s %8s %8s %12s %12s %12s' % ('targets', 'hits', 'diseases', 'legacy ms', 'vector ms', 'matrix ms')
+        for targets in TARGET_SET_SIZES:
+            timings = []
+            scores = []
+            for func in (legacy_enrichment, vectorised_enrichment, matrix_enrichment):
+                if func is matrix_enrichment:
+                    args = (matrix, ['ENSG%011i' % t for t in range(targets)])
+                else:
+                    hits = make_hits(targets)
+                    args = (hits, background, ALL_TARGETS, targets)
+                gc.collect()
+                start_time = time.time()
+                data = func(*args)
+                timings.append(1000 * (time.time() - start_time))
+                scores.append(dict((d['enriched_entity']['id'], d['enrichment']['score']) for d in data))
+                del data, args
+                hits = None
+            legacy, vectorised, from_matrix = scores
+            assert sorted(legacy) == sorted(vectorised) == sorted(from_matrix)
+            assert all(vectorised[d] == from_matrix[d] for d in legacy)
+            print '%-8i %8i %8i %12.1f %12.1f %12.1f' % ((targets, len(make_hits(targets)), len(legacy)) +
+                                                        tuple(timings))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
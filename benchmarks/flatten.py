@@ -0,0 +1,114 @@
+'''
+rows per second of a tab separated export of 10k association-like rows,
+legacy flatten + DictWriter against the compiled flattener.
+
+    python -m benchmarks.flatten
+'''
+import collections
+import json
+import time
+from io import BytesIO
+
+import unicodecsv as csv
+
+from app.common.elasticsearchclient import SearchParams
+from app.common.response_templates import ResponseType
+from app.common.results import PaginatedResult
+
+__author__ = 'andreap'
+
+
+ROWS = 10000
+FIELDS = ['target.id', 'target.gene_info.symbol', 'disease.id', 'disease.efo_info.label',
+          'association_score.overall', 'association_score.datatypes.literature']
+
+
+def make_rows(n=ROWS):
+    return [dict(id='ENSG%011i-EFO_%07i' % (i, i),
+                 target=dict(id='ENSG%011i' % i,
+                             gene_info=dict(symbol='GENE%i' % i, name='gene %i' % i)),
+                 disease=dict(id='EFO_%07i' % i,
+                              efo_info=dict(label='disease %i' % i,
+                                            therapeutic_area=dict(codes=['EFO_0000001', 'EFO_0000002'],
+                                                                  labels=['area one', 'area two']),
+                                            path=[['EFO_0000001', 'EFO_%07i' % i]])),
+                 association_score=dict(overall=i / float(ROWS),
+                                        datatypes=dict(literature=0.1, rna_expression=0.2, genetic_association=0.3),
+                                        datasources=dict(europepmc=0.1, expression_atlas=0.2, gwas_catalog=0.3)),
+                 evidence_count=dict(total=i, datatypes=dict(literature=i)),
+                 is_direct=True)
+            for i in range(n)]
+
+
+def legacy_flatten(d, parent_key='', sep='.'):
+    items = []
+    for k, v in d.items():
+        new_key = parent_key + sep + k if parent_key else k
+        if isinstance(v, collections.MutableMapping):
+            items.extend(legacy_flatten(v, new_key, sep=sep).items())
+        else:
+            items.append((new_key, v))
+    return_dict = collections.OrderedDict()
+    for k, v in items:
+        if isinstance(v, list):
+            try:
+                v = '|'.join(v).encode('utf-8')
+            except:
+                if len(v) == 1:
+                    v = v[0]
+                else:
+                    v = json.dumps(v, encoding='utf-8')
+        if isinstance(v, str):
+            try:
+                v = unicode(v)
+            except UnicodeDecodeError:
+                pass
+        if not isinstance(v, unicode):
+            v = json.dumps(v, encoding='utf-8')
+        return_dict[unicode(k)] = unicode(v)
+    return return_dict
+
+
+def legacy_to_csv(rows, fields=None):
+    output = BytesIO()
+    key_set = set()
+    flattened_data = []
+    for row in rows:
+        flat = legacy_flatten(row)
+        if fields:
+            flat = dict((k, v) for k, v in flat.items() if k in fields)
+        flattened_data.append(flat)
+        key_set.update(flat.keys())
+    writer = csv.DictWriter(output, map(unicode, fields or sorted(key_set)), restval='',
+                            delimiter='\t', quotechar='"', quoting=csv.QUOTE_MINIMAL,
+                            doublequote=False, escapechar='\\')
+    writer.writeheader()
+    for row in flattened_data:
+        writer.writerow(row)
+    return output.getvalue()
+
+
+def to_csv(rows, fields=None):
+    params = SearchParams(fields=fields, format=ResponseType.TSV)
+    return PaginatedResult(None, params, data=rows).toCSV()
+
+
+def run(name, func, rows, fields):
+    start_time = time.time()
+    output = func(rows, fields)
+    elapsed = time.time() - start_time
+    print '%-28s %10.0f rows/s' % (name, len(rows) / elapsed)
+    return output
+
+
+def main():
+    rows = make_rows()
+    for fields in (None, FIELDS):
+        label = 'fields' if fields else 'all columns'
+        before = run('legacy, %s' % label, legacy_to_csv, rows, fields)
+        after = run('compiled, %s' % label, to_csv, rows, fields)
+        assert before == after, 'outputs differ'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+'''
+time to compute and correct the enrichment p-values of 20k diseases: the
+pure python HypergeometricTest loop the api used to ship, one scipy call per
+disease, one scipy call for all of them, and the batched upper tail with
+each correction.
+
+    python -m benchmarks.hypergeometric
+'''
+import random
+import time
+from math import exp, log
+
+import numpy as np
+from scipy.stats import hypergeom
+
+from app.common.hypergeometric import PValueCorrections, correct, upper_tail_pvalues
+
+__author__ = 'andreap'
+
+
+ALL_TARGETS = 20000
+DISEASES = 20000
+TARGET_SET_SIZE = 100
+# the pure python loop is timed on a sample and scaled up
+LEGACY_SAMPLE = 1000
+
+
+def make_counts(diseases=DISEASES, targets=TARGET_SET_SIZE):
+    rnd = random.Random(0)
+    k = [rnd.randint(1, 5000) for _ in range(diseases)]
+    x = [rnd.randint(1, min(kd, targets)) for kd in k]
+    return k, x
+
+
+def _gammaln(x):
+    cof = [76.18009173, -86.50532033, 24.01409822, -1.231739516, 0.120858003e-2, -0.536382e-5]
+    if x == 0 or x == 1:
+        return 0
+    y = x - 1
+    tmp = y + 5.5
+    tmp -= (y + 0.5) * log(tmp)
+    ser = 1
+    for c in cof:
+        y += 1
+        ser += c / y
+    return log(x) + (log(2.50662827465 * ser) - tmp)
+
+
+def _choose(a, b):
+    return _gammaln(a) - (_gammaln(b) + _gammaln(a - b))
+
+
+def legacy_pvalue(N, M, k, x):
+    pvalue = 0
+    for i in range(x, (min(k, M) + 1)):
+        pvalue += exp(_choose(M, x) + _choose((N - M), (k - i)) - _choose(N, k))
+    return pvalue
+
+
+def run(name, func, scale=1.):
+    start_time = time.time()
+    func()
+    print '%-40s %10.1f ms' % (name, 1000 * (time.time() - start_time) * scale)
+
+
+def main():
+    k, x = make_counts()
+    N, M = ALL_TARGETS, TARGET_SET_SIZE
+    print '%i diseases, %i targets in the set' % (DISEASES, M)
+    run('pure python loop (scaled from %i)' % LEGACY_SAMPLE,
+        lambda: [legacy_pvalue(N, M, kd, xd) for kd, xd in zip(k[:LEGACY_SAMPLE], x[:LEGACY_SAMPLE])],
+        scale=float(DISEASES) / LEGACY_SAMPLE)
+    run('scipy sf per disease', lambda: [hypergeom.sf(xd - 1, N, kd, M) for kd, xd in zip(k, x)])
+    run('scipy sf, one call', lambda: hypergeom.sf(np.asarray(x) - 1, N, np.asarray(k), M))
+    run('batched upper tail', lambda: upper_tail_pvalues(N, M, k, x))
+    pvalues = upper_tail_pvalues(N, M, k, x)
+    for correction in (PValueCorrections.BONFERRONI, PValueCorrections.BENJAMINI_HOCHBERG):
+        run('batched upper tail + %s' % correction, lambda: correct(upper_tail_pvalues(N, M, k, x), correction))
+    print 'diseases under 0.001: %i uncorrected, %i bonferroni, %i bh' % (
+        (pvalues <= 1e-3).sum(),
+        (correct(pvalues, PValueCorrections.BONFERRONI) <= 1e-3).sum(),
+        (correct(pvalues, PValueCorrections.BENJAMINI_HOCHBERG) <= 1e-3).sum())
+
+
+if __name__ == '__main__':
+    main()
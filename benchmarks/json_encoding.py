@@ -0,0 +1,56 @@
+'''
+encoding of a page of 1000 associations, as sent by /public/association/filter,
+with the stdlib json module and with ujson, and what a cache hit costs when
+the document is cached decoded or already encoded.
+
+    python -m benchmarks.json_encoding
+'''
+import time
+
+from app.common.codecs import CacheCodec, JSONCodec, UJSONCodec
+from benchmarks.flatten import make_rows
+from config import Config
+
+__author__ = 'andreap'
+
+
+REPEAT = 20
+
+
+def make_page(size=1000):
+    return dict(data=make_rows(size),
+                data_version=Config.DATA_VERSION,
+                from_=0,
+                size=size,
+                total=size * 100,
+                took=0.1,
+                next=[0.5, 'ENSG00000000001-EFO_0000001'])
+
+
+def run(name, func):
+    start_time = time.time()
+    for _ in range(REPEAT):
+        func()
+    print '%-40s %8.2f ms' % (name, 1000 * (time.time() - start_time) / REPEAT)
+
+
+def main():
+    page = make_page()
+    stdlib, fast = JSONCodec(), UJSONCodec()
+    encoded = stdlib.dumps(page)
+    assert stdlib.loads(fast.dumps(page)) == stdlib.loads(encoded), 'outputs differ'
+
+    run('encode, json', lambda: stdlib.dumps(page))
+    run('encode, ujson', lambda: fast.dumps(page))
+    run('decode, json', lambda: stdlib.loads(encoded))
+    run('decode, ujson', lambda: fast.loads(encoded))
+
+    codec = CacheCodec()
+    cached_document, cached_json = codec.dumps(page), codec.dumps(encoded)
+    run('cache hit, decode + encode with json', lambda: stdlib.dumps(codec.loads(cached_document)))
+    run('cache hit, decode + encode with ujson', lambda: fast.dumps(codec.loads(cached_document)))
+    run('cache hit, encoded json passed through', lambda: codec.loads(cached_json))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+'''
+memory each forked worker stops sharing with the master after reading every
+entry of a mapping loaded before the fork, held as a plain dict of nested
+documents or as a FrozenMap. linux only, it reads /proc/self/smaps.
+
+    python -m benchmarks.prefork_memory
+'''
+import gc
+import os
+
+from app.common.prefork import FrozenMap
+
+__author__ = 'andreap'
+
+
+WORKERS = 4
+SIZE = 50000
+
+
+def make_mapping(size=SIZE):
+    return dict(('EFO_%07d' % i, dict(efo_code='EFO_%07d' % i,
+                                      label='tissue %d' % i,
+                                      organs=['organ %d' % (i % 50), 'organ %d' % (i % 7)],
+                                      anatomical_systems=['system %d' % (i % 13)]))
+                for i in range(size))
+
+
+def private_dirty_kb():
+    total = 0
+    with open('/proc/self/smaps') as f:
+        for line in f:
+            if line.startswith('Private_Dirty:'):
+                total += int(line.split()[1])
+    return total
+
+
+def measure(mapping):
+    '''
+    :return: private dirty kB gained by each worker reading all of `mapping`
+    '''
+    gc.collect()
+    results = []
+    for _ in range(WORKERS):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            before = private_dirty_kb()
+            # the keys come from the requests, not from the mapping
+            for i in xrange(SIZE):
+                mapping.get('EFO_%07d' % i)
+            os.write(write_fd, str(private_dirty_kb() - before))
+            os._exit(0)
+        os.close(write_fd)
+        results.append(int(os.read(read_fd, 64)))
+        os.close(read_fd)
+        os.waitpid(pid, 0)
+    return results
+
+
+def main():
+    for name, load in (('nothing loaded', dict),
+                       ('dict', make_mapping), ('FrozenMap', lambda: FrozenMap(make_mapping()))):
+        loaded = load()
+        results = measure(loaded)
+        del loaded
+        print '%-20s %8d kB private per worker, %8d kB for %d workers' % (
+            name, sum(results) / len(results), sum(results), WORKERS)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+'''
+cpu time per request of a cached association page with facets, sent
+gzipped: compressed by Flask-Compress on every request, against the
+variant compressed once when the response is cached.
+
+    python -m benchmarks.response_compression
+'''
+import time
+
+from flask import Flask, Response
+from flask_compress import Compress
+from werkzeug.contrib.cache import SimpleCache
+
+from app.common.codecs import UJSONCodec
+from app.common.response_cache import ResponseCache
+from benchmarks.json_encoding import make_page
+
+__author__ = 'andreap'
+
+
+REQUESTS = 200
+URL = '/v3/platform/public/association/filter?facets=true'
+
+
+def make_app(body, encodings):
+    app = Flask(__name__)
+    Compress(app)
+
+    @app.route('/v3/platform/public/association/filter')
+    def associations():
+        return Response(body, mimetype='application/json')
+
+    ResponseCache(SimpleCache(),
+                  paths=['/public/association'],
+                  encodings=encodings,
+                  compress_level=app.config['COMPRESS_LEVEL'],
+                  compress_mimetypes=app.config['COMPRESS_MIMETYPES']).init_app(app)
+    return app
+
+
+def run(name, app, accept_encoding):
+    client = app.test_client()
+    headers = {'Accept-Encoding': accept_encoding}
+    resp = client.get(URL, headers=headers)  # cache the response
+    start_cpu = time.clock()
+    for _ in range(REQUESTS):
+        client.get(URL, headers=headers)
+    cpu_ms = 1000 * (time.clock() - start_cpu) / REQUESTS
+    print '%-45s %8.2f ms cpu/request %8i bytes' % (name, cpu_ms, len(resp.data))
+
+
+def main():
+    page = make_page(1000)
+    page['facets'] = dict(('facet%i' % i, dict(buckets=[dict(key='EFO_%07i' % j, label='disease %i' % j,
+                                                                doc_count=j) for j in range(100)]))
+                          for i in range(10))
+    body = UJSONCodec().dumps(page)
+    print 'body: %i bytes' % len(body)
+    run('gzip, compressed by Flask-Compress', make_app(body, encodings=()), 'gzip')
+    run('gzip, compressed when cached', make_app(body, encodings=('gzip',)), 'gzip')
+    run('br, compressed when cached', make_app(body, encodings=('br', 'gzip')), 'br, gzip')
+
+
+if __name__ == '__main__':
+    main()
@@ -56,7 +56,8 @@ class Config:
     DATA_VERSION = env('OPENTARGETS_DATA_VERSION', default='20.02')
     # tagged version from expression_hierarchy repository must have same DATA_VERSION tag
     ES_TISSUE_MAP_URL = 'https://raw.githubusercontent.com/opentargets/expression_hierarchy/{0}/process/map_with_efos.json'
-    ES_TISSUE_MAP = None
+    # directory of the local copy of the tissue map of each DATA_VERSION, see app.common.tissues
+    ES_TISSUE_MAP_PATH = env('ES_TISSUE_MAP_PATH', default='/tmp/')
     ## logic to point to custom indices in ES
     ES_CUSTOM_IDXS_FILENAME = basedir + os.path.sep + 'es_custom_idxs.ini'
     ES_CUSTOM_IDXS = ast.literal_eval(env('OPENTARGETS_ES_CUSTOM_IDXS',default='False'))
@@ -139,12 +140,92 @@ class Config:
                                                   'beta.targetvalidation.org', 'localhost', '127.0.0.1'],
                       }
     REDIS_SERVER_PATH = env('REDIS_SERVER_PATH', default='/tmp/api_redis.db')
+    # redis server of the background jobs queue, kept apart from the caches one that evicts keys
+    JOBS_REDIS_SERVER_PATH = env('JOBS_REDIS_SERVER_PATH', default='/tmp/api_jobs_redis.db')
 
     SECRET_PATH = env('SECRET_PATH', default='app/authconf/')
     SECRET_IP_RESOLVER_FILE = env('SECRET_IP_RESOLVER_FILE', default='ip_list.csv')
     IP_RESOLVER_LIST_PATH = os.path.join(SECRET_PATH, SECRET_IP_RESOLVER_FILE)
 
     NO_CACHE_PARAMS = 'no_cache'
+    # size of the in-process cache tier in front of redis, per worker. 0 disables it
+    CACHE_LOCAL_MAX_BYTES = env('CACHE_LOCAL_MAX_BYTES', cast=int, default=64 * 1024 * 1024)
+    # seconds a worker waits for another one computing the same missing key
+    CACHE_LOCK_TTL = env('CACHE_LOCK_TTL', cast=int, default=60)
+    # seconds an expired cached response is still served while it is refreshed in background
+    CACHE_STALE_TTL = env('CACHE_STALE_TTL', cast=int, default=60 * 60)
+    CACHE_STALE_TTL_EXPENSIVE = env('CACHE_STALE_TTL_EXPENSIVE', cast=int, default=24 * 60 * 60)
+    # cached values bigger than this are stored zlib compressed in redis
+    CACHE_COMPRESS_MIN_BYTES = env('CACHE_COMPRESS_MIN_BYTES', cast=int, default=16 * 1024)
+    # memory limit of the redis server holding the caches, 0 for no limit
+    CACHE_REDIS_MAX_BYTES = env('CACHE_REDIS_MAX_BYTES', cast=int, default=1024 * 1024 * 1024)
+    # seconds between checks of the indices behind the elasticsearch aliases, the cache
+    # follows an alias moved to a new index within this time
+    CACHE_INDEX_CHECK_INTERVAL = env('CACHE_INDEX_CHECK_INTERVAL', cast=int, default=60)
+    # requests counted to be replayed by `manage.py warm_cache` after a data release
+    CACHE_WARMUP_PATHS = ['/public/association/filter', '/private/target/']
+    CACHE_WARMUP_MAX_KEYS = env('CACHE_WARMUP_MAX_KEYS', cast=int, default=10000)
+
+    # rendered GET responses of these paths, after the /platform prefix, are kept in the
+    # application cache and sent without running the resources, see app.common.response_cache
+    RESPONSE_CACHE_PATHS = ['/public/association',
+                            '/public/evidence',
+                            '/public/search',
+                            '/public/utils/stats',
+                            '/public/utils/metrics',
+                            '/public/utils/therapeuticareas',
+                            '/private/target',
+                            '/private/disease',
+                            '/private/drug',
+                            '/private/eco',
+                            '/private/relation',
+                            '/private/quicksearch',
+                            '/private/autocomplete',
+                            '/private/besthitsearch',
+                            ]
+    RESPONSE_CACHE_TIMEOUT = env('RESPONSE_CACHE_TIMEOUT', cast=int, default=60 * 60)
+    # cached responses are stored compressed with each of these content encodings too
+    RESPONSE_CACHE_ENCODINGS = ['br', 'gzip']
+    RESPONSE_CACHE_BR_LEVEL = env('RESPONSE_CACHE_BR_LEVEL', cast=int, default=9)
+
+    # directory of the memory mapped reactome and therapeutic area label files shared by the
+    # workers of a host. labels are kept in each process if empty
+    LABEL_INDEX_PATH = env('LABEL_INDEX_PATH', default='')
+
+    # directory of the targets x diseases association matrix of each DATA_VERSION, built by
+    # `manage.py build_association_matrix` before the workers start, they look for it once.
+    # enrichments scroll the association index if empty or not built
+    ASSOCIATION_MATRIX_PATH = env('ASSOCIATION_MATRIX_PATH', default='/tmp/')
+
+    # load the read only data shared by the workers, like the tissue map and the openapi spec, in
+    # the uwsgi master before forking them, in forms that keep its memory pages shared
+    FREEZE_SHARED_DATA = env('FREEZE_SHARED_DATA', cast=bool, default=True)
+
+    # background jobs, e.g. large enrichments, run at a time by `manage.py run_jobs`
+    JOBS_CONCURRENCY = env('JOBS_CONCURRENCY', cast=int, default=2)
+    # seconds a job and its result are kept in redis after its last update
+    JOBS_RESULT_TTL = env('JOBS_RESULT_TTL', cast=int, default=24 * 60 * 60)
+    # jobs waiting to run before new ones are refused with a 503
+    JOBS_MAX_QUEUED = env('JOBS_MAX_QUEUED', cast=int, default=100)
+    # seconds without news from a running job before it is taken for lost with its runner and queued
+    # again, up to JOBS_MAX_ATTEMPTS runs
+    JOBS_HEARTBEAT_TIMEOUT = env('JOBS_HEARTBEAT_TIMEOUT', cast=int, default=5 * 60)
+    JOBS_MAX_ATTEMPTS = env('JOBS_MAX_ATTEMPTS', cast=int, default=2)
+
+    # documents fetched from elasticsearch at a time by the streaming exports
+    STREAM_PAGE_SIZE = env('STREAM_PAGE_SIZE', cast=int, default=1000)
+    # do not buffer the streaming exports to compress them
+    COMPRESS_STREAMS = False
+
+    # independent elasticsearch calls of a request run concurrently, see app.common.fanout
+    ES_FAN_OUT_POOL_SIZE = env('ES_FAN_OUT_POOL_SIZE', cast=int, default=8)
+    ES_FAN_OUT_TIMEOUT = env('ES_FAN_OUT_TIMEOUT', cast=int, default=300)
+
+    # encoder of the json responses and of the cached values marshal cannot store: json or ujson.
+    # ujson is faster but keeps at most JSON_DOUBLE_PRECISION decimals of the floats, 15 tops: values
+    # below 1e-15, like the p-values of the enrichments, are written as 0.0
+    JSON_ENCODER = env('JSON_ENCODER', default='json')
+    JSON_DOUBLE_PRECISION = env('JSON_DOUBLE_PRECISION', cast=int, default=15)
 
     MIXPANEL_TOKEN = env('MIXPANEL_TOKEN', default=None)
 
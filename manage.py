@@ -116,6 +116,79 @@ def runserver(host="127.0.0.1", port=8080):
         serve()
 
 
+@manager.command
+def warm_cache(top=1000, concurrency=8, access_log=None):
+    """Replay the most frequent requests to fill the cache after a data release.
+
+    Requests are taken from the traffic recorded by the running api or, for a
+    fresh deploy, from an nginx/uwsgi access log.
+    """
+    from app.common.warmup import read_access_log, warm_up
+    top = int(top)
+    paths = app.config['CACHE_WARMUP_PATHS']
+    if access_log:
+        counter = read_access_log(access_log, paths)
+        requests, total = counter.most_common(top), sum(counter.values())
+    else:
+        traffic = app.extensions['traffic']
+        requests, total = traffic.top(top), traffic.total()
+    if not requests:
+        print('no recorded requests to replay')
+        return
+    print('replaying %i requests, %i concurrently' % (len(requests), int(concurrency)))
+    report = warm_up(app.test_client(), requests, total=total, concurrency=int(concurrency))
+    print('warmed %i/%i requests in %.1fs, covering %.1f%% of the recorded traffic' % (
+        report['requests'] - report['failed'], report['requests'], report['seconds'], 100 * report['coverage']))
+    for full_path, error in report['errors']:
+        print('  failed %s: %s' % (full_path, error))
+
+
+@manager.command
+def startup_profile(repeat=1):
+    """Report the time spent in each stage of create_app.
+
+    The first report is the app built when this script was loaded, the others
+    are built again in the same process, e.g. like a respawned worker.
+    """
+    print('create_app, first build')
+    print(app.extensions['startup_profile'].report())
+    for i in range(int(repeat) - 1):
+        rebuilt = create_app(env('OPENTARGETS_API_CONFIG', default='default'))
+        print('\ncreate_app, build %i' % (i + 2))
+        print(rebuilt.extensions['startup_profile'].report())
+
+
+@manager.command
+def fetch_tissue_map():
+    """Download the tissue map of the data version, so that the workers do not need github."""
+    print('tissue map stored in %s' % app.extensions['esquery'].tissue_map.fetch())
+
+
+@manager.command
+def build_association_matrix(force=False):
+    """Export the associations of the data version to the matrix the enrichments are computed from."""
+    from app.common.enrichment import association_matrix_directory
+    import shutil
+    directory = association_matrix_directory(app.config['ASSOCIATION_MATRIX_PATH'], app.config['DATA_VERSION'])
+    if os.path.exists(directory):
+        if not force:
+            print('association matrix already in %s, pass --force to build it again' % directory)
+            return
+        shutil.rmtree(directory)
+    matrix = app.extensions['esquery'].export_association_matrix(directory)
+    print('association matrix of %(targets)i targets, %(diseases)i diseases and %(associations)i associations '
+          'stored in %(directory)s' % matrix.info())
+
+
+@manager.command
+def run_jobs(concurrency=None):
+    """Run the background jobs submitted to /private/jobs, e.g. large enrichments, until stopped."""
+    concurrency = int(concurrency or app.config['JOBS_CONCURRENCY'])
+    print('running background jobs, %i at a time' % concurrency)
+    # the job functions read the request like the endpoints they stand for
+    app.extensions['jobs'].work(concurrency, context=app.test_request_context)
+
+
 @manager.command
 def list_routes():
     import urllib
@@ -0,0 +1,194 @@
+import copy
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import gevent
+from flask import Flask, current_app
+from redislite import Redis
+from scipy.stats import hypergeom
+
+from app.common.elasticsearchclient import InternalCache, esQuery
+from app.common.enrichment import AssociationMatrix, DiseaseGroups, enrichment_results
+from app.common.hypergeometric import PValueCorrections
+
+__author__ = 'andreap'
+
+
+def make_hit(target_id, disease_id, score):
+    return {'_source': {'target': dict(id=target_id, gene_info=dict(symbol=target_id.lower())),
+                        'harmonic-sum': dict(overall=score, datatypes=dict(literature=score / 2)),
+                        'disease': dict(id=disease_id, efo_info=dict(label=disease_id.lower()))}}
+
+
+class EnrichmentDataMixin(object):
+
+    def setUp(self):
+        self.hits = [make_hit('T1', 'EFO_2', 0.5),
+                     make_hit('T1', 'EFO_1', 0.2),
+                     make_hit('T2', 'EFO_2', 1.3),
+                     make_hit('T3', 'EFO_2', 0.7)]
+        self.background = dict(EFO_1=dict(id='EFO_1', label='one', association_counts=dict(total=40)),
+                               EFO_2=dict(id='EFO_2', label='two', association_counts=dict(total=10)))
+
+
+class EnrichmentTestCase(EnrichmentDataMixin, unittest.TestCase):
+
+    def testGroupsByIntegerCode(self):
+        groups = DiseaseGroups()
+        groups.add_hits(self.hits)
+        self.assertEqual(groups.ids, ['EFO_2', 'EFO_1'])
+        self.assertEqual(groups.counts().tolist(), [3, 1])
+        self.assertEqual([[s['target']['id'] for s in group] for group in groups.groups()],
+                         [['T1', 'T2', 'T3'], ['T1']])
+
+    def testResults(self):
+        groups = DiseaseGroups()
+        groups.add_hits(self.hits)
+        data = enrichment_results(groups, self.background, 20000, 3)
+        self.assertEqual([d['enriched_entity']['id'] for d in data], ['EFO_2', 'EFO_1'])
+        two = data[0]
+        self.assertEqual(two['enriched_entity']['label'], 'two')
+        self.assertEqual(two['enriched_entity']['properties'], dict(label='efo_2'))
+        self.assertEqual(two['enrichment']['params'], dict(all_targets=20000,
+                                                           all_targets_in_disease=10,
+                                                           targets_in_set=3,
+                                                           targets_in_set_in_disease=3))
+        self.assertIsInstance(two['enrichment']['score'], float)
+        # all the 3 targets in the set are in the disease: the upper tail is the point probability
+        self.assertAlmostEqual(two['enrichment']['score'], hypergeom.pmf(3, 20000, 10, 3))
+        self.assertEqual(two['enrichment']['pvalue'], two['enrichment']['score'])
+        self.assertEqual(two['enrichment']['correction'], PValueCorrections.NONE)
+        self.assertAlmostEqual(data[1]['enrichment']['score'], hypergeom.sf(0, 20000, 40, 3))
+        self.assertEqual([t['target']['id'] for t in two['targets']], ['T2', 'T3', 'T1'])
+        self.assertEqual(two['targets'][0]['association_score']['overall'], 1.)
+        self.assertNotIn('disease', two['targets'][0])
+
+    def testCorrection(self):
+        groups = DiseaseGroups()
+        groups.add_hits(self.hits)
+        data = enrichment_results(groups, self.background, 20000, 3, PValueCorrections.BONFERRONI)
+        for d in data:
+            self.assertEqual(d['enrichment']['correction'], PValueCorrections.BONFERRONI)
+            self.assertAlmostEqual(d['enrichment']['score'], 2 * d['enrichment']['pvalue'])
+
+    def testNoHits(self):
+        groups = DiseaseGroups()
+        self.assertEqual(groups.groups(), [])
+        self.assertEqual(enrichment_results(groups, self.background, 20000, 3), [])
+
+
+class AssociationMatrixTestCase(EnrichmentDataMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(AssociationMatrixTestCase, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.directory = os.path.join(self.path, 'association_matrix_20.02')
+        AssociationMatrix.write(self.directory, copy.deepcopy(self.hits), lambda ids: self.background,
+                                20000, ['genetic_association', 'literature'])
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def testNotBuilt(self):
+        self.assertIsNone(AssociationMatrix.load(os.path.join(self.path, 'association_matrix_19.11')))
+
+    def testRows(self):
+        matrix = AssociationMatrix.load(self.directory)
+        self.assertEqual(matrix.info()['associations'], 4)
+        self.assertEqual(matrix.indptr.tolist(), [0, 2, 3, 4])
+        self.assertEqual([matrix.disease_ids[i] for i in matrix.indices.tolist()], ['EFO_2', 'EFO_1', 'EFO_2', 'EFO_2'])
+        self.assertIn('T2', matrix)
+        self.assertNotIn('T4', matrix)
+
+    def testSameResultsAsTheScroll(self):
+        matrix = AssociationMatrix(self.directory)
+        groups = DiseaseGroups()
+        groups.add_hits(self.hits)
+        expected = enrichment_results(groups, self.background, 20000, 3)
+        # the matrix stores a score for each datatype
+        for d in expected:
+            for target in d['targets']:
+                target['association_score']['datatypes']['genetic_association'] = 0.
+        groups, background = matrix.enrichment_input(['T3', 'T1', 'T2', 'T4', 'T1'])
+        data = enrichment_results(groups, background, matrix.all_targets, 3)
+        key = lambda d: d['enriched_entity']['id']
+        self.assertEqual(sorted(data, key=key), sorted(expected, key=key))
+
+    def testNoKnownTargets(self):
+        groups, background = AssociationMatrix(self.directory).enrichment_input(['T4'])
+        self.assertEqual(len(groups), 0)
+        self.assertEqual(background, {})
+
+
+class TargetFragmentsTestCase(EnrichmentDataMixin, unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.db_path = os.path.join(tempfile.mkdtemp(), 'test_enrichment.db')
+        cls.r_server = Redis(cls.db_path, db=1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.r_server.shutdown()
+
+    def setUp(self):
+        super(TargetFragmentsTestCase, self).setUp()
+        self.r_server.flushdb()
+        self.es = esQuery(None, None, None, cache=InternalCache(self.r_server, 'test'))
+        self.es._count_targets_with_associations = lambda: 20000
+        self.es._scan_enrichment_associations = self.scan
+        self.es._get_disease_background = self.get_background
+        self.scanned = []
+        self.fetched = []
+        app = Flask(__name__)
+        app.config['APP_CACHE_EXPIRY_TIMEOUT'] = 60
+        self.context = app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        self.context.pop()
+
+    def scan(self, query):
+        targets = query['terms']['target.id']
+        self.scanned.append(sorted(targets))
+        return [copy.deepcopy(hit) for hit in self.hits if hit['_source']['target']['id'] in targets]
+
+    def get_background(self, disease_ids):
+        self.fetched.append(sorted(disease_ids))
+        return dict((disease_id, self.background[disease_id]) for disease_id in disease_ids)
+
+    def enrich(self, targets):
+        res = self.es.get_enrichment_for_targets(targets, pvalue_threshold=1, size=100)
+        return dict((d['enriched_entity']['id'], d['enrichment']['params']['targets_in_set_in_disease'])
+                    for d in res.data)
+
+    def testOnlyNewTargetsAreScanned(self):
+        self.assertEqual(self.enrich(['T1', 'T2']), dict(EFO_1=1, EFO_2=2))
+        self.assertEqual(self.scanned, [['T1', 'T2']])
+        self.assertEqual(self.fetched, [['EFO_1', 'EFO_2']])
+
+        self.assertEqual(self.enrich(['T2', 'T3', 'T1']), dict(EFO_1=1, EFO_2=3))
+        self.assertEqual(self.scanned, [['T1', 'T2'], ['T3']])
+        self.assertEqual(self.fetched, [['EFO_1', 'EFO_2']])
+
+    def testStaleTargetsAreScannedAgainTogether(self):
+        self.es.cache.stale_ttl = 60
+        current_app.config['APP_CACHE_EXPIRY_TIMEOUT'] = 1
+        self.assertEqual(self.enrich(['T1', 'T2']), dict(EFO_1=1, EFO_2=2))
+        time.sleep(1.1)
+        self.assertEqual(self.enrich(['T1', 'T2', 'T3']), dict(EFO_1=1, EFO_2=3))
+        gevent.sleep(0.1)
+        self.assertEqual(self.scanned, [['T1', 'T2'], ['T3'], ['T1', 'T2']])
+        self.assertEqual(self.es.cache.info()['stale']['refreshed'], 2 + 2)
+
+    def testTargetsWithoutAssociationsAreCached(self):
+        self.assertEqual(self.enrich(['T3', 'T4']), dict(EFO_2=1))
+        self.assertEqual(self.enrich(['T4', 'T3', 'T1']), dict(EFO_1=1, EFO_2=2))
+        self.assertEqual(self.scanned, [['T3', 'T4'], ['T1']])
+
+
+if __name__ == "__main__":
+     unittest.main()
@@ -0,0 +1,60 @@
+import time
+import unittest
+
+import gevent
+from flask import Flask, request
+
+from app.common.fanout import FanOutTimeout, fan_out
+
+__author__ = 'andreap'
+
+
+class FanOutTestCase(unittest.TestCase):
+
+    def testCallsRunConcurrently(self):
+        def slow(value):
+            gevent.sleep(0.2)
+            return value
+
+        start_time = time.time()
+        res = fan_out(dict(a=lambda: slow(1), b=lambda: slow(2), c=lambda: slow(3)))
+        self.assertEqual(res, dict(a=1, b=2, c=3))
+        self.assertLess(time.time() - start_time, 0.4)
+
+    def testPoolSizeIsBounded(self):
+        running = []
+
+        def call():
+            running.append(1)
+            self.assertLessEqual(len(running), 2)
+            gevent.sleep(0.05)
+            running.pop()
+
+        fan_out(dict((str(i), call) for i in range(6)), size=2)
+
+    def testFailuresCancelTheOtherCalls(self):
+        completed = []
+
+        def slow():
+            gevent.sleep(0.5)
+            completed.append(1)
+
+        def fail():
+            raise ValueError('failed')
+
+        self.assertRaises(ValueError, fan_out, dict(slow=slow, fail=fail))
+        gevent.sleep(0.6)
+        self.assertEqual(completed, [])
+
+    def testSlowCallsTimeOut(self):
+        self.assertRaises(FanOutTimeout, fan_out, dict(slow=lambda: gevent.sleep(1)), timeout=0.1)
+
+    def testCallsSeeTheRequest(self):
+        app = Flask(__name__)
+        with app.test_request_context('/?no_cache=true'):
+            res = fan_out(dict(a=lambda: request.values.get('no_cache')))
+        self.assertEqual(res, dict(a='true'))
+
+
+if __name__ == "__main__":
+     unittest.main()
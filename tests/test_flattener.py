@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from app.common.flattener import Flattener, get_flattener
+from benchmarks.flatten import legacy_flatten, make_rows
+
+__author__ = 'andreap'
+
+
+class FlattenerTestCase(unittest.TestCase):
+
+    row = {'target': {'id': 'ENSG1', 'gene_info': {'symbol': u'G\xe9NE'}},
+           'disease': {'efo_info': {'therapeutic_area': {'codes': ['EFO_1', 'EFO_2']},
+                                    'path': [['EFO_1', 'EFO_3']]}},
+           'unique_association_fields': {'url': 'http://identifiers.org/pubmed/1'},
+           'biological_object': {'properties': {'experiment_specific': 'x'}},
+           'score': 0.5,
+           'is_direct': True,
+           'nothing': None}
+
+    def testSameOutputAsLegacyFlatten(self):
+        for row in make_rows(10) + [self.row]:
+            self.assertEqual(Flattener().flatten(row), legacy_flatten(row))
+
+    def testSimplify(self):
+        flat = Flattener(simplify=True).flatten(self.row)
+        self.assertNotIn('unique_association_fields.url', flat)
+        self.assertNotIn('biological_object.properties.experiment_specific', flat)
+        self.assertEqual(flat['target.id'], 'ENSG1')
+
+    def testRowsMatchFlattenedValues(self):
+        fields = ['target.id', 'target.gene_info.symbol', 'disease.efo_info.therapeutic_area.codes',
+                  'disease.efo_info.path', 'score', 'nothing', 'missing.field', 'unique_association_fields.url']
+        flat = Flattener().flatten(self.row)
+        self.assertEqual(Flattener(fields).row(self.row),
+                         [flat.get(f, u'') for f in fields])
+        simplified = Flattener(fields, simplify=True).row(self.row)
+        self.assertEqual(simplified[-1], u'')
+
+    def testExcludedFields(self):
+        flattener = Flattener(['target.id', 'score'], exclude=['score'])
+        self.assertEqual(flattener.row(self.row), [u'ENSG1', u''])
+        self.assertNotIn('score', Flattener(exclude=['score']).flatten(self.row))
+
+    def testFlattenersAreShared(self):
+        self.assertIs(get_flattener(['target.id']), get_flattener(['target.id']))
+        self.assertIsNot(get_flattener(['target.id']), get_flattener(['target.id'], simplify=True))
+
+
+if __name__ == "__main__":
+     unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+
+import numpy as np
+from scipy.stats import hypergeom
+
+from app.common.hypergeometric import PValueCorrections, benjamini_hochberg, bonferroni, correct, \
+    upper_tail_pvalues
+
+__author__ = 'andreap'
+
+
+class HypergeometricTestCase(unittest.TestCase):
+
+    def testUpperTail(self):
+        k = [10, 40, 500, 7]
+        x = [3, 1, 2, 1]
+        pvalues = upper_tail_pvalues(20000, 30, k, x)
+        for i in range(len(k)):
+            expected = sum(hypergeom.pmf(j, 20000, k[i], 30) for j in range(x[i], min(k[i], 30) + 1))
+            self.assertAlmostEqual(pvalues[i] / expected, 1., places=9)
+        # no targets of the set in the disease or more always happens
+        self.assertEqual(upper_tail_pvalues(20000, 30, [10], [0]).tolist(), [1.])
+
+    def testMatchesScipyOnBothSidesOfTheMode(self):
+        N, M = 20000, 652
+        k = np.array([15775, 15775, 15775, 10, 10190, 5000, 3])
+        x = np.array([61, 514, 600, 2, 150, 200, 3])
+        pvalues = upper_tail_pvalues(N, M, k, x)
+        np.testing.assert_allclose(pvalues, hypergeom.sf(x - 1, N, k, M), rtol=1e-9)
+
+    def testBonferroni(self):
+        self.assertEqual(bonferroni([0.01, 0.2, 0.5]).tolist(), [0.03, 0.6000000000000001, 1.])
+
+    def testBenjaminiHochberg(self):
+        pvalues = [0.01, 0.04, 0.03, 0.005, 0.5]
+        corrected = benjamini_hochberg(pvalues)
+        # p * n / rank, then the lowest of the ranks from there up
+        expected = [0.025, 0.05, 0.05, 0.025, 0.5]
+        np.testing.assert_allclose(corrected, expected)
+        self.assertEqual(benjamini_hochberg([]).tolist(), [])
+        self.assertEqual(benjamini_hochberg([0.9, 0.95]).tolist(), [0.95, 0.95])
+
+    def testCorrect(self):
+        pvalues = [0.01, 0.02]
+        self.assertEqual(correct(pvalues).tolist(), pvalues)
+        self.assertEqual(correct(pvalues, PValueCorrections.BONFERRONI).tolist(), [0.02, 0.04])
+        self.assertEqual(correct(pvalues, PValueCorrections.BENJAMINI_HOCHBERG).tolist(), [0.02, 0.02])
+        self.assertRaises(KeyError, correct, pvalues, 'holm')
+
+
+if __name__ == "__main__":
+     unittest.main()
@@ -0,0 +1,460 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from collections import OrderedDict
+
+import gevent
+from elasticsearch import TransportError
+from flask import Flask, current_app
+from redislite import Redis
+
+from app.common.cache import LocalLRUCache, KeyFoldCounter, SharedCache, SingleFlight, SingleFlightCancelled, \
+    canonical_cache_key
+from app.common.codecs import CacheCodec, JSONCodec, UJSONCodec, get_json_codec
+from app.common.elasticsearchclient import InternalCache, QueryPlan, esQuery
+from app.common.results import RawResult, Result
+
+__author__ = 'andreap'
+
+
+class LocalLRUCacheTestCase(unittest.TestCase):
+
+    def testEvictsLeastRecentlyUsedBySize(self):
+        lru = LocalLRUCache(max_bytes=150)
+        lru.set('a', 'x' * 60, 60)
+        lru.set('b', 'y' * 60, 60)
+        self.assertEqual(lru.get('a'), 'x' * 60)
+        lru.set('c', 'z' * 60, 60)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(lru.get('a'), 'x' * 60)
+        self.assertEqual(lru.get('c'), 'z' * 60)
+        self.assertLessEqual(lru.current_bytes, 150)
+        self.assertEqual(lru.evictions, 1)
+
+    def testReturnsACopy(self):
+        lru = LocalLRUCache()
+        lru.set('k', {'hits': [{'_source': {'a': 1}}]}, 60)
+        lru.get('k')['hits'][0]['_source'].pop('a')
+        self.assertEqual(lru.get('k'), {'hits': [{'_source': {'a': 1}}]})
+
+    def testTooBigValuesAreNotStored(self):
+        lru = LocalLRUCache(max_bytes=10)
+        self.assertFalse(lru.set('k', 'x' * 100, 60))
+        self.assertIsNone(lru.get('k'))
+        self.assertEqual(lru.current_bytes, 0)
+
+
+class InternalCacheTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.db_path = os.path.join(tempfile.mkdtemp(), 'test_cache.db')
+        cls.r_server = Redis(cls.db_path, db=1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.r_server.shutdown()
+
+    def setUp(self):
+        self.r_server.flushdb()
+
+    def testTiersAreCountedSeparately(self):
+        cache = InternalCache(self.r_server, 'test', local_max_bytes=1024 * 1024)
+        self.assertIsNone(cache.get('missing'))
+        cache.set('key', {'took': 1}, 60)
+        self.assertEqual(cache.get('key'), {'took': 1})
+        tiers = cache.info()['tiers']
+        self.assertEqual(tiers['memory']['hits'], 1)
+        self.assertEqual(tiers['redis']['misses'], 1)
+
+        # another worker only shares the redis tier
+        other_worker = InternalCache(self.r_server, 'test', local_max_bytes=1024 * 1024)
+        self.assertEqual(other_worker.get('key'), {'took': 1})
+        self.assertEqual(other_worker.get('key'), {'took': 1})
+        tiers = other_worker.info()['tiers']
+        self.assertEqual(tiers['redis']['hits'], 1)
+        self.assertEqual(tiers['memory']['hits'], 1)
+
+    def testConcurrentMissesAreCoalesced(self):
+        cache = InternalCache(self.r_server, 'test')
+        calls = []
+
+        def search():
+            calls.append(1)
+            gevent.sleep(0.1)
+            return {'hits': [1, 2]}, 60
+
+        greenlets = [gevent.spawn(cache.get_or_set, 'key', search) for _ in range(10)]
+        gevent.joinall(greenlets)
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all(g.value == {'hits': [1, 2]} for g in greenlets))
+        self.assertEqual(cache.info()['coalesced']['greenlets'], 9)
+
+    def testOtherWorkersWaitForTheLock(self):
+        cache = InternalCache(self.r_server, 'test', lock_poll_interval=0.01)
+        other_worker = InternalCache(self.r_server, 'test', lock_poll_interval=0.01)
+        calls = []
+
+        def search():
+            calls.append(1)
+            gevent.sleep(0.1)
+            return 'value', 60
+
+        first = gevent.spawn(cache.get_or_set, 'key', search)
+        gevent.sleep(0.01)
+        second = gevent.spawn(other_worker.get_or_set, 'key', search)
+        gevent.joinall([first, second])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(second.value, 'value')
+        self.assertEqual(other_worker.info()['coalesced']['workers'], 1)
+
+    def testStaleValuesAreServedWhileRefreshed(self):
+        cache = InternalCache(self.r_server, 'test', stale_ttl=60)
+        cache.set('key', 'old', ttl=1, stale_ttl=60)
+        calls = []
+
+        def search():
+            calls.append(1)
+            gevent.sleep(0.05)
+            return 'new', 60
+
+        time.sleep(1.1)
+        self.assertEqual(cache.get_or_set('key', search), 'old')
+        self.assertEqual(cache.get_or_set('key', search), 'old')
+        gevent.sleep(0.2)
+        self.assertEqual(cache.get_or_set('key', search), 'new')
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(cache.info()['stale'], dict(served=2, refreshed=1))
+
+    def testStaleValuesAreRefreshedInTheAppContext(self):
+        cache = InternalCache(self.r_server, 'test', stale_ttl=60)
+        cache.set('key', 'old', ttl=1, stale_ttl=60)
+        app = Flask(__name__)
+        app.config['APP_CACHE_EXPIRY_TIMEOUT'] = 60
+
+        def search():
+            return 'new', current_app.config['APP_CACHE_EXPIRY_TIMEOUT']
+
+        time.sleep(1.1)
+        with app.app_context():
+            self.assertEqual(cache.get_or_set('key', search), 'old')
+        gevent.sleep(0.1)
+        self.assertEqual(cache.get('key'), 'new')
+        self.assertEqual(cache.info()['stale'], dict(served=1, refreshed=1))
+
+    def testHardTtlIncludesTheStaleWindow(self):
+        cache = InternalCache(self.r_server, 'test')
+        cache.set('key', 'value', ttl=10, stale_ttl=50)
+        self.assertGreater(self.r_server.ttl(cache._get_namespaced_key('key')), 10)
+
+    def testMemoryTierCanBeDisabled(self):
+        cache = InternalCache(self.r_server, 'test')
+        cache.set('key', 'value', 60)
+        self.assertEqual(cache.get('key'), 'value')
+        self.assertEqual(cache.info()['memory']['entries'], 0)
+
+    def testBumpingTheGenerationInvalidatesAllWorkers(self):
+        worker_a = InternalCache(self.r_server, 'test', local_max_bytes=1024 * 1024)
+        worker_b = InternalCache(self.r_server, 'test', local_max_bytes=1024 * 1024,
+                                 namespace_check_interval=0)
+        worker_a.set('key', 'value', 60)
+        self.assertEqual(worker_b.get('key'), 'value')
+        self.assertEqual(worker_a.bump_generation(), 1)
+        self.assertIsNone(worker_a.get('key'))
+        self.assertIsNone(worker_b.get('key'))
+        self.assertEqual(worker_b.info()['namespace']['generation'], 1)
+
+    def testNamespaceFollowsTheIndices(self):
+        indices = ['20.02_association-data']
+        cache = InternalCache(self.r_server, 'test', data_version='20.02',
+                              index_resolver=lambda: indices)
+        cache.set('key', 'value', 60)
+        self.assertEqual(cache.get('key'), 'value')
+        indices = ['20.02_association-data-reindexed']
+        self.assertEqual(cache.get('key'), 'value')
+        cache.bump_generation()
+        self.assertIsNone(cache.get('key'))
+
+    def testAliasMovesAreFollowedWithoutBumpingTheGeneration(self):
+        indices = ['20.02_association-data']
+
+        def resolve():
+            if indices is None:
+                raise ValueError('elasticsearch is down')
+            return indices
+
+        worker_a = InternalCache(self.r_server, 'test', local_max_bytes=1024 * 1024,
+                                 index_resolver=resolve, namespace_check_interval=0, index_check_interval=0)
+        worker_b = InternalCache(self.r_server, 'test', index_resolver=resolve,
+                                 namespace_check_interval=0, index_check_interval=0)
+        worker_a.set('key', 'value', 60)
+        self.assertEqual(worker_b.get('key'), 'value')
+        indices = ['20.02_association-data-reindexed']
+        self.assertIsNone(worker_a.get('key'))
+        self.assertIsNone(worker_b.get('key'))
+        worker_b.set('key', 'new', 60)
+        self.assertEqual(worker_a.get('key'), 'new')
+        self.assertEqual(worker_a.info()['namespace']['generation'], 0)
+        indices = None
+        self.assertEqual(worker_a.get('key'), 'new')
+
+    def testMissingKeysAreComputedTogether(self):
+        cache = InternalCache(self.r_server, 'test')
+        cache.set('b', 'cached', 60)
+        calls = []
+
+        def msearch(missing):
+            calls.append(missing)
+            return [(key.upper(), 60) for key in missing]
+
+        self.assertEqual(cache.get_many_or_set(['a', 'b', 'c', 'a'], msearch), ['A', 'cached', 'C', 'A'])
+        self.assertEqual(calls, [['a', 'c']])
+        self.assertEqual(cache.get_many_or_set(['c', 'a'], msearch), ['C', 'A'])
+        self.assertEqual(len(calls), 1)
+
+    def testStaleKeysAreRefreshedTogether(self):
+        cache = InternalCache(self.r_server, 'test', stale_ttl=60)
+        for key in 'abc':
+            cache.set(key, 'old', ttl=1 if key != 'b' else 60, stale_ttl=60)
+        calls = []
+
+        def msearch(keys):
+            calls.append(keys)
+            return [(key.upper(), 60) for key in keys]
+
+        time.sleep(1.1)
+        self.assertEqual(cache.get_many_or_set(['a', 'b', 'c', 'd'], msearch), ['old', 'old', 'old', 'D'])
+        # a refresh already running is not started again
+        self.assertEqual(cache.get_many_or_set(['a', 'c'], msearch), ['old', 'old'])
+        gevent.sleep(0.1)
+        self.assertEqual(calls, [['d'], ['a', 'c']])
+        self.assertEqual(cache.get_many_or_set(['a', 'b', 'c'], msearch), ['A', 'old', 'C'])
+        self.assertEqual(cache.info()['stale'], dict(served=4, refreshed=2))
+
+    def testSharedCacheNamespacesAreIndependent(self):
+        es_cache = InternalCache(self.r_server, 'test', local_max_bytes=1024 * 1024)
+        app_cache = SharedCache(es_cache.namespace('app'))
+        es_cache.set('key', 'es', 60)
+        self.assertTrue(app_cache.add('key', 'app'))
+        self.assertFalse(app_cache.add('key', 'other'))
+        self.assertEqual(app_cache.get('key'), 'app')
+        self.assertEqual(app_cache.info()['tiers']['memory']['hits'], 2)
+        app_cache.clear()
+        self.assertIsNone(app_cache.get('key'))
+        self.assertEqual(es_cache.get('key'), 'es')
+        self.assertTrue(app_cache.set('key', 'app'))
+        self.assertTrue(app_cache.delete('key'))
+        self.assertFalse(app_cache.has('key'))
+
+    def testLegacyJsonEntriesAreReadable(self):
+        cache = InternalCache(self.r_server, 'test')
+        self.r_server.set(cache._get_namespaced_key('key'), '{"hits": {"total": 1}}')
+        self.assertEqual(cache.get('key'), {'hits': {'total': 1}})
+
+
+class FakeHandler(object):
+    '''
+    answers every search with the index and body it was sent, or with the
+    error given for its index
+    '''
+
+    def __init__(self, errors=None):
+        self.errors = errors or {}
+        self.searches = []
+        self.msearches = []
+
+    def search(self, index, body):
+        self.searches.append(body)
+        return dict(hits=dict(index=index, body=body))
+
+    def msearch(self, body):
+        self.msearches.append(body[1::2])
+        responses = []
+        for header, search in zip(body[::2], body[1::2]):
+            if header['index'] in self.errors:
+                responses.append(dict(error=dict(type=self.errors[header['index']]), status=400))
+            else:
+                responses.append(dict(hits=dict(index=header['index'], body=search), status=200))
+        return dict(responses=responses)
+
+
+class QueryPlanTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.db_path = os.path.join(tempfile.mkdtemp(), 'test_query_plan.db')
+        cls.r_server = Redis(cls.db_path, db=1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.r_server.shutdown()
+
+    def setUp(self):
+        self.r_server.flushdb()
+        self.handler = FakeHandler(errors={'broken': 'query_shard_exception'})
+        self.es = esQuery(self.handler, None, None, cache=InternalCache(self.r_server, 'test'))
+        self.context = Flask(__name__).test_request_context()
+        self.context.push()
+
+    def tearDown(self):
+        self.context.pop()
+
+    def testOnlyMissingSearchesAreSent(self):
+        self.es._cached_search(index='idx', body={'size': 1})
+        plan = QueryPlan(self.es)
+        cached = plan.search('idx', {'size': 1})
+        missing = plan.search('idx', {'size': 2})
+        plan.execute()
+        self.assertEqual(self.handler.msearches, [[{'size': 2}]])
+        self.assertEqual(cached.result, dict(hits=dict(index='idx', body={'size': 1})))
+        self.assertEqual(missing.result, dict(hits=dict(index='idx', body={'size': 2})))
+        # the searches of the plan share the cache entries of the single searches
+        self.assertEqual(self.es._cached_search(index='idx', body={'size': 2}), missing.result)
+        self.assertEqual(self.handler.searches, [{'size': 1}])
+
+    def testErrorsAreRaisedAndNotCached(self):
+        plan = QueryPlan(self.es)
+        plan.search('idx', {'size': 1})
+        plan.search('broken', {'size': 1})
+        self.assertRaises(TransportError, plan.execute)
+        self.assertRaises(TransportError, self.es._cached_msearch, [dict(index='broken', body={'size': 1})])
+        self.assertEqual(len(self.handler.msearches), 2)
+
+    def testStaleJsonIsRefreshedOutsideOfTheRequest(self):
+        current_app.config['APP_CACHE_EXPIRY_TIMEOUT'] = 60
+        key = self.es._cache_key('json', ['efo_info', 'EFO_1'])
+        self.es.cache.set(key, '{"label": "old"}', ttl=1, stale_ttl=60)
+        time.sleep(1.1)
+
+        def document():
+            return self.es._cached_search(index='efo', body={'size': 1})['hits']
+
+        self.assertEqual(self.es._cached_json(['efo_info', 'EFO_1'], document), '{"label": "old"}')
+        gevent.sleep(0.1)
+        self.assertEqual(json.loads(self.es.cache.get(key)), dict(index='efo', body={'size': 1}))
+        self.assertEqual(self.es.cache.info()['stale'], dict(served=1, refreshed=1))
+
+    def testStatusIsStripped(self):
+        self.assertEqual(self.es._cached_msearch([dict(index='idx', body={'size': 1})]),
+                         [dict(hits=dict(index='idx', body={'size': 1}))])
+        self.assertEqual(self.es.cache.get(self.es._cache_key(index='idx', body={'size': 1})),
+                         dict(hits=dict(index='idx', body={'size': 1})))
+
+
+class CacheCodecTestCase(unittest.TestCase):
+
+    def testCodecIsChosenBySize(self):
+        codec = CacheCodec(compress_min_bytes=1024)
+        small = {'took': 1, 'hits': [u'ENSG1', 1.5, None]}
+        big = {'hits': [{'id': u'ENSG%i' % i, 'score': 0.1 * i} for i in range(1000)]}
+        small_data, big_data = codec.dumps(small), codec.dumps(big)
+        self.assertEqual(codec.loads(small_data), small)
+        self.assertEqual(codec.loads(big_data), big)
+        info = codec.info()
+        self.assertEqual(info['marshal']['encoded'], 1)
+        self.assertEqual(info['marshal+zlib']['encoded'], 1)
+        self.assertGreater(info['marshal+zlib']['compression_ratio'], 1)
+
+    def testUnmarshallableValuesFallBackToJson(self):
+        codec = CacheCodec()
+        data = codec.dumps(OrderedDict(key='value'))
+        self.assertEqual(codec.loads(data), {'key': 'value'})
+        self.assertEqual(codec.info()['json']['encoded'], 1)
+
+    def testUJSONCodec(self):
+        codec = UJSONCodec()
+        value = {'score': 0.123456789, 'id': u'ENSG\xe9', 'url': 'http://identifiers.org/x', 'n': [1, None, True]}
+        self.assertEqual(codec.loads(codec.dumps(value)), value)
+        # at most 15 decimals are kept
+        self.assertAlmostEqual(codec.loads(codec.dumps(0.1 + 0.2)), 0.1 + 0.2, places=15)
+        # ujson cannot encode nan, the stdlib module does
+        self.assertEqual(codec.dumps(float('nan')), 'NaN')
+        self.assertRaises(ValueError, UJSONCodec, 17)
+        self.assertEqual(CacheCodec(json_codec=codec).loads('{"a": 1}'), {'a': 1})
+
+    def testSmallFloatsAreKeptByTheDefaultCodec(self):
+        self.assertIsInstance(get_json_codec(), JSONCodec)
+        self.assertNotIsInstance(Result.json_codec, UJSONCodec)
+        enrichment = {'enrichment': {'score': 3.2e-16, 'pvalue': 1.234567891e-40, 'tail': [1e-39, 5e-41, 0.]}}
+        self.assertEqual(json.loads(RawResult(enrichment).toJSON()), enrichment)
+        codec = CacheCodec(json_codec=Result.json_codec)
+        self.assertEqual(codec.json.loads(codec.json.dumps(enrichment)), enrichment)
+        # the loss ujson is documented for
+        self.assertEqual(json.loads(UJSONCodec().dumps(enrichment))['enrichment']['pvalue'], 0.)
+
+
+class SingleFlightTestCase(unittest.TestCase):
+
+    def testWaitersGetACopy(self):
+        flights = SingleFlight()
+
+        def compute():
+            gevent.sleep(0.05)
+            return {'a': [1]}
+
+        def leader():
+            value = flights.do('k', compute)
+            value['a'].append(2)
+            return value
+
+        first = gevent.spawn(leader)
+        gevent.sleep(0)
+        second = gevent.spawn(flights.do, 'k', compute)
+        gevent.joinall([first, second])
+        self.assertEqual(first.value, {'a': [1, 2]})
+        self.assertEqual(second.value, {'a': [1]})
+
+    def testErrorsArePropagated(self):
+        flights = SingleFlight()
+
+        def compute():
+            gevent.sleep(0.05)
+            raise KeyError('boom')
+
+        greenlets = [gevent.spawn(flights.do, 'k', compute) for _ in range(3)]
+        gevent.joinall(greenlets)
+        self.assertTrue(all(isinstance(g.exception, KeyError) for g in greenlets))
+        self.assertNotIn('k', flights)
+
+
+    def testWaitersAreReleasedWhenTheLeaderIsKilled(self):
+        flight = SingleFlight()
+        leader = gevent.spawn(flight.do, 'key', lambda: gevent.sleep(10))
+        gevent.sleep(0)
+        waiter = gevent.spawn(flight.do, 'key', lambda: 'unused')
+        gevent.sleep(0)
+        leader.kill()
+        waiter.join(timeout=1)
+        self.assertIsInstance(waiter.exception, SingleFlightCancelled)
+
+
+class CanonicalCacheKeyTestCase(unittest.TestCase):
+
+    def testKeyOrderAndTimeoutsAreIgnored(self):
+        body_a = {'query': {'terms': {'target.id': ['ENSG2', 'ENSG1']}}, 'size': 10}
+        body_b = {'size': 10, 'query': {'terms': {'target.id': ['ENSG1', 'ENSG2']}}}
+        self.assertEqual(canonical_cache_key(index='idx', body=body_a, timeout='10m'),
+                         canonical_cache_key(body=body_b, index='idx', request_timeout=60))
+
+    def testOrderedListsAreKept(self):
+        self.assertNotEqual(canonical_cache_key(body={'sort': ['a', 'b']}),
+                            canonical_cache_key(body={'sort': ['b', 'a']}))
+        order_a = {'aggs': {'x': {'terms': {'field': 'f', 'order': [{'_count': 'desc'}, {'_key': 'asc'}]}}}}
+        order_b = {'aggs': {'x': {'terms': {'field': 'f', 'order': [{'_key': 'asc'}, {'_count': 'desc'}]}}}}
+        self.assertNotEqual(canonical_cache_key(body=order_a), canonical_cache_key(body=order_b))
+
+    def testFoldsAreCounted(self):
+        folds = KeyFoldCounter()
+        key = canonical_cache_key(body={'a': 1, 'b': 2})
+        folds.record("{'a': 1, 'b': 2}", key)
+        folds.record("{'b': 2, 'a': 1}", key)
+        stats = folds.to_dict()
+        self.assertEqual(stats['canonical_keys'], 1)
+        self.assertEqual(stats['raw_keys'], 2)
+        self.assertEqual(stats['top'][0]['raw_keys'], 2)
+
+
+if __name__ == "__main__":
+     unittest.main()
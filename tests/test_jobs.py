@@ -0,0 +1,183 @@
+import json
+import os
+import tempfile
+import unittest
+
+import gevent
+from redislite import Redis
+
+from app.common.jobs import JobQueue, JobStatus, QueueFull
+from app.common.results import SimpleResult
+from app.resources.jobs import register_jobs, validate_enrichment
+
+__author__ = 'andreap'
+
+
+class JobQueueTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.db_path = os.path.join(tempfile.mkdtemp(), 'test_jobs.db')
+        cls.r_server = Redis(cls.db_path, db=1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.r_server.shutdown()
+
+    def setUp(self):
+        self.r_server.flushdb()
+        self.queue = JobQueue(self.r_server, result_ttl=60, max_queued=2)
+        self.seen_progress = []
+
+        def add(params, progress):
+            progress(.5, 'half way')
+            self.seen_progress.append(self.queue.get(self.running)['progress'])
+            return SimpleResult(None, data=dict(total=params['a'] + params['b']))
+
+        def validate(params):
+            if 'a' not in params:
+                raise ValueError('a is required')
+            return params
+
+        def fail(params, progress):
+            raise RuntimeError('no elasticsearch')
+
+        def slow(params, progress):
+            gevent.sleep(params['seconds'])
+            return SimpleResult(None, data={})
+
+        self.queue.register('add', add, validate)
+        self.queue.register('fail', fail)
+        self.queue.register('slow', slow)
+
+    def run_next(self):
+        job_id = self.r_server.lpop(self.queue._queue_key)
+        self.running = job_id
+        self.queue.run(job_id)
+        return job_id
+
+    def testSubmit(self):
+        first = self.queue.submit('add', dict(a=1, b=2))
+        second = self.queue.submit('add', dict(a=3, b=4))
+        self.assertEqual(first['status'], JobStatus.QUEUED)
+        self.assertEqual(first['params'], dict(a=1, b=2))
+        self.assertEqual(self.queue.get(second['id'])['queued_before'], 1)
+        self.assertIsNone(self.queue.get_result(first['id']))
+
+    def testRejected(self):
+        self.assertRaises(ValueError, self.queue.submit, 'multiply', dict(a=1, b=2))
+        self.assertRaises(ValueError, self.queue.submit, 'add', dict(b=2))
+        self.queue.submit('add', dict(a=1, b=2))
+        self.queue.submit('add', dict(a=1, b=2))
+        self.assertRaises(QueueFull, self.queue.submit, 'add', dict(a=1, b=2))
+        self.run_next()
+        self.queue.submit('add', dict(a=1, b=2))
+
+    def testRun(self):
+        job = self.queue.submit('add', dict(a=1, b=2))
+        self.assertEqual(self.run_next(), job['id'])
+        self.assertEqual(self.seen_progress, [.5])
+        done = self.queue.get(job['id'])
+        self.assertEqual(done['status'], JobStatus.DONE)
+        self.assertEqual(done['progress'], 1.)
+        self.assertLessEqual(done['started'], done['finished'])
+        self.assertEqual(json.loads(self.queue.get_result(job['id']))['data'], dict(total=3))
+        self.assertLessEqual(self.r_server.ttl(self.queue._result_key(job['id'])), 60)
+
+    def testFailed(self):
+        job = self.queue.submit('fail', {})
+        self.run_next()
+        failed = self.queue.get(job['id'])
+        self.assertEqual(failed['status'], JobStatus.FAILED)
+        self.assertEqual(failed['error'], 'no elasticsearch')
+        self.assertIsNone(self.queue.get_result(job['id']))
+
+    def testExpired(self):
+        job = self.queue.submit('add', dict(a=1, b=2))
+        self.r_server.delete(self.queue._job_key(job['id']))
+        self.assertIsNone(self.queue.get(job['id']))
+        self.run_next()
+        self.assertIsNone(self.queue.get_result(job['id']))
+
+    def testRunningJobsBeat(self):
+        self.queue.heartbeat_interval = 0.01
+        job = self.queue.submit('slow', dict(seconds=0.1))
+        self.run_next()
+        done = self.queue.get(job['id'])
+        self.assertGreater(done['heartbeat'], done['started'])
+        self.assertEqual(done['attempts'], 1)
+        self.assertEqual(self.queue.info()['running'], 0)
+
+    def testStoppedJobsAreQueuedAgain(self):
+        job = self.queue.submit('slow', dict(seconds=10))
+        self.queue.submit('add', dict(a=1, b=2))
+        runner = gevent.spawn(self.run_next)
+        gevent.sleep(0.05)
+        # the runner is killed while the job runs
+        runner.kill()
+        self.assertEqual(self.queue.get(job['id'])['status'], JobStatus.RUNNING)
+        self.assertEqual(self.queue.recover(), [])
+        self.queue.heartbeat_timeout = 0
+        self.assertEqual(self.queue.recover(), [job['id']])
+        self.assertEqual(self.queue.recover(), [])
+        queued = self.queue.get(job['id'])
+        self.assertEqual(queued['status'], JobStatus.QUEUED)
+        self.assertEqual(queued['queued_before'], 0)
+        self.assertEqual(queued['attempts'], 1)
+
+        # and failed once it ran max_attempts times
+        runner = gevent.spawn(self.run_next)
+        gevent.sleep(0.05)
+        runner.kill()
+        self.assertEqual(self.queue.recover(), [job['id']])
+        failed = self.queue.get(job['id'])
+        self.assertEqual(failed['status'], JobStatus.FAILED)
+        self.assertEqual(failed['attempts'], 2)
+        self.assertEqual(self.queue.info()['queued'], 1)
+
+    def testWork(self):
+        jobs = [self.queue.submit('add', dict(a=i, b=i)) for i in range(2)]
+        self.running = jobs[0]['id']
+        self.queue.work(concurrency=1, poll_timeout=1,
+                        stop=lambda: not self.r_server.llen(self.queue._queue_key))
+        self.assertEqual([json.loads(self.queue.get_result(job['id']))['data']['total'] for job in jobs], [0, 2])
+
+
+class EnrichmentJobTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.db_path = os.path.join(tempfile.mkdtemp(), 'test_enrichment_jobs.db')
+        cls.r_server = Redis(cls.db_path, db=1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.r_server.shutdown()
+
+    def setUp(self):
+        self.r_server.flushdb()
+        self.queue = JobQueue(self.r_server)
+        register_jobs(self.queue)
+
+    def testParametersAreCoerced(self):
+        self.assertEqual(validate_enrichment({'target': 'ENSG1', 'pvalue': '0.01', 'from': '5', 'size': 20}),
+                         {'target': ['ENSG1'], 'pvalue': 0.01, 'from': 5, 'size': 20, 'correction': 'none'})
+        self.assertEqual(validate_enrichment({'target': ['ENSG1', 'ENSG2'], 'correction': 'bh'}),
+                         {'target': ['ENSG1', 'ENSG2'], 'pvalue': 0.001, 'from': 0, 'size': 10, 'correction': 'bh'})
+        job = self.queue.submit('enrichment', {'target': ['ENSG1'], 'pvalue': '0.01'})
+        self.assertEqual(job['params']['pvalue'], 0.01)
+
+    def testInvalidParametersAreRejectedAtSubmission(self):
+        for params in ({'target': ['ENSG1'], 'pvalue': 'low'},
+                       {'target': ['ENSG1'], 'from': 'x'},
+                       {'target': ['ENSG1'], 'size': -1},
+                       {'target': ['ENSG1'], 'size': True},
+                       {'target': ['ENSG1'], 'correction': 'holm'},
+                       {'target': []},
+                       {'target': ['ENSG%i' % i for i in range(1001)]}):
+            self.assertRaises(ValueError, self.queue.submit, 'enrichment', params)
+        self.assertEqual(self.queue.info()['queued'], 0)
+
+
+if __name__ == "__main__":
+     unittest.main()
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from app.common.elasticsearchclient import QueryPlan, esQuery
+from app.common.labels import LabelIndex, MappedLabels
+
+__author__ = 'andreap'
+
+
+class LabelIndexTestCase(unittest.TestCase):
+
+    labels = {'R-HSA-1': u'Signal Transduction', 'R-HSA-2': u'Métabolisme', 'EFO_0000319': 'cardiovascular disease'}
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.version = 'v1'
+        self.loads = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def load(self):
+        self.loads += 1
+        return self.labels
+
+    def testMappedLabels(self):
+        filename = os.path.join(self.path, 'test.labels')
+        MappedLabels.write(filename, self.labels)
+        mapped = MappedLabels(filename)
+        self.assertEqual(len(mapped), 3)
+        for key, label in self.labels.items():
+            self.assertEqual(mapped[key], label)
+        self.assertNotIn('R-HSA-3', mapped)
+        self.assertIsNone(mapped.get('A'))
+        self.assertIsNone(mapped.get('Z'))
+        empty = os.path.join(self.path, 'empty.labels')
+        MappedLabels.write(empty, {})
+        self.assertEqual(MappedLabels(empty).get('R-HSA-1', 'none'), 'none')
+
+    def testLabelsAreLoadedOncePerVersion(self):
+        index = LabelIndex(lambda: self.version)
+        index.add('reactome', self.load)
+        self.assertEqual(index.get('reactome')['R-HSA-1'], 'Signal Transduction')
+        index.get('reactome')
+        self.assertEqual(self.loads, 1)
+        self.version = 'v2'
+        index.get('reactome')
+        self.assertEqual(self.loads, 2)
+
+    def testWorkersShareTheMappedFile(self):
+        first, second = LabelIndex(lambda: self.version, self.path), LabelIndex(lambda: self.version, self.path)
+        first.add('reactome', self.load)
+        second.add('reactome', self.load)
+        self.assertEqual(first.get('reactome')['R-HSA-2'], u'Métabolisme')
+        self.assertEqual(second.get('reactome')['R-HSA-2'], u'Métabolisme')
+        self.assertEqual(self.loads, 1)
+        self.version = 'v2'
+        first.get('reactome')
+        self.assertEqual(len(os.listdir(self.path)), 1)
+
+    def testFailuresAreRetriedLater(self):
+        index = LabelIndex(lambda: self.version, retry_interval=60)
+
+        def fail():
+            self.loads += 1
+            raise IOError('elasticsearch is down')
+
+        index.add('reactome', fail)
+        self.assertIsNone(index.get('reactome'))
+        self.assertIsNone(index.get('reactome'))
+        self.assertEqual(self.loads, 1)
+        index.retry_interval = 0
+        index.add('reactome', self.load)
+        self.assertEqual(len(index.get('reactome')), 3)
+
+
+class FacetLabelsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.es = esQuery(None, None, None, index_reactome='reactome', index_efo='efo')
+        self.es.labels = LabelIndex(lambda: 'v1', retry_interval=60)
+
+    def facets(self):
+        return {'pathway': {'buckets': [{'key': 'R-HSA-1', 'pathway': {'buckets': [{'key': 'R-HSA-2'}]}}]},
+                'therapeutic_area': {'buckets': [{'key': 'efo_0000319'}, {'key': 'efo_0000001'}]}}
+
+    def testFacetsAreLabelledFromTheIndex(self):
+        self.es.labels.add(esQuery.REACTOME_LABELS, lambda: {'R-HSA-1': 'Signal Transduction'})
+        self.es.labels.add(esQuery.THERAPEUTIC_AREA_LABELS, lambda: {'EFO_0000319': 'cardiovascular disease'})
+        plan = QueryPlan(self.es)
+        facets = self.facets()
+        searches = self.es._plan_facet_labels(facets, plan)
+        self.assertEqual(searches, (None, None))
+        self.assertEqual(plan.searches, [])
+        facets = self.es._label_facets(facets, *searches)
+        pathway = facets['pathway']['buckets'][0]
+        self.assertEqual(pathway['label'], 'Signal Transduction')
+        self.assertEqual(pathway['pathway']['buckets'][0]['label'], 'R-HSA-2')
+        self.assertEqual([b['label'] for b in facets['therapeutic_area']['buckets']],
+                         ['cardiovascular disease', 'efo_0000001'])
+
+    def testFacetsAreSearchedIfTheIndexCannotLoad(self):
+        def fail():
+            raise IOError('elasticsearch is down')
+
+        self.es.labels.add(esQuery.REACTOME_LABELS, fail)
+        self.es.labels.add(esQuery.THERAPEUTIC_AREA_LABELS, fail)
+        plan = QueryPlan(self.es)
+        reactome_search, t_areas_search = self.es._plan_facet_labels(self.facets(), plan)
+        self.assertEqual([s.index for s in plan.searches], ['reactome', 'efo'])
+        self.assertEqual(sorted(reactome_search.body['query']['ids']['values']), ['R-HSA-1', 'R-HSA-2'])
+
+
+if __name__ == "__main__":
+     unittest.main()
@@ -0,0 +1,42 @@
+import unittest
+
+from app.common.prefork import FrozenMap
+
+__author__ = 'andreap'
+
+
+class FrozenMapTestCase(unittest.TestCase):
+
+    mapping = {u'UBERON_0000948': {'label': u'heart', 'organs': ['circulatory organ']},
+               u'UBERON_0002107': {'label': u'liver', 'organs': []},
+               'EFO_0000001': [1, 2.5, None],
+               u'\xe9': u'accented'}
+
+    def testLookups(self):
+        frozen = FrozenMap(self.mapping)
+        self.assertEqual(len(frozen), len(self.mapping))
+        for key, value in self.mapping.items():
+            self.assertIn(key, frozen)
+            self.assertEqual(frozen[key], value)
+            self.assertEqual(frozen.get(key), value)
+        self.assertEqual(sorted(frozen.keys()), sorted(self.mapping.keys()))
+        # str and unicode keys find the same entry
+        self.assertEqual(frozen.get('UBERON_0000948')['label'], u'heart')
+
+    def testMissingKeys(self):
+        frozen = FrozenMap(self.mapping)
+        self.assertNotIn('UBERON_0000000', frozen)
+        self.assertIsNone(frozen.get('UBERON_0000000'))
+        self.assertEqual(frozen.get('ZZZ', 'default'), 'default')
+        self.assertRaises(KeyError, lambda: frozen['UBERON_0000000'])
+        self.assertEqual(len(FrozenMap({})), 0)
+        self.assertIsNone(FrozenMap({}).get('a'))
+
+    def testValuesAreCopies(self):
+        frozen = FrozenMap(self.mapping)
+        frozen['UBERON_0000948']['organs'].append('changed')
+        self.assertEqual(frozen['UBERON_0000948']['organs'], ['circulatory organ'])
+
+
+if __name__ == "__main__":
+     unittest.main()
@@ -0,0 +1,87 @@
+import gzip
+import unittest
+from io import BytesIO
+
+from flask import Flask, Response, request
+from werkzeug.contrib.cache import SimpleCache
+
+from app.common.response_cache import ResponseCache, brotli
+
+__author__ = 'andreap'
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.calls = []
+
+        @self.app.route('/v3/platform/public/association/filter')
+        def associations():
+            self.calls.append(request.args.get('target'))
+            return Response('{"data": ["%s"]}' % request.args.get('target') * 100,
+                            mimetype='application/json')
+
+        @self.app.route('/v3/platform/private/utils/logevent')
+        def not_cached():
+            self.calls.append('logevent')
+            return Response('{}', mimetype='application/json')
+
+        self.response_cache = ResponseCache(SimpleCache(),
+                                            paths=['/public/association'],
+                                            compress_mimetypes=['application/json'])
+        self.response_cache.init_app(self.app)
+        self.client = self.app.test_client()
+
+    def testRepeatedRequestsSkipTheResource(self):
+        url = '/v3/platform/public/association/filter?target=ENSG1&size=10'
+        first = self.client.get(url)
+        second = self.client.get('/v3/platform/public/association/filter?size=10&target=ENSG1')
+        self.assertEqual(self.calls, ['ENSG1'])
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(first.headers['ETag'], second.headers['ETag'])
+        self.assertIn('Last-Modified', second.headers)
+        self.assertEqual(self.response_cache.info()['hits'], 1)
+
+        self.client.get('/v3/platform/public/association/filter?target=ENSG2')
+        self.assertEqual(self.calls, ['ENSG1', 'ENSG2'])
+
+    def testConditionalRequestsGetA304(self):
+        url = '/v3/platform/public/association/filter?target=ENSG1'
+        etag = self.client.get(url).headers['ETag']
+        resp = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, '')
+
+    def testEncodingIsNegotiated(self):
+        url = '/v3/platform/public/association/filter?target=ENSG1'
+        plain = self.client.get(url)
+        gzipped = self.client.get(url, headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertEqual(gzipped.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.GzipFile(fileobj=BytesIO(gzipped.data)).read(), plain.data)
+        self.assertNotEqual(plain.headers['ETag'], gzipped.headers['ETag'])
+        self.assertEqual(self.calls, ['ENSG1'])
+
+    @unittest.skipIf(brotli is None, 'brotli is not installed')
+    def testBrotliIsPreferred(self):
+        url = '/v3/platform/public/association/filter?target=ENSG1'
+        plain = self.client.get(url)
+        compressed = self.client.get(url, headers={'Accept-Encoding': 'gzip, deflate, br'})
+        self.assertEqual(compressed.headers['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(compressed.data), plain.data)
+        compressed = self.client.get(url, headers={'Accept-Encoding': 'gzip, br;q=0.5'})
+        self.assertEqual(compressed.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(self.calls, ['ENSG1'])
+
+    def testOtherPathsAndNoCacheAreNotCached(self):
+        self.client.get('/v3/platform/private/utils/logevent')
+        self.client.get('/v3/platform/private/utils/logevent')
+        url = '/v3/platform/public/association/filter?target=ENSG1&no_cache=true'
+        self.client.get(url)
+        self.client.get(url)
+        self.assertEqual(self.calls, ['logevent', 'logevent', 'ENSG1', 'ENSG1'])
+
+
+if __name__ == "__main__":
+     unittest.main()
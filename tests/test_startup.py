@@ -0,0 +1,41 @@
+import time
+import unittest
+
+import gevent
+
+from app.common.startup import Lazy, StartupProfile
+
+__author__ = 'andreap'
+
+
+class StartupTestCase(unittest.TestCase):
+
+    def testStagesAreTimed(self):
+        profile = StartupProfile()
+        time.sleep(0.02)
+        profile.mark('slow')
+        profile.mark('fast')
+        self.assertEqual(profile.stages.keys(), ['slow', 'fast'])
+        self.assertGreater(profile.stages['slow'], profile.stages['fast'])
+        report = profile.report().splitlines()
+        self.assertTrue(report[1].startswith('slow'))
+        self.assertTrue(report[-1].startswith('total'))
+
+    def testLazyValueIsBuiltOnce(self):
+        calls = []
+
+        def build():
+            calls.append(1)
+            gevent.sleep(0.01)
+            return {'value': 1}
+
+        lazy = Lazy(build)
+        self.assertFalse(lazy.loaded)
+        values = [g.value for g in gevent.joinall([gevent.spawn(lazy.get) for _ in range(3)])]
+        self.assertEqual(values, [{'value': 1}] * 3)
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(lazy.loaded)
+
+
+if __name__ == "__main__":
+     unittest.main()
@@ -0,0 +1,200 @@
+import copy
+import json
+import os
+import tempfile
+import unittest
+
+from flask import Flask
+from flask_restful import Api
+from redislite import Redis
+
+from app.common import streaming
+from app.common.datatypes import DataTypes
+from app.common.elasticsearchclient import InternalCache, esQuery
+from app.common.scoring_conf import DataSourceScoring
+from app.common.streaming import csv_rows, ndjson_rows, streamed_response
+from app.resources import association, evidence
+from config import Config
+
+__author__ = 'andreap'
+
+
+class StreamingTestCase(unittest.TestCase):
+
+    rows = [{'target': {'id': 'ENSG1'}, 'association_score': {'overall': 0.5}},
+            {'target': {'id': 'ENSG2'}, 'association_score': {'overall': 0.1}, 'extra': 1}]
+
+    def testNdjsonRows(self):
+        lines = ''.join(ndjson_rows(iter(self.rows))).splitlines()
+        self.assertEqual([json.loads(l) for l in lines], self.rows)
+
+    def testCsvRowsUseTheColumnsOfTheFirstRow(self):
+        lines = ''.join(csv_rows(iter(self.rows), delimiter='\t')).splitlines()
+        self.assertEqual(lines, ['association_score.overall\ttarget.id',
+                                 '0.5\tENSG1',
+                                 '0.1\tENSG2'])
+
+    def testRowsAreSentInChunks(self):
+        chunk_size, streaming.CHUNK_SIZE = streaming.CHUNK_SIZE, 100
+        try:
+            rows = ({'id': 'ENSG%05i' % i} for i in range(100))
+            chunks = list(csv_rows(rows, delimiter=','))
+        finally:
+            streaming.CHUNK_SIZE = chunk_size
+        self.assertGreater(len(chunks), 10)
+        self.assertEqual(''.join(chunks).count('\n'), 101)
+
+    def testFormatIsNegotiated(self):
+        app = Flask(__name__)
+        with app.test_request_context('/', headers={'Accept': 'text/csv'}):
+            resp = streamed_response(iter(self.rows), filename='associations')
+            self.assertEqual(resp.mimetype, 'text/csv')
+            self.assertTrue(resp.is_streamed)
+            self.assertIn('associations.csv', resp.headers['Content-Disposition'])
+        with app.test_request_context('/'):
+            self.assertEqual(streamed_response(iter(self.rows)).mimetype, 'application/x-ndjson')
+
+
+class PagedHandler(object):
+    '''
+    elasticsearch stub answering each search with the next page of hits,
+    recording the bodies it is sent
+    '''
+
+    def __init__(self, pages):
+        self.pages = list(pages)
+        self.bodies = []
+
+    def search(self, index, body, **kwargs):
+        self.bodies.append(copy.deepcopy(body))
+        hits = self.pages.pop(0) if self.pages else []
+        return {'took': 1,
+                'hits': {'hits': copy.deepcopy(hits), 'total': {'value': sum(map(len, self.pages)) + len(hits)}}}
+
+
+def association_hit(i):
+    return {'_source': {'id': 'ENSG1-EFO_%i' % i,
+                        'target': {'id': 'ENSG1'},
+                        'disease': {'id': 'EFO_%i' % i},
+                        'harmonic-sum': {'overall': 1.5 - i * 0.1}},
+            'sort': [1.5 - i * 0.1, 'ENSG1-EFO_%i' % i]}
+
+
+class StreamedAssociationsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.from_object(Config)
+        self.app.config['STREAM_PAGE_SIZE'] = 2
+        self.hits = [association_hit(i) for i in range(5)]
+        self.handler = PagedHandler([self.hits[0:2], self.hits[2:4], self.hits[4:]])
+        self.app.extensions['esquery'] = esQuery(self.handler, DataTypes(self.app), DataSourceScoring(self.app),
+                                                 index_association='association')
+        Api(self.app).add_resource(association.FilterBy, '/public/association/filter')
+
+    def testPagesAreWalkedWithSearchAfter(self):
+        with self.app.test_request_context():
+            rows = list(self.app.extensions['esquery'].iter_associations(page_size=2, target=['ENSG1'],
+                                                                          size=1, **{'from': 3}))
+        self.assertEqual([r['disease']['id'] for r in rows], ['EFO_%i' % i for i in range(5)])
+        # scores are capped like in the paginated associations
+        self.assertEqual(rows[0]['association_score']['overall'], 1.)
+        # the walk stops at the first short page
+        self.assertEqual(len(self.handler.bodies), 3)
+        self.assertNotIn('search_after', self.handler.bodies[0])
+        self.assertEqual([b['search_after'] for b in self.handler.bodies[1:]], [self.hits[1]['sort'],
+                                                                               self.hits[3]['sort']])
+        for body in self.handler.bodies:
+            self.assertEqual(body['size'], 2)
+            self.assertNotIn('from', body)
+            self.assertFalse(body['track_total_hits'])
+            self.assertNotIn('aggs', body)
+            self.assertIn({'terms': {'target.id': ['ENSG1']}}, body['query']['bool']['filter'])
+
+    def testStreamedResourceIgnoresSize(self):
+        resp = self.app.test_client().get('/public/association/filter?target=ENSG1&stream=true&format=csv&size=1')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/csv')
+        self.assertTrue(resp.is_streamed)
+        lines = resp.get_data().splitlines()
+        self.assertEqual(len(lines), 6)
+        self.assertIn('disease.id', lines[0].split(','))
+        self.assertEqual([b['size'] for b in self.handler.bodies], [2, 2, 2])
+
+    def testStreamedResourceDefaultsToNdjson(self):
+        resp = self.app.test_client().get('/public/association/filter?target=ENSG1&stream=true')
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        rows = [json.loads(l) for l in resp.get_data().splitlines()]
+        self.assertEqual([r['id'] for r in rows], [h['_source']['id'] for h in self.hits])
+
+
+def evidence_hit(i):
+    return {'_id': 'ev%i' % i,
+            '_source': {'id': 'ev%i' % i,
+                        'target': {'id': 'ENSG1'},
+                        'disease': {'id': 'EFO_%i' % i},
+                        'sourceID': 'chembl',
+                        'scores': {'association_score': 1. - i * 0.1}},
+            'sort': [1. - i * 0.1, 'ev%i' % i]}
+
+
+class StreamedEvidenceTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.db_path = os.path.join(tempfile.mkdtemp(), 'test_streaming.db')
+        cls.r_server = Redis(cls.db_path, db=1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.r_server.shutdown()
+
+    def setUp(self):
+        self.r_server.flushdb()
+        self.app = Flask(__name__)
+        self.app.config.from_object(Config)
+        self.app.config['STREAM_PAGE_SIZE'] = 2
+        self.hits = [evidence_hit(i) for i in range(5)]
+        Api(self.app).add_resource(evidence.FilterBy, '/public/evidence/filter')
+
+    def set_pages(self, pages):
+        self.handler = PagedHandler(pages)
+        self.app.extensions['esquery'] = esQuery(self.handler, DataTypes(self.app), DataSourceScoring(self.app),
+                                                 index_data='evidence',
+                                                 cache=InternalCache(self.r_server, 'test'))
+
+    def testPagesAreWalkedWithSearchAfter(self):
+        self.set_pages([self.hits[0:2], self.hits[2:4], self.hits[4:]])
+        with self.app.test_request_context():
+            rows = list(self.app.extensions['esquery'].iter_evidence(targets=['ENSG1'], datasources=['chembl'],
+                                                                      page_size=2, size=1, **{'from': 3}))
+        self.assertEqual([r['id'] for r in rows], ['ev%i' % i for i in range(5)])
+        self.assertEqual(len(self.handler.bodies), 3)
+        self.assertNotIn('search_after', self.handler.bodies[0])
+        self.assertEqual([b['search_after'] for b in self.handler.bodies[1:]], [self.hits[1]['sort'],
+                                                                               self.hits[3]['sort']])
+        for body in self.handler.bodies:
+            self.assertEqual(body['size'], 2)
+            self.assertNotIn('from', body)
+            self.assertFalse(body['track_total_hits'])
+            # filters restrict the hits walked, a post_filter would only hide them from the results
+            self.assertNotIn('post_filter', body)
+            conditions = json.dumps(body['query']['bool']['filter'])
+            self.assertIn('ENSG1', conditions)
+            self.assertIn('chembl', conditions)
+
+    def testStreamedRowsMatchThePaginatedEvidence(self):
+        self.set_pages([self.hits])
+        paginated = self.app.test_client().get('/public/evidence/filter?target=ENSG1&size=5')
+        self.assertEqual(paginated.status_code, 200)
+        self.set_pages([self.hits[0:2], self.hits[2:4], self.hits[4:]])
+        streamed = self.app.test_client().get('/public/evidence/filter?target=ENSG1&stream=true')
+        self.assertEqual(streamed.mimetype, 'application/x-ndjson')
+        rows = json.loads(paginated.get_data())['data']
+        self.assertEqual(len(rows), 5)
+        self.assertEqual([json.loads(l) for l in streamed.get_data().splitlines()], rows)
+        self.assertEqual(len(self.handler.bodies), 3)
+
+
+if __name__ == "__main__":
+     unittest.main()
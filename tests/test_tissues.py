@@ -0,0 +1,72 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from app.common.elasticsearchclient import _inject_tissue_data
+from app.common.prefork import FrozenMap
+from app.common.tissues import TissueMap
+
+__author__ = 'andreap'
+
+
+class TissueMapTestCase(unittest.TestCase):
+
+    tissues = {'tissues': {'heart': {'efo_code': 'UBERON_0000948', 'label': 'heart'},
+                           'liver': {'efo_code': 'UBERON_0002107', 'label': 'liver'}}}
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        source = os.path.join(self.path, 'map_with_efos.json')
+        with open(source, 'w') as f:
+            json.dump(self.tissues, f)
+        self.tissue_map = TissueMap(os.path.join(self.path, '{0}', '..', 'map_with_efos.json'),
+                                    '20.02',
+                                    os.path.join(self.path, 'artifacts'))
+        os.mkdir(os.path.join(self.path, '20.02'))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def testMapIsStoredOncePerDataVersion(self):
+        self.assertEqual(self.tissue_map.get('UBERON_0000948')['label'], 'heart')
+        self.assertTrue(os.path.exists(self.tissue_map.filename))
+        os.remove(os.path.join(self.path, 'map_with_efos.json'))
+        other = TissueMap(self.tissue_map.url_template, '20.02', self.tissue_map.path)
+        self.assertEqual(other.get('UBERON_0002107')['label'], 'liver')
+
+    def testMasterMapIsNotStoredForTheDataVersion(self):
+        tissue_map = TissueMap(self.tissue_map.url_template, '20.06', self.tissue_map.path)
+        os.mkdir(os.path.join(self.path, 'master'))
+        self.assertEqual(tissue_map.get('UBERON_0000948')['label'], 'heart')
+        self.assertFalse(os.path.exists(tissue_map.filename))
+        os.mkdir(os.path.join(self.path, '20.06'))
+        self.assertEqual(tissue_map.fetch(), tissue_map.filename)
+
+    def testFreezeOnlyLoadsDownloadedMap(self):
+        self.tissue_map.freeze()
+        self.assertIsNone(self.tissue_map._codes)
+        self.tissue_map.fetch()
+        self.tissue_map.freeze()
+        self.assertIsInstance(self.tissue_map.codes, FrozenMap)
+        self.assertEqual(self.tissue_map.get('UBERON_0002107')['label'], 'liver')
+
+    def testUnavailableMapIsEmpty(self):
+        tissue_map = TissueMap(os.path.join(self.path, 'missing', '{0}.json'), '20.02', self.path)
+        self.assertIsNone(tissue_map.get('UBERON_0000948'))
+
+    def testTissueDataIsInjected(self):
+        response = {'facets': {'rna_expression_tissue': {'buckets': [{'key': '1_UBERON_0000948'},
+                                                                     {'key': 'unknown'}]}}}
+        buckets = _inject_tissue_data(response, self.tissue_map)['facets']['rna_expression_tissue']['buckets']
+        self.assertEqual(buckets[0], {'key': 'UBERON_0000948', 'data': self.tissue_map.get('UBERON_0000948')})
+        self.assertEqual(buckets[1], {'key': 'unknown'})
+
+        response = {'tissues': {'UBERON_0002107': {}}}
+        self.assertEqual(_inject_tissue_data(response, self.tissue_map)['tissues']['UBERON_0002107']['data']['label'],
+                         'liver')
+
+
+if __name__ == "__main__":
+     unittest.main()
@@ -0,0 +1,61 @@
+import os
+import tempfile
+import unittest
+
+from flask import Flask
+from redislite import Redis
+
+from app.common.warmup import TrafficRecorder, read_access_log, warm_up
+
+__author__ = 'andreap'
+
+
+class TrafficRecorderTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.r_server = Redis(os.path.join(tempfile.mkdtemp(), 'test_warmup.db'), db=1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.r_server.shutdown()
+
+    def testMostFrequentRequestsAreKept(self):
+        traffic = TrafficRecorder(self.r_server, paths=['/association/filter'], max_keys=2, trim_every=4)
+        self.assertFalse(traffic.should_record('/v3/platform/public/evidence'))
+        self.assertTrue(traffic.should_record('/v3/platform/public/association/filter'))
+        for full_path in ['/a?x=1', '/a?x=1', '/a?x=1', '/b', '/b', '/c', '/a?x=1', '/b']:
+            traffic.record(full_path)
+        self.assertEqual(traffic.top(5), [('/a?x=1', 4), ('/b', 3)])
+        self.assertEqual(traffic.total(), 7)
+
+
+class WarmUpTestCase(unittest.TestCase):
+
+    def testAccessLogIsParsed(self):
+        log = tempfile.NamedTemporaryFile(delete=False)
+        log.write('1.2.3.4 - - [10/Oct/2020:13:55:36 +0000] "GET /v3/platform/public/association/filter?target=ENSG1 HTTP/1.1" 200 2326\n'
+                  '1.2.3.4 - - [10/Oct/2020:13:55:37 +0000] "GET /v3/platform/public/association/filter?target=ENSG1 HTTP/1.1" 200 2326\n'
+                  '1.2.3.4 - - [10/Oct/2020:13:55:38 +0000] "POST /v3/platform/public/association/filter HTTP/1.1" 200 2326\n'
+                  '1.2.3.4 - - [10/Oct/2020:13:55:39 +0000] "GET /v3/platform/public/evidence HTTP/1.1" 200 2326\n')
+        log.close()
+        counter = read_access_log(log.name, paths=['/association/filter'])
+        os.unlink(log.name)
+        self.assertEqual(counter.most_common(), [('/v3/platform/public/association/filter?target=ENSG1', 2)])
+
+    def testCoverageIsReported(self):
+        app = Flask(__name__)
+
+        @app.route('/ok')
+        def ok():
+            return 'ok'
+
+        report = warm_up(app.test_client(), [('/ok', 3), ('/missing', 1)], total=8, concurrency=2)
+        self.assertEqual(report['requests'], 2)
+        self.assertEqual(report['failed'], 1)
+        self.assertEqual(report['errors'], [('/missing', 404)])
+        self.assertAlmostEqual(report['coverage'], 3 / 8.)
+
+
+if __name__ == "__main__":
+     unittest.main()